@@ -1,4 +1,4 @@
-from bankmanager.basebank import BankAccountID
+from bankmanager.basebank import BankAccountID, BankException
 
 
 # Basically a wallet (can easily be blockchainified)
@@ -13,17 +13,44 @@ class BankAccount(object):
         if currency is not None:
             self.add_currency(currency)
 
-    def check_balance(self):
+    def _ledger_of(self, ledger):
+        # A TransactionList brings its ledger up to date
+        ledger = getattr(ledger, "ledger", ledger)
+        if ledger.bank_code is not self._bankid:
+            raise BankException("Account " + str(self._id) +
+                                " is not in the ledger of bank " +
+                                str(ledger.bank_code.bankid))
+        return ledger
+
+    def check_balance(self, ledger):
         """
-        TODO :  Do some algorithm  here to check transaction records and return
-                value
-        TODO : Maybe some kind of cache as well,  or to get it via a push
-                notification whenever we calculate bank balance
+        Balance of the account in the base currency, read from the account
+        index of its bank's transactions, without walking them
+
+        Parameters
+        ----------
+        ledger : instance of AccountLedger or TransactionList,
+            Of the bank of the account
+
         Returns
         -------
+        balance : float,
+            Money in minus money out, also kept as the last calculated one
+        """
+        self._last_calculated_balance = self._ledger_of(ledger).balance(
+            self._id)
+        return self._last_calculated_balance
 
+    def statement(self, ledger):
         """
-        pass
+        Transactions of the account, in log order. Same ledger as for
+        check_balance.
+        """
+        return self._ledger_of(ledger).statement(self._id)
+
+    @property
+    def last_calculated_balance(self):
+        return self._last_calculated_balance
 
     def add_currency(self, new_currency_str=None):
         self._currencies.append(new_currency_str)
@@ -0,0 +1,593 @@
+"""
+Running sums for balances.
+
+The daily and category reports only need, per bucket, the converted
+incoming and outgoing amounts and a few counts. Accumulating those as the
+transactions go by means the transactions themselves never have to be kept.
+"""
+import math
+import logging
+import numpy as np
+from bankmanager import fixedpoint
+from bankmanager.currencyrates import encode_currencies
+
+logger = logging.getLogger(__name__)
+
+INTERNAL = 0
+OUTGOING = 1
+INCOMING = 2
+
+# Dimensions transactions can be aggregated along, see aggregate_balances
+DATE = "date"
+CATEGORY = "category"
+CURRENCY = "currency"
+WEEKDAY = "weekday"  # 0 is Monday, like datetime.date.weekday
+
+
+def classify_and_convert(transaction, bank_code, currency_rates,
+                         fixed_point=False):
+    """
+    Parameters
+    ----------
+    transaction : instance of Transaction
+    bank_code : instance of BankCode,
+        The bank whose point of view is taken
+    currency_rates : instance of CurrencyRateList
+    fixed_point : bool,
+        Convert to int minor units, see bankmanager.fixedpoint
+
+    Returns
+    -------
+    direction, amount : (int, float),
+        direction is one of INTERNAL, OUTGOING, INCOMING. amount is in
+        config.BASE_CURRENCY (an int of minor units with fixed_point), None
+        for internal transactions
+    """
+    if transaction.internal:
+        return INTERNAL, None
+    # Rates of config.BASE_CURRENCY are 1, except for CrossRates
+    rate = currency_rates.rate_at(transaction.currency_code,
+                                  transaction.epoch_us)
+    if rate is None:
+        logger.info("We are parsing a currency, whose"
+                    " rate is not defined at that time. "
+                    "Assuming as if it is USD")
+        rate = 1
+    if fixed_point:
+        amount = fixedpoint.convert_minor_one(
+            transaction.transaction_amount_nocurrency,
+            transaction.currency_code, rate,
+            fixedpoint.report_exponent(currency_rates))
+    else:
+        amount = transaction.transaction_amount_nocurrency * rate
+    if transaction.is_outgoing(bank_code):
+        return OUTGOING, amount
+    elif transaction.is_incoming(bank_code):
+        return INCOMING, amount
+    else:
+        assert 1 == 0, "Every transaction has to be internal "\
+                       "or incoming or outgoing"
+
+
+def classify_and_convert_many(transactions, bank_code, currency_rates,
+                              fixed_point=False):
+    """
+    classify_and_convert for a whole list of transactions, the amounts are
+    converted with one batch lookup (CurrencyRateList.convert)
+
+    Returns
+    -------
+    directions, amounts : np.ndarray, np.ndarray
+        int8 direction and float64 amount in config.BASE_CURRENCY of every
+        transaction (int64 minor units with fixed_point), amounts of
+        internal ones are 0
+    """
+    count = len(transactions)
+    directions = np.empty(count, dtype=np.int8)
+    times = np.empty(count, dtype=np.int64)
+    amounts = np.zeros(count, dtype=np.float64)
+    currencies = []
+    for idx, transaction in enumerate(transactions):
+        if transaction.internal:
+            directions[idx] = INTERNAL
+        elif transaction.is_outgoing(bank_code):
+            directions[idx] = OUTGOING
+        elif transaction.is_incoming(bank_code):
+            directions[idx] = INCOMING
+        else:
+            assert 1 == 0, "Every transaction has to be internal "\
+                           "or incoming or outgoing"
+        currencies.append(transaction.currency_code)
+        times[idx] = transaction.epoch_us
+        amounts[idx] = transaction.transaction_amount_nocurrency
+    external = np.flatnonzero(directions != INTERNAL)
+    converted = np.zeros(count, dtype=np.int64 if fixed_point
+                         else np.float64)
+    if len(external) and fixed_point:
+        values, codes = encode_currencies([currencies[idx]
+                                           for idx in external])
+        exponents = fixedpoint.exponents_of(values, codes)
+        converted[external] = fixedpoint.convert(
+            currency_rates, (values, codes), times[external],
+            fixedpoint.to_minor(amounts[external], exponents), exponents)
+    elif len(external):
+        converted[external] = currency_rates.convert(
+            [currencies[idx] for idx in external], times[external],
+            amounts[external])
+    return directions, converted
+
+
+def sequential_sum(values, start=0):
+    """
+    Sums left to right onto start, exactly like a python loop would.
+    np.sum uses pairwise summation which changes the last bits, while cumsum
+    keeps the order, so totals match the one transaction at a time ones.
+    """
+    if len(values) == 0:
+        return start
+    return float(np.cumsum(np.concatenate(([start], values)))[-1])
+
+
+def encode_keys(keys):
+    """
+    Dictionary encodes a sequence of hashable keys
+
+    Returns
+    -------
+    values, codes : list, np.ndarray
+        Distinct keys, in order of first appearance, and the int index in
+        values of every key
+    """
+    distinct = {}
+    codes = np.fromiter((distinct.setdefault(key, len(distinct))
+                         for key in keys), dtype=np.intp, count=len(keys))
+    return list(distinct), codes
+
+
+def derive_keys(keys, key_of):
+    """
+    (values, codes) of key_of(key) for dictionary encoded keys, key_of
+    being called once per distinct key (eg. the weekday of dates)
+    """
+    values, codes = keys
+    derived_values, derived_codes = encode_keys([key_of(value)
+                                                 for value in values])
+    return derived_values, derived_codes[codes]
+
+
+def aggregate_balances(directions, amounts, dimensions, exponent=None):
+    """
+    Per key sums and counts of transactions, along several dimensions, in
+    one vectorized pass per dimension and no per group copy.
+
+    Float amounts are summed in the order of the transactions, so every
+    bucket gets the same total as summing its transactions one by one
+    (np.bincount adds its weights in order).
+
+    Parameters
+    ----------
+    directions, amounts : np.ndarray, np.ndarray
+        Direction and converted amount of every transaction, see
+        classify_and_convert_many. int64 minor units with an exponent.
+    dimensions : dict,
+        {dimension: (values, codes)}, the key of every transaction along
+        every dimension, dictionary encoded
+    exponent : int,
+        See BalanceAccumulator
+
+    Returns
+    -------
+    balances : dict,
+        {dimension: {key: BalanceAccumulator}}, only keys with transactions
+    """
+    masks = ((INCOMING, directions == INCOMING),
+             (OUTGOING, directions == OUTGOING),
+             (INTERNAL, directions == INTERNAL))
+    balances = {}
+    for dimension, (values, codes) in dimensions.items():
+        count = len(values)
+        counts, sums = {}, {}
+        for direction, mask in masks:
+            counts[direction] = np.bincount(codes[mask], minlength=count)
+            if direction == INTERNAL:
+                continue
+            if exponent is None:
+                sums[direction] = np.bincount(codes[mask], amounts[mask],
+                                              minlength=count).tolist()
+            else:
+                sums[direction] = fixedpoint.exact_group_sums(
+                    codes[mask], amounts[mask], count)
+        present = np.flatnonzero(counts[INCOMING] + counts[OUTGOING] +
+                                 counts[INTERNAL])
+        buckets = balances[dimension] = {}
+        for code in present.tolist():
+            accumulator = buckets[values[code]] = BalanceAccumulator(exponent)
+            accumulator.incoming_count = int(counts[INCOMING][code])
+            accumulator.outgoing_count = int(counts[OUTGOING][code])
+            accumulator.internal_count = int(counts[INTERNAL][code])
+            # Buckets without any stay at an int 0, like sequential_sum
+            if accumulator.incoming_count:
+                accumulator.incoming_amount = sums[INCOMING][code]
+            if accumulator.outgoing_count:
+                accumulator.outgoing_amount = sums[OUTGOING][code]
+    return balances
+
+
+class BalanceAccumulator(object):
+    """
+    Incoming/outgoing amounts and counts of one bucket of transactions.
+    With an exponent, the amounts are int minor units (see
+    bankmanager.fixedpoint), summed exactly, and only turned into floats by
+    balance and calculate_balance.
+    """
+    _FIELDS = ("incoming_amount", "incoming_count", "outgoing_amount",
+               "outgoing_count", "internal_count")
+    __slots__ = _FIELDS + ("exponent",)
+
+    def __init__(self, exponent=None):
+        """
+        Parameters
+        ----------
+        exponent : int,
+            Number of decimals of the minor units the amounts are in, None
+            for float amounts
+        """
+        self.incoming_amount = 0
+        self.incoming_count = 0
+        self.outgoing_amount = 0
+        self.outgoing_count = 0
+        self.internal_count = 0
+        self.exponent = exponent
+
+    def add(self, direction, amount):
+        if direction == INTERNAL:
+            self.internal_count += 1
+        elif direction == OUTGOING:
+            self.outgoing_amount += amount
+            self.outgoing_count += 1
+        else:
+            self.incoming_amount += amount
+            self.incoming_count += 1
+
+    def add_many(self, directions, amounts):
+        """
+        add for whole arrays of directions and amounts, in order
+        """
+        incoming = directions == INCOMING
+        outgoing = directions == OUTGOING
+        if self.exponent is not None:
+            self.incoming_amount += fixedpoint.exact_sum(amounts, incoming)
+            self.outgoing_amount += fixedpoint.exact_sum(amounts, outgoing)
+        else:
+            self.incoming_amount = sequential_sum(amounts[incoming],
+                                                  self.incoming_amount)
+            self.outgoing_amount = sequential_sum(amounts[outgoing],
+                                                  self.outgoing_amount)
+        self.incoming_count += int(incoming.sum())
+        self.outgoing_count += int(outgoing.sum())
+        self.internal_count += int((directions == INTERNAL).sum())
+        return self
+
+    def merge(self, other):
+        """
+        Adds the sums and counts of another accumulator to this one
+        """
+        self.incoming_amount += other.incoming_amount
+        self.incoming_count += other.incoming_count
+        self.outgoing_amount += other.outgoing_amount
+        self.outgoing_count += other.outgoing_count
+        self.internal_count += other.internal_count
+        return self
+
+    def to_list(self):
+        return [getattr(self, field) for field in self._FIELDS]
+
+    @classmethod
+    def from_list(cls, values):
+        accumulator = cls()
+        for field, value in zip(cls._FIELDS, values):
+            setattr(accumulator, field, value)
+        return accumulator
+
+    def _major(self, amount):
+        if self.exponent is None:
+            return amount
+        return fixedpoint.to_major(amount, self.exponent)
+
+    @property
+    def balance(self):
+        return self._major(self.incoming_amount - self.outgoing_amount)
+
+    @property
+    def count(self):
+        return self.incoming_count + self.outgoing_count + \
+               self.internal_count
+
+    def calculate_balance(self):
+        """
+        Same return value as TransactionList.calculate_balance, so
+        accumulators can be handed to the report writers directly
+        """
+        return (self._major(self.incoming_amount), self.incoming_count), \
+               (self._major(self.outgoing_amount), self.outgoing_count), \
+               self.internal_count
+
+
+def _time_in(start, end):
+    """
+    A time of the rate interval [start, end) (see
+    CurrencyRateList.rate_interval), to look its rate up at
+    """
+    if start is not None:
+        return start
+    return 0 if end is None else end - 1
+
+
+class BankAggregate(object):
+    """
+    Per date and per category accumulators of one bank, filled one
+    transaction at a time.
+
+    With keep_raw, the amounts before conversion are also kept, summed per
+    (date, category, currency, rate interval), so the buckets can be
+    converted again when rates are corrected (see reconvert) without the
+    transactions. The rate is the same over a whole interval (see
+    CurrencyRateList.rate_interval), so there are a few raw sums per rate
+    set, not one per transaction. consume then sets the bucket amounts to
+    the exact sums (math.fsum) of the raw amounts converted, as reconvert
+    does : they do not depend on the order of the amounts, and a bucket
+    converted again with the same rates gets the very same floats.
+    """
+    def __init__(self, bank, currency_rates, keep_raw=False,
+                 fixed_point=False):
+        """
+        Parameters
+        ----------
+        bank : instance of Bank
+        currency_rates: instance of CurrencyRateList
+        keep_raw : bool,
+            Keep the amounts before conversion, see reconvert
+        fixed_point : bool,
+            Sum int minor units, see bankmanager.fixedpoint. Buckets in
+            fixed point cannot be converted again.
+        """
+        assert not (keep_raw and fixed_point), \
+            "Fixed point buckets cannot be converted again"
+        assert currency_rates is not None, \
+            "Cannot calculate the balances without date-wise currency rates"
+        self._bank = bank
+        self._currency_rates = currency_rates
+        self._by_date = {}
+        self._by_category = {}
+        # {(date, category, currency, start, end): [outgoing, incoming]},
+        # None when not kept
+        self._raw = {} if keep_raw else None
+        # {currency: (start, end)} rate interval of the last transaction in
+        # the currency, see _interval
+        self._intervals = {}
+        self._fixed_point = fixed_point
+        # Exponent of the buckets' minor units, None for floats
+        self._exponent = None
+        if fixed_point:
+            self._exponent = fixedpoint.report_exponent(currency_rates)
+
+    def add(self, transaction):
+        direction, amount = classify_and_convert(transaction,
+                                                 self._bank.code,
+                                                 self._currency_rates,
+                                                 self._fixed_point)
+        for buckets, key in ((self._by_date, transaction.transaction_date),
+                             (self._by_category, transaction.category)):
+            accumulator = buckets.get(key)
+            if accumulator is None:
+                accumulator = buckets[key] = \
+                    BalanceAccumulator(self._exponent)
+            accumulator.add(direction, amount)
+        if self._raw is not None and direction != INTERNAL:
+            key = (transaction.transaction_date, transaction.category,
+                   transaction.currency_code) + \
+                self._interval(transaction.currency_code,
+                               transaction.epoch_us)
+            raw = self._raw.get(key)
+            if raw is None:
+                raw = self._raw[key] = [0, 0]
+            raw[direction == INCOMING] += \
+                transaction.transaction_amount_nocurrency
+
+    def _interval(self, currency, time):
+        # Transactions come in runs of close times, the last interval of
+        # the currency mostly holds the next one too
+        interval = self._intervals.get(currency)
+        if interval is None or \
+                (interval[0] is not None and time < interval[0]) or \
+                (interval[1] is not None and time >= interval[1]):
+            rate_interval = getattr(self._currency_rates, "rate_interval",
+                                    None)
+            if rate_interval is None:
+                # Rates without intervals (eg. DailyRates), one per time
+                interval = (time, time + 1)
+            else:
+                interval = rate_interval(currency, time)
+            self._intervals[currency] = interval
+        return interval
+
+    def consume(self, transactions):
+        for transaction in transactions:
+            self.add(transaction)
+        if self._raw is not None:
+            self._sum_raw(set(self._by_date), set(self._by_category))
+        return self
+
+    def merge(self, other):
+        """
+        Adds the buckets of another aggregate (eg. of another log file of
+        the same bank) to this one
+        """
+        for buckets, other_buckets in ((self._by_date, other.by_date),
+                                       (self._by_category,
+                                        other.by_category)):
+            for key, other_accumulator in other_buckets.items():
+                accumulator = buckets.get(key)
+                if accumulator is None:
+                    accumulator = buckets[key] = \
+                        BalanceAccumulator(other_accumulator.exponent)
+                accumulator.merge(other_accumulator)
+        return self
+
+    @property
+    def has_raw(self):
+        return self._raw is not None
+
+    def _hits(self, changes):
+        """
+        Returns
+        -------
+        hits, split : list, bool
+            Raw keys whose rate interval has a rate that changed, and
+            whether a change starts or ends inside one of those intervals
+        """
+        by_currency = {}
+        for key in self._raw:
+            if key[2] in changes:
+                by_currency.setdefault(key[2], []).append(key)
+        hits, split = [], False
+        for currency, keys in by_currency.items():
+            starts, ends = changes[currency]
+            first = np.array([np.iinfo(np.int64).min if key[3] is None
+                              else key[3] for key in keys], dtype=np.int64)
+            last = np.array([np.iinfo(np.int64).max if key[4] is None
+                             else key[4] for key in keys], dtype=np.int64)
+            # First changed range ending after the interval starts
+            ranges = np.searchsorted(ends, first, side="right")
+            found = ranges < len(ends)
+            ranges = np.minimum(ranges, len(ends) - 1)
+            hit = found & (starts[ranges] < last)
+            split = split or bool((hit & ((starts[ranges] > first) |
+                                          (ends[ranges] < last))).any())
+            hits.extend(keys[idx] for idx in np.flatnonzero(hit))
+        return hits, split
+
+    def can_reconvert(self, changes):
+        """
+        Whether reconvert can take the rate changes : the raw amounts are
+        kept, and no change starts or ends inside the rate interval of a
+        raw sum (eg. a rate added between two others), as the amounts of
+        the interval would need different rates
+
+        Parameters
+        ----------
+        changes : dict,
+            See reconvert
+        """
+        return self._raw is not None and not self._hits(changes)[1]
+
+    def reconvert(self, changes, currency_rates):
+        """
+        Converts again, from the raw amounts, the buckets with transactions
+        in a currency and time range whose rate changed.
+
+        Parameters
+        ----------
+        changes : dict,
+            {currency: (starts, ends)} time ranges whose rate changed, see
+            currencyrates.rate_changes. Has to pass can_reconvert.
+        currency_rates : instance of CurrencyRateList,
+            The corrected rates
+
+        Returns
+        -------
+        dates, categories : set, set
+            Keys of the buckets whose converted amounts changed
+        """
+        assert self._raw is not None, \
+            "Cannot convert again without the raw amounts"
+        hits, split = self._hits(changes)
+        assert not split, \
+            "Cannot convert again raw sums of rates changed in part"
+        self._currency_rates = currency_rates
+        self._intervals = {}
+        return self._sum_raw({key[0] for key in hits},
+                             {key[1] for key in hits})
+
+    def _sum_raw(self, dates, categories):
+        """
+        Sets the amounts of the given date and category buckets to the
+        exact sums of their raw amounts converted
+
+        Returns
+        -------
+        dates, categories : set, set
+            Keys of the buckets whose amounts changed
+        """
+        sums = ({key: ([], []) for key in dates},
+                {key: ([], []) for key in categories})
+        for key, (outgoing, incoming) in self._raw.items():
+            date_sums = sums[0].get(key[0])
+            category_sums = sums[1].get(key[1])
+            if date_sums is None and category_sums is None:
+                continue
+            rate = self._currency_rates.rate_at(key[2], _time_in(*key[3:]))
+            if rate is None:
+                rate = 1
+            for bucket in (date_sums, category_sums):
+                if bucket is not None:
+                    bucket[0].append(outgoing * rate)
+                    bucket[1].append(incoming * rate)
+
+        changed = set(), set()
+        for buckets, bucket_sums, changed_keys in (
+                (self._by_date, sums[0], changed[0]),
+                (self._by_category, sums[1], changed[1])):
+            for key, (outgoing, incoming) in bucket_sums.items():
+                accumulator = buckets[key]
+                # Buckets without any stay at an int 0, like sequential_sum
+                amounts = (
+                    math.fsum(outgoing) if accumulator.outgoing_count else 0,
+                    math.fsum(incoming) if accumulator.incoming_count else 0)
+                if (accumulator.outgoing_amount,
+                        accumulator.incoming_amount) != amounts:
+                    accumulator.outgoing_amount, \
+                        accumulator.incoming_amount = amounts
+                    changed_keys.add(key)
+        return changed
+
+    def to_dict(self):
+        """
+        JSON friendly dump of the buckets, and the raw amounts if kept,
+        see from_dict
+        """
+        buckets = {
+            "dates": {key: accumulator.to_list()
+                      for key, accumulator in self._by_date.items()},
+            "categories": {key: accumulator.to_list()
+                           for key, accumulator in self._by_category.items()}
+        }
+        if self._raw is not None:
+            buckets["raw"] = [list(key) + amounts
+                              for key, amounts in self._raw.items()]
+        return buckets
+
+    @classmethod
+    def from_dict(cls, bank, currency_rates, buckets):
+        aggregate = cls(bank, currency_rates, "raw" in buckets)
+        aggregate._by_date = {key: BalanceAccumulator.from_list(values)
+                              for key, values in buckets["dates"].items()}
+        aggregate._by_category = {
+            key: BalanceAccumulator.from_list(values)
+            for key, values in buckets["categories"].items()}
+        if "raw" in buckets:
+            aggregate._raw = {tuple(entry[:5]): entry[5:]
+                              for entry in buckets["raw"]}
+        return aggregate
+
+    @property
+    def bank(self):
+        return self._bank
+
+    @property
+    def by_date(self):
+        return self._by_date
+
+    @property
+    def by_category(self):
+        return self._by_category
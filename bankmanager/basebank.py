@@ -6,23 +6,50 @@ from bankmanager import config
 logger = logging.getLogger(__name__) # Make a logger for this class
 
 
+_BANK_ID_RULE = re.compile(config.BANK_ID_RULE)
+_ACCOUNT_RULE = re.compile("^[0-9A-F]{32}$")
+_BANKLESS_ACCOUNT_RULE = re.compile("^[0-9A-F]{28}$")
+
+
 class BankCode(object):
-    def __init__(self, bankid):
-        assert len(bankid) == 4 # Early reject
-        assert len(re.findall(config.BANK_ID_RULE, bankid)) == 1  #Some regex to assert the right format
-        self._bankid = bankid
+    """
+    Interned : there is only ever one BankCode instance per bank id in the
+    process, so they can be compared with `is`.
+    """
+    # Stored as a 16 bit int, the string is only rendered when asked for
+    __slots__ = ("_code",)
+    _interned = {}
+
+    def __new__(cls, bankid):
+        bank_code = cls._interned.get(bankid)
+        if bank_code is None:
+            # Early reject on the length, then some regex for the format
+            if len(bankid) != 4 or _BANK_ID_RULE.search(bankid) is None:
+                raise BankException("Not a bank code : " + str(bankid))
+            bank_code = object.__new__(cls)
+            bank_code._code = int(bankid, 16)
+            cls._interned[bankid] = bank_code
+        return bank_code
+
+    def __reduce__(self):
+        # Unpickling goes through the registry again
+        return BankCode, (self.bankid,)
 
     @property
     def bankid(self):
-        return self._bankid
+        return "%04X" % self._code
 
     @bankid.setter
     def bankid(self, value):
         logger.debug("Cannot change bankid")
         pass
 
+    @property
+    def code(self):
+        return self._code
+
     def __str__(self):
-        return self._bankid
+        return self.bankid
 
 
 class BankZone(object):
@@ -51,44 +78,80 @@ class BankZone(object):
         self._timezone = BankZone(timezone=value)
 
 
+def render_hex_id(value):
+    """
+    128 bit int to the 8-4-4-4-12 string layout used for ids
+    """
+    digits = "%032X" % value
+    return digits[0:8] + "-" + digits[8:12] + "-" + digits[12:16] + "-" + \
+        digits[16:20] + "-" + digits[20:]
+
+
 class BankAccountID(object):
-    def __init__(self, accountid, bankid=None):
-        self._accountid = None
+    # The whole id (bank code included) is kept as one 128 bit int
+    __slots__ = ("_id", "_bankid")
 
+    def __init__(self, accountid, bankid=None):
         # Screw the dashes first
         accountid = "".join(accountid.split("-"))
 
         if bankid is None:
-            assert len(re.findall("^[0-9A-F]{32}$", accountid)) == 1
+            if _ACCOUNT_RULE.match(accountid) is None:
+                raise BankException("Not an account id : " + accountid)
             self._bankid = BankCode(accountid[0:4])
-            self._accountid = accountid[5:]
+            self._id = int(accountid, 16)
         else:
-            assert len(re.findall("^[0-9A-F]{28}$", accountid)) == 1
-            assert(issubclass(type(accountid), BankCode)), \
-                "This parameter has to be an instance of Bankid or None"
+            if _BANKLESS_ACCOUNT_RULE.match(accountid) is None:
+                raise BankException("Not an account id : " + accountid)
+            if not issubclass(type(bankid), BankCode):
+                raise BankException("This parameter has to be an instance "
+                                    "of Bankid or None")
             self._bankid = bankid
-            self._accountid = accountid
+            self._id = (bankid.code << 112) | int(accountid, 16)
+
+    @classmethod
+    def from_valid(cls, accountid):
+        """
+        BankAccountID of an id validation passed already (see
+        bankmanager.validation), without checking it again
+        """
+        accountid = accountid.replace("-", "")
+        account = object.__new__(cls)
+        account._bankid = BankCode(accountid[0:4])
+        account._id = int(accountid, 16)
+        return account
 
     @property
     def id(self):
-        return self._bankid + self._accountid
+        return "%032X" % self._id
 
     @id.setter
     def id(self, value):
         logger.debug("Cannot reset id")
 
+    @property
+    def number(self):
+        """
+        The id as a 128 bit int
+        """
+        return self._id
+
     @property
     def bankid(self):
         return self._bankid
-    
+
     @property
     def accountid(self):
-        return self._accountid
+        return "%028X" % (self._id & ((1 << 112) - 1))
+
+    def __eq__(self, other):
+        return isinstance(other, BankAccountID) and self._id == other._id
+
+    def __hash__(self):
+        return hash(self._id)
 
     def __str__(self):
-        return self._bankid.bankid + self._accountid[0:4] + "-" + \
-               self._accountid[4:8] + "-" + self._accountid[8:12] + "-" + \
-               self._accountid[12:16] + "-" + self._accountid[16:]
+        return render_hex_id(self._id)
 
 
 # Creating a custom Exception so we don't mix it with primitive exceptions
@@ -0,0 +1,483 @@
+"""
+Columnar counterpart of TransactionList.
+
+Instead of building a Transaction object per CSV row, the columns of a log
+are stored in NumPy buffers :-
+- timestamps as UTC microseconds since the epoch, plus the utc offset
+- amounts as float64, or int64 minor units with fixed_point (see
+  bankmanager.fixedpoint)
+- currencies and categories dictionary encoded (int32 codes)
+- source and destination account ids as 128 bit integers (two uint64)
+
+Balances and categorizations are then vectorized operations on those buffers.
+"""
+import logging
+import numpy as np
+from bankmanager.basebank import BankException
+from bankmanager.validation import decode_account_ids
+from bankmanager.aggregation import sequential_sum, aggregate_balances, \
+    INTERNAL, OUTGOING, INCOMING, DATE, CATEGORY, CURRENCY, WEEKDAY
+from bankmanager import fixedpoint
+from bankmanager.timeindex import TimeIndex
+from bankmanager.timestamps import parse_timestamp, epoch_us, \
+    utc_offset_seconds, day_of, render_day
+from bankmanager import registry
+
+logger = logging.getLogger(__name__)
+
+
+def _decode_account_ids(account_ids):
+    decoded, valid = decode_account_ids(account_ids)
+    if not valid.all():
+        raise BankException("Malformed account id : " +
+                            account_ids[np.flatnonzero(~valid)[0]])
+    return decoded
+
+
+def _parse_time(date):
+    """
+    Returns (utc microseconds since epoch, utc offset in seconds) of an
+    ISO-8601 string
+    """
+    timestamp = parse_timestamp(date)
+    return epoch_us(timestamp), utc_offset_seconds(timestamp)
+
+
+class _Dictionary(object):
+    """
+    Maps values to small integer codes, validating every distinct value once
+    """
+    def __init__(self, validate):
+        self._codes = {}
+        self._values = []
+        self._validate = validate
+
+    def encode(self, values):
+        codes = self._codes
+        encoded = np.empty(len(values), dtype=np.int32)
+        for idx, value in enumerate(values):
+            code = codes.get(value)
+            if code is None:
+                self._validate(value)
+                code = codes[value] = len(self._values)
+                self._values.append(value)
+            encoded[idx] = code
+        return encoded
+
+    @property
+    def values(self):
+        return self._values
+
+
+class ColumnarTransactionList(object):
+    """
+    Array backed list of transactions, bank specific.
+    Has the same reporting API as TransactionList (calculate_balance,
+    balance, categorize, categorize_by_date), meant for bulk ingest.
+    """
+    def __init__(self, bank, currency_rates=None, fixed_point=False):
+        """
+        Starts from an empty transaction list per bank
+        Parameters
+        ----------
+        bank : instance of Bank
+            Each transaction list is unique to a bank.
+
+        currency_rates: instance of CurrencyRateList
+            Required to calculate the balance in a unified currency
+
+        fixed_point : bool,
+            Store the amounts as int64 minor units of their currency, and
+            convert and sum them as integers
+        """
+        self._bank = bank
+        self._bank_code = np.uint64(bank.code.code)
+        self._currency_rates = currency_rates
+        self._fixed_point = fixed_point
+        self._amount = None
+        # {currency_rates: amounts in base currency}, see _conversions
+        self._converted = {}
+        # (internal, outgoing, incoming) masks, see _directions
+        self._direction_masks = None
+        # {dimension: (values, codes)}, see _dimension_keys
+        self._keys = {}
+        # {currency_rates: (version, TimeIndex)}, see time_index
+        self._time_indexes = {}
+        self._size = 0
+        self._times = np.empty(0, dtype=np.int64)
+        self._offsets = np.empty(0, dtype=np.int32)
+        self._amounts = np.empty(0, dtype=np.int64 if fixed_point
+                                 else np.float64)
+        self._currency_codes = np.empty(0, dtype=np.int32)
+        self._category_codes = np.empty(0, dtype=np.int32)
+        self._sources = np.empty((0, 2), dtype=np.uint64)
+        self._destinations = np.empty((0, 2), dtype=np.uint64)
+        self._currency_dict = _Dictionary(registry.currency)
+        self._category_dict = _Dictionary(registry.category)
+
+    _COLUMNS = ("_times", "_offsets", "_amounts", "_currency_codes",
+                "_category_codes", "_sources", "_destinations")
+
+    def _reserve(self, extra):
+        needed = self._size + extra
+        capacity = len(self._amounts)
+        if needed <= capacity:
+            return
+        capacity = max(needed, 2 * capacity, 1024)
+        for column in self._COLUMNS:
+            old = getattr(self, column)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, column, new)
+
+    def add_transactions(self, dates, sources, destinations, amounts,
+                         currencies, categories):
+        """
+        Appends a batch of transactions, given column wise.
+        Every parameter is a sequence with one entry per transaction, with
+        the same meaning as in Transaction.__init__(...)
+        """
+        count = len(dates)
+        amounts = np.asarray(amounts, dtype=np.float64)
+        if not (amounts >= 0).all():
+            raise BankException("Cannot transfer negative amounts. "
+                                "Stop gaming the system!")
+        sources = _decode_account_ids(sources)
+        destinations = _decode_account_ids(destinations)
+        currency_codes = self._currency_dict.encode(currencies)
+        category_codes = self._category_dict.encode(categories)
+
+        # Logs repeat timestamps a lot, so parse every distinct one once
+        distinct = {}
+        time_codes = np.fromiter(
+            (distinct.setdefault(date, len(distinct)) for date in dates),
+            dtype=np.int64, count=count)
+        parsed = [_parse_time(date) for date in distinct]
+        times = np.array([p[0] for p in parsed], dtype=np.int64)
+        offsets = np.array([p[1] for p in parsed], dtype=np.int32)
+
+        self._reserve(count)
+        rows = slice(self._size, self._size + count)
+        self._times[rows] = times[time_codes]
+        self._offsets[rows] = offsets[time_codes]
+        self._amounts[rows] = self._stored_amounts(
+            amounts, self._currency_dict.values, currency_codes)
+        self._currency_codes[rows] = currency_codes
+        self._category_codes[rows] = category_codes
+        self._sources[rows] = sources
+        self._destinations[rows] = destinations
+        self._size += count
+        self._amount = None
+        self._converted = {}
+        self._direction_masks = None
+        self._keys = {}
+        self._time_indexes = {}
+
+    def add_batch(self, batch):
+        """
+        Appends a LogBatch (see bankmanager.logreader), whose columns are
+        already typed and validated
+        """
+        count = len(batch)
+        currency_values, currency_codes = batch.currencies
+        category_values, category_codes = batch.categories
+        self._reserve(count)
+        rows = slice(self._size, self._size + count)
+        self._times[rows] = batch.times
+        self._offsets[rows] = batch.offsets
+        self._amounts[rows] = self._stored_amounts(batch.amounts,
+                                                   currency_values,
+                                                   currency_codes)
+        # Batch codes index the batch's distinct values, map them to ours
+        self._currency_codes[rows] = self._currency_dict.encode(
+            currency_values)[currency_codes]
+        self._category_codes[rows] = self._category_dict.encode(
+            category_values)[category_codes]
+        self._sources[rows] = batch.sources
+        self._destinations[rows] = batch.destinations
+        self._size += count
+        self._amount = None
+        self._converted = {}
+        self._direction_masks = None
+        self._keys = {}
+        self._time_indexes = {}
+
+    def add_transaction(self, date, source, destination, transaction_id,
+                        amount=0, currency="USD", category=None):
+        """
+        Single row version of add_transactions, same signature as
+        TransactionList.add_transaction. transaction_id is not stored.
+        """
+        if category is None:
+            category = ""
+        self.add_transactions([date], [source], [destination], [amount],
+                              [currency], [category])
+
+    def _stored_amounts(self, amounts, currency_values, currency_codes):
+        """
+        amounts as stored, minor units of their currency with fixed_point
+        """
+        if not self._fixed_point:
+            return amounts
+        return fixedpoint.to_minor(
+            amounts, fixedpoint.exponents_of(currency_values, currency_codes))
+
+    def _subset(self, rows):
+        subset = self.__class__(self._bank, self._currency_rates,
+                                self._fixed_point)
+        subset._currency_dict = self._currency_dict
+        subset._category_dict = self._category_dict
+        for column in self._COLUMNS:
+            setattr(subset, column, getattr(self, column)[:self._size][rows])
+        subset._size = len(rows)
+        if self._currency_rates is not None:
+            self._conversions(self._currency_rates)
+        # The subset gets its share of every conversion done so far
+        subset._converted = {currency_rates: converted[rows]
+                             for currency_rates, converted in
+                             self._converted.items()}
+        return subset
+
+    def _column(self, name):
+        return getattr(self, name)[:self._size]
+
+    @property
+    def days(self):
+        """
+        Local date of every transaction, as days since 1970-01-01
+        """
+        return day_of(self._column("_times"),
+                      self._column("_offsets").astype(np.int64))
+
+    def _conversions(self, currency_rates):
+        """
+        Amount in base currency of every transaction, internal ones being 0.
+        Converted in one batch (CurrencyRateList.convert) and kept, per
+        currency_rates, until the list changes.
+        """
+        converted = self._converted.get(currency_rates)
+        if converted is not None:
+            return converted
+        external = np.flatnonzero(~self._internal())
+        currencies = (self._currency_dict.values,
+                      self._column("_currency_codes")[external])
+        converted = np.zeros(self._size, dtype=self._amounts.dtype)
+        if self._fixed_point:
+            converted[external] = fixedpoint.convert(
+                currency_rates, currencies, self._column("_times")[external],
+                self._column("_amounts")[external],
+                fixedpoint.exponents_of(*currencies))
+        else:
+            converted[external] = currency_rates.convert(
+                currencies, self._column("_times")[external],
+                self._column("_amounts")[external])
+        self._converted[currency_rates] = converted
+        return converted
+
+    def _directions(self):
+        """
+        Masks of the internal, outgoing and incoming transactions, kept
+        until the list changes (balances in several currencies reuse them)
+        """
+        if self._direction_masks is None:
+            shift = np.uint64(48)
+            source_banks = self._column("_sources")[:, 0] >> shift
+            destination_banks = self._column("_destinations")[:, 0] >> shift
+            internal = source_banks == destination_banks
+            outgoing = ~internal & (source_banks == self._bank_code)
+            incoming = ~internal & (destination_banks == self._bank_code)
+            assert (internal | outgoing | incoming).all(), \
+                "Every transaction has to be internal or incoming or outgoing"
+            self._direction_masks = (internal, outgoing, incoming)
+        return self._direction_masks
+
+    def _internal(self):
+        shift = np.uint64(48)
+        return (self._column("_sources")[:, 0] >> shift) == \
+            (self._column("_destinations")[:, 0] >> shift)
+
+    def currencies(self):
+        counts = np.bincount(self._column("_currency_codes"),
+                             minlength=len(self._currency_dict.values))
+        return {currency: int(count) for currency, count in
+                zip(self._currency_dict.values, counts) if count}
+
+    def calculate_balance(self, currency_rates=None):
+        """
+        Calculates balance in the base currency
+        """
+        if currency_rates is None:
+            currency_rates = self._currency_rates
+        assert currency_rates is not None, \
+            "Cannot calculate the balances without date-wise currency rates"
+        internal, outgoing, incoming = self._directions()
+        converted = self._conversions(currency_rates)
+        if self._fixed_point:
+            # Exact integer sums, whatever the order
+            exponent = fixedpoint.report_exponent(currency_rates)
+            incoming_minor = fixedpoint.exact_sum(converted, incoming)
+            outgoing_minor = fixedpoint.exact_sum(converted, outgoing)
+            incoming_amount = fixedpoint.to_major(incoming_minor, exponent)
+            outgoing_amount = fixedpoint.to_major(outgoing_minor, exponent)
+            self._amount = fixedpoint.to_major(
+                incoming_minor - outgoing_minor, exponent)
+        else:
+            incoming_amount = sequential_sum(converted[incoming])
+            outgoing_amount = sequential_sum(converted[outgoing])
+            self._amount = incoming_amount - outgoing_amount
+        incoming_count = int(incoming.sum())
+        outgoing_count = int(outgoing.sum())
+        internal_count = int(internal.sum())
+        return (incoming_amount, incoming_count), \
+               (outgoing_amount, outgoing_count), \
+               internal_count
+
+    def _group_by(self, codes, name_of):
+        """
+        Splits the list into one sub list per distinct code, keeping the
+        original order of transactions inside every group
+        """
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        starts = np.flatnonzero(np.diff(sorted_codes)) + 1
+        groups = {}
+        for rows in np.split(order, starts):
+            if len(rows):
+                groups[name_of(codes[rows[0]])] = self._subset(rows)
+        return groups
+
+    def _dimension_keys(self, dimension):
+        """
+        (values, codes) of the key of every transaction along dimension,
+        kept until the list changes
+        """
+        keys = self._keys.get(dimension)
+        if keys is not None:
+            return keys
+        if dimension == DATE:
+            days, codes = np.unique(self.days, return_inverse=True)
+            keys = [render_day(day) for day in days], codes
+        elif dimension == CATEGORY:
+            keys = self._category_dict.values, \
+                self._column("_category_codes")
+        elif dimension == CURRENCY:
+            keys = self._currency_dict.values, \
+                self._column("_currency_codes")
+        elif dimension == WEEKDAY:
+            # 1970-01-01 was a Thursday
+            keys = list(range(7)), (self.days + 3) % 7
+        else:
+            raise ValueError("Unknown dimension : " + str(dimension))
+        self._keys[dimension] = keys
+        return keys
+
+    def balances(self, currency_rates=None, dimensions=(DATE, CATEGORY)):
+        """
+        Same as TransactionList.balances, vectorized over the columns
+        """
+        if currency_rates is None:
+            currency_rates = self._currency_rates
+        assert currency_rates is not None, \
+            "Cannot calculate the balances without date-wise currency rates"
+        exponent = None
+        if self._fixed_point:
+            exponent = fixedpoint.report_exponent(currency_rates)
+        return aggregate_balances(
+            self._direction_codes(), self._conversions(currency_rates),
+            {dimension: self._dimension_keys(dimension)
+             for dimension in dimensions}, exponent)
+
+    def _direction_codes(self):
+        """
+        INTERNAL, OUTGOING or INCOMING of every row, as int8
+        """
+        internal, outgoing, incoming = self._directions()
+        directions = np.full(self._size, INTERNAL, dtype=np.int8)
+        directions[outgoing] = OUTGOING
+        directions[incoming] = INCOMING
+        return directions
+
+    def time_index(self, currency_rates=None):
+        """
+        Same as TransactionList.time_index
+        """
+        if currency_rates is None:
+            currency_rates = self._currency_rates
+        assert currency_rates is not None, \
+            "Cannot calculate the balances without date-wise currency rates"
+        version = getattr(currency_rates, "version", None)
+        cached = self._time_indexes.get(currency_rates)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        if cached is not None:
+            self._converted.pop(currency_rates, None)
+        exponent = None
+        if self._fixed_point:
+            exponent = fixedpoint.report_exponent(currency_rates)
+        time_index = TimeIndex(self._column("_times"), self._direction_codes(),
+                               self._conversions(currency_rates), exponent)
+        self._time_indexes[currency_rates] = (version, time_index)
+        return time_index
+
+    def balance_between(self, t0, t1, currency_rates=None):
+        """
+        Same as TransactionList.balance_between
+        """
+        return self.time_index(currency_rates).between(t0, t1).balance
+
+    def convert_with(self, currency_rates):
+        """
+        Converts every transaction with currency_rates (eg. CrossRates of
+        another report currency) now, in one batch. Lists split from this
+        one afterwards (categorize, categorize_by_date) get their share of
+        the conversion.
+        """
+        self._conversions(currency_rates)
+
+    @property
+    def currency_rates(self):
+        return self._currency_rates
+
+    @currency_rates.setter
+    def currency_rates(self, currency_rates):
+        # Rates can come after the transactions, eg. once the currencies in
+        # use are known
+        self._currency_rates = currency_rates
+
+    @property
+    def fixed_point(self):
+        return self._fixed_point
+
+    @property
+    def categories(self):
+        names = self._category_dict.values
+        return {names[code] for code in
+                np.unique(self._column("_category_codes"))}
+
+    @property
+    def balance(self):
+        if self._amount is None:
+            self.calculate_balance()
+        return self._amount
+
+    @property
+    def bank(self):
+        return self._bank
+
+    @property
+    def dates(self):
+        return {render_day(day) for day in np.unique(self.days)}
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def categorize(cls, transaction_list):
+        names = transaction_list._category_dict.values
+        return transaction_list._group_by(
+            transaction_list._column("_category_codes"),
+            lambda code: names[code])
+
+    @classmethod
+    def categorize_by_date(cls, transaction_list):
+        return transaction_list._group_by(transaction_list.days, render_day)
@@ -1,5 +1,26 @@
 from bankmanager.config import BASE_CURRENCY
+from bankmanager.timestamps import parse_timestamp, epoch_us, US_PER_SECOND, \
+    US_PER_DAY, render_timestamp, shared_zone
+from bankmanager.ratestore import open_rate_store
+from bisect import bisect_right
+from collections import OrderedDict
+import datetime
 import json
+import logging
+import re
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# "date": {"CUR": rate, ...} entries of a currency rates file, as written by
+# CurrencyRateList.dump
+_DATE_ENTRY = re.compile(r'"([^"\\]*)"\s*:\s*\{([^{}]*)\}')
+_ENTRY_SEPARATOR = re.compile(r"[\s,]*")
+
+# (currency, time bucket) entries remembered by CurrencyRateList.rate_at
+DEFAULT_MEMO_SIZE = 4096
+# Characters of a rates file read_rates scans at a time
+RATES_CHUNK_SIZE = 1 << 20
 
 
 class CurrencyRate(object):
@@ -36,28 +57,186 @@ class CurrencyRate(object):
         return amount * self.rate
 
 
+class RateTimeline(object):
+    """
+    Rates of one currency, sorted by time (utc microseconds since epoch).
+    Rates are appended in any order and sorted on the first lookup after.
+    When two rates have the same time, the first one added is kept.
+    A timeline can also start from sorted arrays (see from_arrays), which
+    are only copied into lists if rates are added.
+    """
+    __slots__ = ("_times", "_rates", "_sorted", "_arrays")
+
+    def __init__(self):
+        self._times = []
+        self._rates = []
+        self._sorted = True
+        self._arrays = None
+
+    @classmethod
+    def from_arrays(cls, times, rates):
+        """
+        Timeline over sorted, duplicate free arrays, eg. views of a RateStore
+        """
+        timeline = cls()
+        timeline._times = timeline._rates = None
+        timeline._arrays = (times, rates)
+        return timeline
+
+    def add(self, time, rate):
+        if self._times is None:
+            self._times = self._arrays[0].tolist()
+            self._rates = self._arrays[1].tolist()
+        if self._sorted and self._times and time <= self._times[-1]:
+            self._sorted = False
+        self._times.append(time)
+        self._rates.append(rate)
+        self._arrays = None
+
+    def _sort(self):
+        # Stable, so the first rate added comes first among equal times
+        order = sorted(range(len(self._times)), key=self._times.__getitem__)
+        times, rates = [], []
+        for idx in order:
+            if times and times[-1] == self._times[idx]:
+                continue
+            times.append(self._times[idx])
+            rates.append(self._rates[idx])
+        self._times, self._rates = times, rates
+        self._sorted = True
+
+    def rate_at(self, time, max_staleness=None):
+        """
+        Parameters
+        ----------
+        time : int,
+            utc microseconds since epoch
+        max_staleness : int,
+            Microseconds a rate stays valid for, None for ever
+
+        Returns
+        -------
+        rate : float,
+            Rate in effect at time, ie. the last one set at or before it.
+            None if there is none (or it is too old).
+        """
+        if self._times is None:
+            times, rates = self._arrays
+            idx = int(np.searchsorted(times, time, side="right")) - 1
+        else:
+            if not self._sorted:
+                self._sort()
+            times, rates = self._times, self._rates
+            idx = bisect_right(times, time) - 1
+        if idx < 0:
+            return None
+        if max_staleness is not None and \
+                time - times[idx] > max_staleness:
+            return None
+        return float(rates[idx])
+
+    def rates_at(self, times, max_staleness=None):
+        """
+        rate_at for a whole array of times at once
+
+        Returns
+        -------
+        rates : np.ndarray,
+            float64, NaN where there is no rate
+        """
+        rate_times, rates = self.arrays()
+        if len(rate_times) == 0:
+            return np.full(len(times), np.nan)
+        idx = np.searchsorted(rate_times, times, side="right") - 1
+        missing = idx < 0
+        idx[missing] = 0
+        found = rates[idx]
+        if max_staleness is not None:
+            missing |= times - rate_times[idx] > max_staleness
+        found[missing] = np.nan
+        return found
+
+    def arrays(self):
+        """
+        Returns
+        -------
+        times, rates : np.ndarray, np.ndarray
+            int64 times and float64 rates, sorted by time
+        """
+        if not self._sorted:
+            self._sort()
+        if self._arrays is None:
+            self._arrays = (np.array(self._times, dtype=np.int64),
+                            np.array(self._rates, dtype=np.float64))
+        return self._arrays
+
+    def __len__(self):
+        if self._times is None:
+            return len(self._arrays[0])
+        if not self._sorted:
+            self._sort()
+        return len(self._times)
+
+
 class CurrencyRateList(object):
     """
     Hold a list of currencies, in different times of generating.
     This currencyRateList is required because we want(!!) to calculate the
     balance/sum in a particular currency.
+
+    Lookups are as-of : the rate of a currency at some time is the last rate
+    set at or before that time, found with a binary search in the currency's
+    RateTimeline.
+
+    Logs use a few currencies over a few days a lot, so rate_at remembers,
+    per (currency, time bucket), the rates in effect over the bucket (most
+    often a single one). The memo keeps the memo_size most recently used
+    buckets, and forgets the buckets a new rate changes.
     """
-    def __init__(self):
+    def __init__(self, max_staleness=None, memo_size=DEFAULT_MEMO_SIZE,
+                 memo_bucket=US_PER_DAY):
+        """
+        Parameters
+        ----------
+        max_staleness : float,
+            Seconds after which a rate is too old to be used. Lookups with
+            no rate that recent miss. None means rates never expire.
+        memo_size : int,
+            Number of (currency, time bucket) kept by rate_at, 0 for none
+        memo_bucket : int,
+            Microseconds per time bucket of the memo, a utc day by default
+        """
         self._currency_rates_by_date = {}
+        self._timelines = {}
+        # RateStore the timelines not in _timelines come from, see
+        # load_cached
+        self._store = None
+        self._max_staleness = None
+        if max_staleness is not None:
+            self._max_staleness = int(max_staleness * US_PER_SECOND)
+        self._lookups = 0
+        self._misses = 0
+        # {(currency, bucket): (times, rates)}, least recently used first,
+        # see _memo_rate_at
+        self._memo = OrderedDict()
+        self._memo_size = memo_size
+        self._memo_bucket = memo_bucket
+        self._memo_hits = 0
+        self._memo_misses = 0
+        # Bumped by every new rate, see version
+        self._version = 0
 
     def add_date_if_nonexistant(self, date):
         if date not in self._currency_rates_by_date.keys():
-            self._currency_rates_by_date[date] = set([])
-            # Set because We don't want to repeat values
+            self._currency_rates_by_date[date] = {}
+            # {currency: rate}, because We don't want to repeat values
 
     def append_current_rate(self, currency, date, rate):
         self.add_date_if_nonexistant(date)
-        currency_inst = CurrencyRate(currency, rate)
-        if currency_inst in self._currency_rates_by_date[date]:
+        if currency in self._currency_rates_by_date[date]:
+            # First rate wins, as in the RateTimeline
             return False
-        self._currency_rates_by_date[date].add(
-            CurrencyRate(currency, rate)
-        )
+        self._currency_rates_by_date[date][currency] = rate
         return True
 
     def add_currency_at_date(self, currency="USD", rate=1,
@@ -66,33 +245,568 @@ class CurrencyRateList(object):
             rate = 1
             return True
         success = self.append_current_rate(currency, time, rate)
+        timeline = self.timeline(currency)
+        if timeline is None:
+            timeline = self._timelines[currency] = RateTimeline()
+        epoch = _epoch_of(time)
+        timeline.add(epoch, float(rate))
+        self._version += 1
+        if self._memo:
+            # The rate is in effect from its time on
+            bucket = epoch // self._memo_bucket
+            for key in [key for key in self._memo
+                        if key[0] == currency and key[1] >= bucket]:
+                del self._memo[key]
         return success
 
     def dump(self, filename):
-        for date in self._currency_rates_by_date.keys():
-            self._currency_rates_by_date[date] = {
-                curr.currency: curr.rate for curr in
-                self._currency_rates_by_date[date]
-            }
+        """
+        Writes the rates to filename, as {date: {currency: rate}}. The list
+        is left as it is, so dump can be called again (eg. to checkpoint a
+        list still being filled).
+        """
+        rates_by_date = {date: dict(rates) for date, rates in
+                         self._currency_rates_by_date.items()}
+        if self._store is not None:
+            utc = shared_zone(0)
+            for currency in self._store.currencies:
+                times, rates = self._store.arrays(currency)
+                for time, rate in zip(times.tolist(), rates.tolist()):
+                    rates_by_date.setdefault(
+                        render_timestamp(time, utc), {})[currency] = rate
 
-        json.dump(self._currency_rates_by_date, open(filename, "w"))
+        with open(filename, "w") as f:
+            json.dump(rates_by_date, f)
+
+    def timeline(self, currency_name):
+        """
+        RateTimeline of a currency, None if it has no rates
+        """
+        timeline = self._timelines.get(currency_name)
+        if timeline is None and self._store is not None:
+            arrays = self._store.arrays(currency_name)
+            if arrays is not None:
+                timeline = self._timelines[currency_name] = \
+                    RateTimeline.from_arrays(*arrays)
+        return timeline
 
     def currency_rate_at_date(self, currency_name, date):
+        """
+        Parameters
+        ----------
+        currency_name : str,
+            The iso4217 currency code
+        date : str or datetime.datetime,
+            ISO-8601 time of the lookup
+
+        Returns
+        -------
+        rate : float,
+            Rate in effect at that time, None if there is none
+        """
         if currency_name == BASE_CURRENCY:
             return 1
-        if date in self._currency_rates_by_date:
-            for curr in self._currency_rates_by_date[date]:
-                if curr.currency == currency_name:
-                    return curr.rate
+        return self.rate_at(currency_name, _epoch_of(date))
+
+    def rate_at(self, currency_name, time):
+        """
+        Same as currency_rate_at_date, with the time in utc microseconds
+        since epoch (see timestamps.epoch_us)
+        """
+        if currency_name == BASE_CURRENCY:
+            return 1
+        self._lookups += 1
+        if self._memo_size:
+            rate = self._memo_rate_at(currency_name, time)
         else:
-            return None
+            timeline = self.timeline(currency_name)
+            rate = None
+            if timeline is not None:
+                rate = timeline.rate_at(time, self._max_staleness)
+        if rate is None:
+            self._misses += 1
+        return rate
+
+    def rate_interval(self, currency_name, time):
+        """
+        Returns
+        -------
+        start, end : int, int
+            utc microseconds of the range [start, end) around time over
+            which rate_at gives one rate : between two rates set, or a rate
+            set and the time it gets too old. None for no bound.
+        """
+        timeline = None
+        if currency_name != BASE_CURRENCY:
+            timeline = self.timeline(currency_name)
+        if timeline is None:
+            return None, None
+        changes = [timeline.arrays()[0]]
+        if self._max_staleness is not None:
+            changes.append(changes[0] + self._max_staleness + 1)
+        start = end = None
+        for change_times in changes:
+            idx = int(np.searchsorted(change_times, time, side="right"))
+            if idx and (start is None or change_times[idx - 1] > start):
+                start = int(change_times[idx - 1])
+            if idx < len(change_times) and \
+                    (end is None or change_times[idx] < end):
+                end = int(change_times[idx])
+        return start, end
+
+    def _memo_rate_at(self, currency_name, time):
+        key = (currency_name, time // self._memo_bucket)
+        entry = self._memo.get(key)
+        if entry is None:
+            self._memo_misses += 1
+            entry = self._memo[key] = self._bucket_rates(*key)
+            if len(self._memo) > self._memo_size:
+                self._memo.popitem(last=False)
+        else:
+            self._memo_hits += 1
+            self._memo.move_to_end(key)
+        times, rates = entry
+        if len(times) == 1:
+            return rates[0]
+        return rates[bisect_right(times, time) - 1]
+
+    def _bucket_rates(self, currency_name, bucket):
+        """
+        Returns
+        -------
+        times, rates : list, list
+            The times in the bucket at which rate_at changes (the bucket's
+            start first), and the rate (or None) from each of them on
+        """
+        start = bucket * self._memo_bucket
+        end = start + self._memo_bucket
+        timeline = self.timeline(currency_name)
+        if timeline is None:
+            return [start], [None]
+        rate_times, rates = timeline.arrays()
+        first, last = np.searchsorted(rate_times, [start, end], side="right")
+        if first == last and self._max_staleness is None:
+            # No rate set in the bucket, the usual case
+            return [start], [float(rates[first - 1]) if first else None]
+        changes = [rate_times]
+        if self._max_staleness is not None:
+            # Rates also change when they get too old
+            changes.append(rate_times + self._max_staleness + 1)
+        times = {start}
+        for change_times in changes:
+            first, last = np.searchsorted(change_times, [start, end])
+            times.update(change_times[first:last].tolist())
+        times = sorted(times)
+        rates = timeline.rates_at(np.array(times, dtype=np.int64),
+                                  self._max_staleness)
+        return times, [None if np.isnan(rate) else rate
+                       for rate in rates.tolist()]
+
+    def rates_at(self, currencies, times):
+        """
+        rate_at for whole arrays, one binary search per currency.
+
+        Parameters
+        ----------
+        currencies : sequence of str, or (values, codes) pair,
+            Currency of every row, as codes or dictionary encoded (distinct
+            values and the int index of every row in them)
+        times : np.ndarray,
+            int64 utc microseconds since epoch of every row
+
+        Returns
+        -------
+        rates : np.ndarray,
+            float64 rate of every row, NaN where there is none
+        """
+        times = np.asarray(times, dtype=np.int64)
+        values, codes = encode_currencies(currencies)
+        rates = np.ones(len(times), dtype=np.float64)
+        if len(times) == 0:
+            return rates
+        if len(values) < 1 << 15:
+            # Stable sorts of 16 bit ints are radix sorts, a lot faster
+            codes = codes.astype(np.int16)
+        order = np.argsort(codes, kind="stable")
+        starts = np.flatnonzero(np.diff(codes[order])) + 1
+        for rows in np.split(order, starts):
+            currency_name = values[codes[rows[0]]]
+            if currency_name == BASE_CURRENCY:
+                continue
+            self._lookups += len(rows)
+            timeline = self.timeline(currency_name)
+            if timeline is None:
+                rates[rows] = np.nan
+            else:
+                rates[rows] = timeline.rates_at(times[rows],
+                                                self._max_staleness)
+        self._misses += int(np.isnan(rates).sum())
+        return rates
+
+    def convert(self, currencies, times, amounts):
+        """
+        Converts whole arrays of amounts to BASE_CURRENCY in one pass.
+        Parameters are the same as in rates_at, plus the amounts.
+        Amounts without a rate are taken as in BASE_CURRENCY already.
+
+        Returns
+        -------
+        converted : np.ndarray,
+            float64, amount * rate for every row
+        """
+        return apply_rates(self.rates_at(currencies, times), amounts)
+
+    @property
+    def max_staleness(self):
+        """
+        Microseconds after which a rate is too old to be used, None if
+        rates never expire
+        """
+        return self._max_staleness
+
+    @property
+    def lookups(self):
+        return self._lookups
+
+    @property
+    def misses(self):
+        """
+        Number of lookups that found no rate
+        """
+        return self._misses
+
+    @property
+    def memo_hits(self):
+        """
+        Number of rate_at answered from the memo
+        """
+        return self._memo_hits
+
+    @property
+    def memo_misses(self):
+        """
+        Number of rate_at that had to look a (currency, time bucket) up
+        """
+        return self._memo_misses
+
+    @property
+    def memo_size(self):
+        return self._memo_size
+
+    @property
+    def version(self):
+        """
+        Number of rates added since the list was made. Anything converted
+        with an older version may be stale.
+        """
+        return self._version
+
+    @memo_size.setter
+    def memo_size(self, memo_size):
+        self._memo_size = memo_size
+        while len(self._memo) > memo_size:
+            self._memo.popitem(last=False)
+
+    @property
+    def currencies(self):
+        """
+        Codes of the currencies with rates
+        """
+        currencies = set(self._timelines)
+        if self._store is not None:
+            currencies.update(self._store.currencies)
+        return currencies
 
     @classmethod
-    def load(cls, filename):
-        currency_list = cls()
-        json_curr_list = json.load(open(filename, "r"))
-        for date in json_curr_list.keys():
-            curr_date_dict = json_curr_list[date]
-            for curr_name, curr_rate in curr_date_dict.items():
-                currency_list.add_currency_at_date(curr_name, curr_rate, date)
+    def load(cls, filename, max_staleness=None, currencies=None):
+        """
+        Parameters
+        ----------
+        currencies : iterable,
+            Currency codes to load the rates of, eg. the ones found in the
+            logs. Rates of other currencies are skipped without being
+            decoded. None loads every currency.
+        """
+        currency_list = cls(max_staleness)
+        for date, curr_name, curr_rate in read_rates(filename, currencies):
+            currency_list.add_currency_at_date(curr_name, curr_rate, date)
+        return currency_list
+
+    @classmethod
+    def load_cached(cls, filename, max_staleness=None, currencies=None):
+        """
+        Same rates as load(filename), read from the binary sidecar of the
+        json file (see bankmanager.ratestore), which is written first if
+        needed. Opening the sidecar only reads its index, a currency's rates
+        are read on its first lookup, so only the currencies in use are
+        ever read. Falls back to load(filename, max_staleness, currencies)
+        if the sidecar cannot be written.
+        """
+        store = open_rate_store(filename)
+        if store is None:
+            return cls.load(filename, max_staleness, currencies)
+        currency_list = cls(max_staleness)
+        currency_list._store = store
         return currency_list
+
+
+class CrossRates(object):
+    """
+    Rates to a report currency other than BASE_CURRENCY, derived from the
+    rates to BASE_CURRENCY : a currency's rate over the report currency's
+    rate, both at the time of the lookup, so that converted amounts are the
+    BASE_CURRENCY ones divided by the report currency's rate.
+
+    A missing rate counts as 1, as everywhere else, and as a miss of the
+    underlying rates. A rate of 0 is a rate : amounts in that currency are
+    worth 0, as in BASE_CURRENCY. A report currency rate of 0 cannot be
+    divided by, it is taken as missing (amounts stay at their
+    BASE_CURRENCY value), logged and counted in zero_report_rates.
+    It converts like a CurrencyRateList (rate_at, rates_at, convert).
+    """
+    def __init__(self, currency_rates, currency):
+        """
+        Parameters
+        ----------
+        currency_rates : instance of CurrencyRateList (or DailyRates),
+            Rates to BASE_CURRENCY
+        currency : str,
+            The iso4217 code of the report currency
+        """
+        self._currency_rates = currency_rates
+        self._currency = currency
+        self._zero_report_rates = 0
+
+    @property
+    def currency(self):
+        return self._currency
+
+    def _zero_report_rate(self, count):
+        self._zero_report_rates += count
+        logger.info("{} lookups with a {} rate of 0, converted at "
+                    "{} value".format(count, self._currency,
+                                      BASE_CURRENCY))
+
+    def rate_at(self, currency_name, time):
+        rate = self._currency_rates.rate_at(currency_name, time)
+        if rate is None:
+            rate = 1
+        report_rate = self._currency_rates.rate_at(self._currency, time)
+        if report_rate == 0:
+            self._zero_report_rate(1)
+        if not report_rate:
+            report_rate = 1
+        return rate / report_rate
+
+    def rates_at(self, currencies, times):
+        """
+        Same as CurrencyRateList.rates_at, except that rows without a rate
+        get 1 instead of NaN
+        """
+        times = np.asarray(times, dtype=np.int64)
+        rates = self._currency_rates.rates_at(currencies, times)
+        rates[np.isnan(rates)] = 1
+        report_rates = self._currency_rates.rates_at(
+            ([self._currency], np.zeros(len(times), dtype=np.int32)), times)
+        zero = report_rates == 0
+        if zero.any():
+            self._zero_report_rate(int(zero.sum()))
+        report_rates[np.isnan(report_rates) | zero] = 1
+        return rates / report_rates
+
+    def convert(self, currencies, times, amounts):
+        return np.asarray(amounts, dtype=np.float64) * \
+            self.rates_at(currencies, times)
+
+    @property
+    def version(self):
+        return getattr(self._currency_rates, "version", None)
+
+    @property
+    def zero_report_rates(self):
+        """
+        Number of lookups the report currency had a rate of 0 at
+        """
+        return self._zero_report_rates
+
+    @property
+    def lookups(self):
+        return self._currency_rates.lookups
+
+    @property
+    def misses(self):
+        return self._currency_rates.misses
+
+
+def rate_changes(old, new):
+    """
+    Where two CurrencyRateList (eg. before and after a correction of the
+    rates file) give different rates. Both have to have the same
+    max_staleness.
+
+    Returns
+    -------
+    changes : dict,
+        {currency: (starts, ends)}, int64 arrays of the utc microsecond
+        time ranges [start, end) where rate_at differs, only for currencies
+        with such ranges
+    """
+    assert old.max_staleness == new.max_staleness, \
+        "Rates valid for different durations cannot be compared"
+    max_staleness = new.max_staleness
+    changes = {}
+    for currency in sorted(old.currencies | new.currencies):
+        timelines = [old.timeline(currency), new.timeline(currency)]
+        # The rates only change at these times
+        points = [timeline.arrays()[0] for timeline in timelines
+                  if timeline is not None]
+        if max_staleness is not None:
+            points += [times + max_staleness + 1 for times in points]
+        points = np.unique(np.concatenate(points))
+        old_rates, new_rates = [
+            np.full(len(points), np.nan) if timeline is None
+            else timeline.rates_at(points, max_staleness)
+            for timeline in timelines]
+        differ = ~((old_rates == new_rates) |
+                   (np.isnan(old_rates) & np.isnan(new_rates)))
+        if differ.any():
+            ends = np.append(points[1:], np.iinfo(np.int64).max)
+            changes[currency] = (points[differ], ends[differ])
+    return changes
+
+
+def encode_currencies(currencies):
+    """
+    Parameters
+    ----------
+    currencies : sequence of str, or (values, codes) pair,
+        See CurrencyRateList.rates_at
+
+    Returns
+    -------
+    values, codes : list, np.ndarray
+        Distinct currencies and the index in values of every row
+    """
+    if isinstance(currencies, tuple):
+        values, codes = currencies
+    else:
+        distinct = {}
+        codes = np.fromiter((distinct.setdefault(currency, len(distinct))
+                             for currency in currencies),
+                            dtype=np.int32, count=len(currencies))
+        values = list(distinct)
+    return values, np.asarray(codes).ravel()
+
+
+def fill_missing_rates(rates):
+    """
+    Sets the NaN (missing) rates to 1 in place, so their amounts are taken
+    as in BASE_CURRENCY already
+    """
+    missing = np.isnan(rates)
+    if missing.any():
+        logger.info("{} amounts in a currency whose rate is not defined "
+                    "at that time. Assuming as if it is {}".format(
+                        int(missing.sum()), BASE_CURRENCY))
+        rates[missing] = 1
+    return rates
+
+
+def apply_rates(rates, amounts):
+    """
+    amounts * rates, amounts whose rate is NaN are taken as in
+    BASE_CURRENCY already
+    """
+    return np.asarray(amounts, dtype=np.float64) * fill_missing_rates(rates)
+
+
+def read_rates(filename, currencies=None, chunk_size=RATES_CHUNK_SIZE):
+    """
+    Entries of a currency rates file, in file order.
+
+    When only some currencies are wanted, the file is scanned chunk by
+    chunk with regular expressions instead of decoded : only chunk_size
+    characters (plus the date entry across the chunk boundary) are held at
+    a time, and the rates of the other currencies never become Python
+    objects. Files not in the flat {"date": {"CUR": rate}} shape of dump
+    are decoded as json anyway, as is the whole file when every currency
+    is wanted.
+
+    Parameters
+    ----------
+    currencies : iterable,
+        Currency codes to keep, None keeps all of them
+
+    Returns
+    -------
+    entries : list,
+        (date, currency, rate) tuples
+    """
+    with open(filename, "r") as f:
+        if currencies is not None:
+            entries = _scan_rates(f, set(currencies), chunk_size)
+            if entries is not None:
+                return entries
+            f.seek(0)
+        rates_by_date = json.load(f)
+    return [(date, currency, rate)
+            for date, rates in rates_by_date.items()
+            for currency, rate in rates.items()
+            if currencies is None or currency in currencies]
+
+
+def _scan_rates(f, currencies, chunk_size):
+    """
+    read_rates of the wanted currencies from the open file f, None if it is
+    not flat enough to be scanned
+    """
+    wanted = None
+    if currencies:
+        wanted = re.compile(r'"({})"\s*:\s*([^\s,}}]+)'.format(
+            "|".join(re.escape(currency) for currency in sorted(currencies))))
+    entries = []
+    text = ""
+    position = None  # Before the opening brace
+    while True:
+        chunk = f.read(chunk_size)
+        if position is not None:
+            # What is left of the previous chunk is at most one date entry
+            text, position = text[position:], 0
+        text += chunk
+        if position is None:
+            start = text.find("{")
+            if start < 0:
+                if text.strip():
+                    return None
+                if not chunk:
+                    return [] if not currencies else None
+                continue
+            if text[:start].strip():
+                return None
+            position = start + 1
+        for match in _DATE_ENTRY.finditer(text, position):
+            # Only separators are allowed between entries
+            if _ENTRY_SEPARATOR.fullmatch(text, position,
+                                          match.start()) is None:
+                return None
+            position = match.end()
+            if wanted is None:
+                continue
+            date = match.group(1)
+            for rate in wanted.finditer(match.group(2)):
+                try:
+                    entries.append((date, rate.group(1),
+                                    json.loads(rate.group(2))))
+                except ValueError:
+                    return None
+        if not chunk:
+            break
+    if text[position:].strip(" \t\r\n,") != "}":
+        return None
+    return entries
+
+
+def _epoch_of(date):
+    if not isinstance(date, datetime.datetime):
+        date = parse_timestamp(date)
+    return epoch_us(date)
@@ -0,0 +1,198 @@
+"""
+Dense day x currency rate matrix.
+
+The daily and category reports do not need a rate per transaction time, one
+rate per currency per day is enough. DailyRates holds, for every utc day of
+the period covered and every currency in use, the closing rate of the day :
+the last rate set at or before the end of that day (so days without a rate
+carry the previous one forward). Converting is then one array gather, no
+search per transaction.
+
+The matrix grows on demand as transactions of new days or currencies come
+in, and can be saved next to the rates file (<json file>.daily.npz), so a
+later run over the same period starts from it.
+"""
+import os
+import json
+import logging
+import numpy as np
+from bankmanager.config import BASE_CURRENCY
+from bankmanager.timestamps import US_PER_DAY
+from bankmanager.currencyrates import encode_currencies, apply_rates
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = ".daily.npz"
+
+
+def cache_filename(json_filename):
+    return json_filename + SUFFIX
+
+
+def cache_key(json_filename, max_staleness=None):
+    """
+    What a saved matrix was computed from : the rates file (size and
+    mtime) and how long rates stay valid
+    """
+    stat = os.stat(json_filename)
+    return json.dumps([stat.st_size, stat.st_mtime_ns, max_staleness])
+
+
+class DailyRates(object):
+    """
+    Closing rate of every currency on every utc day, built from a
+    CurrencyRateList. It converts like a CurrencyRateList (rate_at,
+    rates_at, convert), and can be used in its place.
+    """
+    def __init__(self, currency_rates):
+        """
+        Parameters
+        ----------
+        currency_rates : instance of CurrencyRateList,
+            Where the closing rates come from
+        """
+        self._currency_rates = currency_rates
+        self._first_day = 0
+        self._currencies = {BASE_CURRENCY: 0}  # currency: column
+        self._matrix = np.ones((0, 1), dtype=np.float64)
+        self._grown = False
+        self._lookups = 0
+        self._misses = 0
+
+    @property
+    def days(self):
+        """
+        (first, last) utc day covered, days since 1970-01-01
+        """
+        return self._first_day, self._first_day + len(self._matrix) - 1
+
+    @property
+    def currencies(self):
+        return [currency for currency in self._currencies
+                if currency != BASE_CURRENCY]
+
+    def _closing_rates(self, currency, first_day, count):
+        timeline = self._currency_rates.timeline(currency)
+        if timeline is None:
+            return np.full(count, np.nan)
+        day_ends = (np.arange(first_day, first_day + count,
+                              dtype=np.int64) + 1) * US_PER_DAY - 1
+        return timeline.rates_at(day_ends,
+                                 self._currency_rates.max_staleness)
+
+    def _cover(self, currencies, first_day, last_day):
+        """
+        Grows the matrix to the days first_day..last_day and currencies
+        """
+        new = [currency for currency in currencies
+               if currency not in self._currencies]
+        if len(self._matrix):
+            first_day, last_day = min(first_day, self._first_day), \
+                max(last_day, self.days[1])
+        if not new and (first_day, last_day) == self.days:
+            return
+        for currency in new:
+            self._currencies[currency] = len(self._currencies)
+        count = last_day - first_day + 1
+        matrix = np.empty((count, len(self._currencies)), dtype=np.float64)
+        old = slice(self._first_day - first_day,
+                    self._first_day - first_day + len(self._matrix))
+        for currency, column in self._currencies.items():
+            if currency == BASE_CURRENCY:
+                matrix[:, column] = 1
+            elif column < self._matrix.shape[1] and len(self._matrix):
+                # Only the new days of a known currency are looked up
+                matrix[old, column] = self._matrix[:, column]
+                matrix[:old.start, column] = self._closing_rates(
+                    currency, first_day, old.start)
+                matrix[old.stop:, column] = self._closing_rates(
+                    currency, first_day + old.stop, count - old.stop)
+            else:
+                matrix[:, column] = self._closing_rates(currency, first_day,
+                                                        count)
+        self._first_day, self._matrix = first_day, matrix
+        self._grown = True
+
+    def rates_at(self, currencies, times):
+        """
+        Same as CurrencyRateList.rates_at, with the closing rate of the
+        day of every time
+        """
+        values, codes = encode_currencies(currencies)
+        days = np.asarray(times, dtype=np.int64) // US_PER_DAY
+        if len(days) == 0:
+            return np.ones(0, dtype=np.float64)
+        self._cover(values, int(days.min()), int(days.max()))
+        columns = np.array([self._currencies[currency] for currency in values],
+                           dtype=np.intp)[codes]
+        rates = self._matrix[days - self._first_day, columns]
+        self._lookups += int((columns != 0).sum())
+        self._misses += int(np.isnan(rates).sum())
+        return rates
+
+    def rate_at(self, currency_name, time):
+        if currency_name == BASE_CURRENCY:
+            return 1
+        row = time // US_PER_DAY - self._first_day
+        column = self._currencies.get(currency_name)
+        if column is not None and 0 <= row < len(self._matrix):
+            # Covered already, no need for arrays
+            self._lookups += 1
+            rate = self._matrix[row, column]
+            if np.isnan(rate):
+                self._misses += 1
+                return None
+            return float(rate)
+        rate = self.rates_at([currency_name], [time])[0]
+        return None if np.isnan(rate) else float(rate)
+
+    def convert(self, currencies, times, amounts):
+        """
+        Same as CurrencyRateList.convert, with the closing rates
+        """
+        return apply_rates(self.rates_at(currencies, times), amounts)
+
+    @property
+    def lookups(self):
+        return self._lookups
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def save(self, filename, key):
+        """
+        Saves the matrix, if it grew since it was made or loaded
+        """
+        if not self._grown:
+            return
+        temporary = "{}.{}.tmp.npz".format(filename, os.getpid())
+        np.savez(temporary, key=np.array(key), first_day=self._first_day,
+                 currencies=np.array(list(self._currencies)),
+                 matrix=self._matrix)
+        os.replace(temporary, filename)
+        self._grown = False
+        logger.info("Saved daily currency rates to " + filename)
+
+    @classmethod
+    def load(cls, filename, currency_rates, key):
+        """
+        DailyRates of currency_rates, starting from the matrix saved in
+        filename if it was computed with the same key (see cache_key)
+        """
+        daily_rates = cls(currency_rates)
+        if not os.path.exists(filename):
+            return daily_rates
+        try:
+            with np.load(filename) as saved:
+                if str(saved["key"]) != key:
+                    return daily_rates
+                currencies = saved["currencies"].tolist()
+                daily_rates._first_day = int(saved["first_day"])
+                daily_rates._matrix = saved["matrix"]
+        except (OSError, ValueError, KeyError) as error:
+            logger.info("Cannot read {} : {}".format(filename, error))
+            return daily_rates
+        daily_rates._currencies = {currency: column for column, currency
+                                   in enumerate(currencies)}
+        return daily_rates
@@ -0,0 +1,204 @@
+"""
+Fixed point money.
+
+Float amounts summed one after the other drift on large sums, and the
+result depends on the order they are added in. Here amounts are int64
+counts of the minor unit of their currency (cents for USD, yen for JPY, see
+the iso4217 exponent), rates are int64 counts of 1 / RATE_SCALE, and
+converted amounts are int64 minor units of the report currency, rounded
+half to even. Sums of integers are exact, so balances do not depend on how
+the transactions were split (serial, per worker, per date...).
+
+Amounts are rounded to the minor unit of their currency when they are
+stored, rates to RATE_DIGITS decimals when they are used.
+"""
+import logging
+import numpy as np
+from bankmanager.config import BASE_CURRENCY
+from bankmanager.basebank import BankException
+from bankmanager.currencyrates import fill_missing_rates
+from bankmanager import registry
+
+logger = logging.getLogger(__name__)
+
+RATE_DIGITS = 9
+RATE_SCALE = 10 ** RATE_DIGITS
+# iso4217 has no minor unit for some codes (gold, SDR...), they keep 4
+# decimals, as many as the most precise currencies
+NO_MINOR_UNIT_EXPONENT = 4
+_LARGEST = 2.0 ** 62  # Margin below int64, for the rounding corrections
+
+
+def minor_exponent(currency):
+    """
+    Number of decimals of the minor unit of an iso4217 currency code
+    """
+    exponent = registry.currency(currency).exponent
+    if exponent is None:
+        return NO_MINOR_UNIT_EXPONENT
+    return exponent
+
+
+def report_exponent(currency_rates):
+    """
+    minor_exponent of the currency currency_rates convert to, (the
+    currency of CrossRates, config.BASE_CURRENCY otherwise)
+    """
+    return minor_exponent(getattr(currency_rates, "currency", BASE_CURRENCY))
+
+
+def exponents_of(values, codes):
+    """
+    minor_exponent of every row of dictionary encoded currencies
+    """
+    return np.array([minor_exponent(value) for value in values],
+                    dtype=np.int64)[np.asarray(codes, dtype=np.intp)]
+
+
+def to_minor(amounts, exponents):
+    """
+    Float amounts to int64 minor units, rounded half to even. Raises a
+    BankException for amounts too large for int64.
+    """
+    scaled = np.rint(np.asarray(amounts, dtype=np.float64) *
+                     10.0 ** np.asarray(exponents))
+    if len(scaled) and not (np.abs(scaled) < _LARGEST).all():
+        raise BankException("Amount too large for fixed point")
+    return scaled.astype(np.int64)
+
+
+def to_fixed_rates(rates):
+    """
+    Float rates to int64 multiples of 1 / RATE_SCALE. Missing rates are 1,
+    like everywhere else (see currencyrates.fill_missing_rates).
+    """
+    rates = fill_missing_rates(np.array(rates, dtype=np.float64))
+    return np.rint(rates * RATE_SCALE).astype(np.int64)
+
+
+def convert_minor(amounts, exponents, rates, target_exponent):
+    """
+    Converts minor units of several currencies to minor units of one.
+
+    amount * rate * 10 ** (target_exponent - exponent) / RATE_SCALE does not
+    fit in int64 before the division. The quotient is estimated in float64,
+    then corrected with the exact remainder : computed modulo 2 ** 64 (int64
+    products wrap around), the remainder is right as it is small.
+
+    Parameters
+    ----------
+    amounts, exponents : np.ndarray, np.ndarray
+        int64 minor units and minor_exponent of their currency
+    rates : np.ndarray,
+        int64 fixed point rates, see to_fixed_rates
+    target_exponent : int,
+        minor_exponent of the currency converted to
+
+    Returns
+    -------
+    converted : np.ndarray,
+        int64 minor units, rounded half to even
+    """
+    amounts = np.asarray(amounts, dtype=np.int64)
+    exponents = np.asarray(exponents, dtype=np.int64)
+    # amount * multiplier / divisor, both ints
+    multipliers = np.asarray(rates, dtype=np.int64) * \
+        10 ** np.maximum(target_exponent - exponents, 0)
+    divisors = RATE_SCALE * 10 ** np.maximum(exponents - target_exponent, 0)
+    estimate = np.floor(amounts.astype(np.float64) *
+                        multipliers.astype(np.float64) / divisors)
+    if len(estimate) and not (np.abs(estimate) < _LARGEST).all():
+        raise BankException("Converted amount too large for fixed point")
+    quotients = estimate.astype(np.int64)
+    with np.errstate(over="ignore"):
+        remainders = amounts * multipliers - quotients * divisors
+    quotients += remainders // divisors
+    remainders %= divisors
+    # Half to even
+    quotients += (2 * remainders > divisors) | \
+        ((2 * remainders == divisors) & (quotients % 2 == 1))
+    return quotients
+
+
+def convert_minor_one(amount, currency, rate, target_exponent):
+    """
+    Same as to_minor then convert_minor, for one float amount and one float
+    rate (None when missing), with python ints
+    """
+    exponent = minor_exponent(currency)
+    minor = float(np.rint(amount * 10.0 ** exponent))
+    if not abs(minor) < _LARGEST:
+        raise BankException("Amount too large for fixed point")
+    rate = int(np.rint((1 if rate is None else rate) * RATE_SCALE))
+    divisor = RATE_SCALE * 10 ** max(exponent - target_exponent, 0)
+    quotient, remainder = divmod(
+        int(minor) * rate * 10 ** max(target_exponent - exponent, 0), divisor)
+    if 2 * remainder > divisor or \
+            (2 * remainder == divisor and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+
+def convert(currency_rates, currencies, times, amounts, exponents):
+    """
+    Fixed point counterpart of CurrencyRateList.convert : looks the rates up
+    in one batch and converts minor units with them
+
+    Parameters
+    ----------
+    currency_rates : instance of CurrencyRateList, DailyRates or CrossRates
+    currencies, times :
+        See CurrencyRateList.rates_at
+    amounts, exponents : np.ndarray, np.ndarray
+        int64 minor units and minor_exponent of every row
+
+    Returns
+    -------
+    converted : np.ndarray,
+        int64 minor units of the currency currency_rates convert to
+    """
+    rates = to_fixed_rates(currency_rates.rates_at(currencies, times))
+    return convert_minor(amounts, exponents, rates,
+                         report_exponent(currency_rates))
+
+
+def exact_sum(values, where=None):
+    """
+    Sum of int64 values (those where the mask where is True) as a python
+    int, which cannot overflow (for less than 2 ** 31 values).
+
+    The int64 sum may wrap around, it is only right modulo 2 ** 64. The sum
+    of the high 32 bits of the values cannot, and the sum of the low 32
+    bits is between 0 and 2 ** 63 : it is the int64 sum minus the high one,
+    modulo 2 ** 64.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if where is not None:
+        # Unlike float sums, the order does not matter. Zeroing the other
+        # values is much faster than selecting them.
+        values = values * where
+    # ufunc reduce directly, this runs once per bucket
+    high = int(np.add.reduce(values >> 32)) << 32
+    return high + (int(np.add.reduce(values)) - high) % (1 << 64)
+
+
+def exact_group_sums(codes, values, count):
+    """
+    exact_sum of the values of every code from 0 to count - 1, as a list of
+    python ints. Same split of the high bits as exact_sum.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    high = np.zeros(count, dtype=np.int64)
+    wrapped = np.zeros(count, dtype=np.int64)
+    np.add.at(high, codes, values >> 32)
+    np.add.at(wrapped, codes, values)
+    return [(high_sum << 32) + (wrapped_sum - (high_sum << 32)) % (1 << 64)
+            for high_sum, wrapped_sum in zip(high.tolist(), wrapped.tolist())]
+
+
+def to_major(minor, exponent):
+    """
+    Minor units to a float amount (the nearest one, so it prints as the
+    exact decimal)
+    """
+    return int(minor) / 10 ** exponent
@@ -0,0 +1,217 @@
+"""
+State for incremental re-runs of the parser.
+
+A state folder holds :-
+- manifest.json : (size, mtime, sha1) of every log file already processed,
+  and of the currency rates file the aggregates were converted with
+- currency_rates.json : a copy of that rates file
+- <bank_code>.json : per log file partial aggregates of that bank, with the
+  amounts before conversion (see aggregation.BankAggregate.to_dict), and
+  the rows of the file that were rejected
+
+The manifest also keeps the (size, mtime) of the reports written by the
+last run. A bank whose logs and rates did not change is neither saved nor
+written again, as long as its reports are still those.
+
+A re-run only parses the log files whose fingerprint changed, and merges
+the partial aggregates of all the files into the reports. When the rates
+file was corrected, the times whose rates changed are found by comparing
+it to the copy, and only the buckets with amounts at those times are
+converted again, from the saved amounts.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+from bankmanager.currencyrates import CurrencyRateList, rate_changes
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+RATES_COPY = "currency_rates.json"
+
+
+def file_hash(filename, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fingerprint(filename, previous=None):
+    """
+    (size, mtime, sha1) of a file, as a dict.
+    The file is only hashed if size or mtime differ from previous.
+    """
+    stat = os.stat(filename)
+    current = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if previous is not None and previous["size"] == current["size"] and \
+            previous["mtime"] == current["mtime"]:
+        return previous
+    current["sha1"] = file_hash(filename)
+    return current
+
+
+class IncrementalState(object):
+    """
+    Manifest of processed files plus the per bank partial aggregates
+    """
+    def __init__(self, state_folder):
+        self._folder = state_folder
+        if not os.path.exists(state_folder):
+            os.makedirs(state_folder)
+        manifest_file = os.path.join(state_folder, MANIFEST)
+        if os.path.exists(manifest_file):
+            with open(manifest_file, "r") as f:
+                self._manifest = json.load(f)
+        else:
+            self._manifest = {"currency_rates": None, "logs": {}}
+        self._rate_changes = None
+        self._rates_to_copy = None
+
+    def unchanged(self, key, filename):
+        """
+        Parameters
+        ----------
+        key : str,
+            Name of the file in the manifest
+        filename : str,
+            Path of the file now
+
+        Returns
+        -------
+        unchanged : bool,
+            True if the file is the one recorded under key
+        """
+        previous = self._manifest["logs"].get(key)
+        if previous is None:
+            return False
+        current = fingerprint(filename, previous)
+        if current.get("sha1") != previous.get("sha1"):
+            return False
+        # Touched but same content, remember the new mtime
+        self._manifest["logs"][key] = current
+        return True
+
+    def record(self, key, filename):
+        self._manifest["logs"][key] = fingerprint(filename)
+
+    def reports_kept(self, key, filenames):
+        """
+        True if the files are the reports recorded under key (see
+        record_reports), untouched since
+        """
+        previous = self._manifest.get("reports", {}).get(key)
+        if previous is None or sorted(previous) != sorted(filenames):
+            return False
+        for filename in filenames:
+            if not os.path.exists(filename):
+                return False
+            stat = os.stat(filename)
+            if previous[filename] != [stat.st_size, stat.st_mtime_ns]:
+                return False
+        return True
+
+    def record_reports(self, key, filenames):
+        reports = self._manifest.setdefault("reports", {})
+        reports[key] = {}
+        for filename in filenames:
+            stat = os.stat(filename)
+            reports[key][filename] = [stat.st_size, stat.st_mtime_ns]
+
+    def retain(self, keys):
+        """
+        Forgets every log file not in keys (eg. removed from
+        transactions.csv)
+        """
+        keys = set(keys)
+        self._manifest["logs"] = {key: value for key, value in
+                                  self._manifest["logs"].items()
+                                  if key in keys}
+
+    def check_currency_rates(self, filename, max_staleness=None,
+                             daily_rates=False):
+        """
+        Everything saved is in base currency, so it has to be converted
+        again once the rates file changes. If only the rates changed (same
+        max_staleness, no daily rates) and the previous rates were copied,
+        the changed time ranges are kept in rate_changes for the saved
+        aggregates to be converted again. Otherwise (or if how long rates
+        stay valid, or whether daily rates are used, changed) nothing saved
+        can be reused and every log is forgotten.
+
+        Returns
+        -------
+        unchanged : bool,
+            True if the rates are the ones of the last run
+        """
+        previous = self._manifest["currency_rates"]
+        current = dict(fingerprint(filename, previous))
+        current["max_staleness"] = max_staleness
+        current["daily_rates"] = daily_rates
+        self._manifest["currency_rates"] = current
+        self._rate_changes = None
+        copy = os.path.join(self._folder, RATES_COPY)
+        if previous is not None and \
+                previous.get("max_staleness") == max_staleness and \
+                previous.get("daily_rates", False) == daily_rates:
+            if previous.get("sha1") == current.get("sha1"):
+                if not os.path.exists(copy):
+                    self._rates_to_copy = filename
+                return True
+            if not daily_rates and os.path.exists(copy) and \
+                    self._manifest["logs"]:
+                self._rate_changes = rate_changes(
+                    CurrencyRateList.load(copy, max_staleness),
+                    CurrencyRateList.load(filename, max_staleness))
+                logger.info("Currency rates corrected for {} currencies, "
+                            "converting the affected buckets again".format(
+                                len(self._rate_changes)))
+                self._rates_to_copy = filename
+                return False
+        if self._manifest["logs"]:
+            logger.info("Currency rates changed, re-parsing everything")
+        self._manifest["logs"] = {}
+        self._rates_to_copy = filename
+        return False
+
+    @property
+    def rate_changes(self):
+        """
+        {currency: (starts, ends)} time ranges whose rate was corrected
+        since the last run (see currencyrates.rate_changes), None if the
+        saved aggregates do not need converting again
+        """
+        return self._rate_changes
+
+    def _bank_file(self, bank_code):
+        return os.path.join(self._folder, bank_code + ".json")
+
+    def load_bank(self, bank_code):
+        """
+        Returns
+        -------
+        partials : dict,
+            {log file: BankAggregate.to_dict()} saved for the bank
+        """
+        if not os.path.exists(self._bank_file(bank_code)):
+            return {}
+        with open(self._bank_file(bank_code), "r") as f:
+            return json.load(f)
+
+    def save_bank(self, bank_code, partials):
+        with open(self._bank_file(bank_code), "w") as f:
+            json.dump(partials, f)
+
+    def save(self):
+        with open(os.path.join(self._folder, MANIFEST), "w") as f:
+            json.dump(self._manifest, f, indent=1)
+        # The copy is what the next run compares its rates to. Written after
+        # the manifest, a copy left behind by a crash is older than the
+        # aggregates, which only makes the next correction convert more.
+        if self._rates_to_copy is not None:
+            shutil.copyfile(self._rates_to_copy,
+                            os.path.join(self._folder, RATES_COPY))
+            self._rates_to_copy = None
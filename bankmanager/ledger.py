@@ -0,0 +1,172 @@
+"""
+Per account index of a bank's transactions.
+
+A bank's TransactionList is in log order, so the balance of one account
+meant walking the whole list. AccountLedger keeps, for every account of
+the bank, its running balance in config.BASE_CURRENCY (money in minus
+money out, internal transfers included) and the offsets in the list of the
+transactions it took part in, as a compact array. A balance is then one
+dict lookup, and a statement only reads the transactions of the account.
+
+The ledger follows the list : update indexes the transactions appended
+since the last update (eg. the ones of a new log). It starts over if the
+list's rates changed since (see CurrencyRateList.version).
+"""
+from array import array
+import logging
+import numpy as np
+from bankmanager import fixedpoint
+from bankmanager.basebank import BankAccountID, BankException
+from bankmanager.currencyrates import encode_currencies
+
+logger = logging.getLogger(__name__)
+
+
+def _account_number(account_id):
+    if not isinstance(account_id, BankAccountID):
+        account_id = BankAccountID(account_id)
+    return account_id.number
+
+
+class AccountLedger(object):
+    """
+    Running balance and transaction offsets of every account of one bank
+    """
+    def __init__(self, transaction_list):
+        """
+        Parameters
+        ----------
+        transaction_list : instance of TransactionList,
+            The transactions of the bank, with its currency rates
+        """
+        self._transaction_list = transaction_list
+        self._bank_code = transaction_list.bank.code
+        self._exponent = None
+        self._version = None
+        self._indexed = 0
+        # {account number: balance}, int minor units with fixed point
+        self._balances = {}
+        # {account number: array of offsets in the list}
+        self._offsets = {}
+
+    def _reset(self):
+        currency_rates = self._transaction_list.currency_rates
+        self._exponent = None
+        if self._transaction_list.fixed_point:
+            self._exponent = fixedpoint.report_exponent(currency_rates)
+        self._version = getattr(currency_rates, "version", None)
+        self._indexed = 0
+        self._balances = {}
+        self._offsets = {}
+
+    def _convert(self, transactions):
+        """
+        Amount in base currency of every transaction, internal ones
+        included, in one batch
+        """
+        currency_rates = self._transaction_list.currency_rates
+        currencies = encode_currencies([transaction.currency_code
+                                        for transaction in transactions])
+        times = np.fromiter((transaction.epoch_us
+                             for transaction in transactions),
+                            dtype=np.int64, count=len(transactions))
+        amounts = np.fromiter((transaction.transaction_amount_nocurrency
+                               for transaction in transactions),
+                              dtype=np.float64, count=len(transactions))
+        if self._exponent is None:
+            return currency_rates.convert(currencies, times, amounts).tolist()
+        exponents = fixedpoint.exponents_of(*currencies)
+        return fixedpoint.convert(
+            currency_rates, currencies, times,
+            fixedpoint.to_minor(amounts, exponents), exponents).tolist()
+
+    def update(self):
+        """
+        Indexes the transactions appended to the list since the last update
+
+        Returns
+        -------
+        count : int,
+            Number of transactions indexed
+        """
+        currency_rates = self._transaction_list.currency_rates
+        if currency_rates is None:
+            raise BankException("Cannot index the accounts without "
+                                "date-wise currency rates")
+        if getattr(currency_rates, "version", None) != self._version or \
+                self._indexed == 0:
+            self._reset()
+        transactions = self._transaction_list.transactions
+        new = transactions[self._indexed:]
+        if not new:
+            return 0
+        for offset, transaction, amount in zip(
+                range(self._indexed, len(transactions)), new,
+                self._convert(new)):
+            source = transaction.source
+            destination = transaction.destination
+            if source.bankid is self._bank_code:
+                self._post(source.number, offset, -amount)
+            if destination.bankid is self._bank_code:
+                if destination == source:
+                    # Paid to itself, the offset is there already
+                    self._balances[source.number] += amount
+                else:
+                    self._post(destination.number, offset, amount)
+        self._indexed = len(transactions)
+        logger.debug("Indexed {} transactions of {} accounts".format(
+            len(new), len(self._balances)))
+        return len(new)
+
+    def _post(self, number, offset, amount):
+        if number in self._balances:
+            self._balances[number] += amount
+            self._offsets[number].append(offset)
+        else:
+            self._balances[number] = amount
+            self._offsets[number] = array("q", [offset])
+
+    def _major(self, amount):
+        if self._exponent is None:
+            return amount
+        return fixedpoint.to_major(amount, self._exponent)
+
+    def balance(self, account_id):
+        """
+        Balance of an account in the base currency, 0 for accounts without
+        transactions
+
+        Parameters
+        ----------
+        account_id : str or BankAccountID
+        """
+        return self._major(self._balances.get(_account_number(account_id),
+                                              0))
+
+    def offsets(self, account_id):
+        """
+        Offsets in the list of the transactions of an account, in list order
+        """
+        return self._offsets.get(_account_number(account_id), array("q"))
+
+    def statement(self, account_id):
+        """
+        Transactions of an account, in list order, without walking the
+        rest of the list
+        """
+        transactions = self._transaction_list.transactions
+        return [transactions[offset] for offset in self.offsets(account_id)]
+
+    @property
+    def bank_code(self):
+        return self._bank_code
+
+    @property
+    def accounts(self):
+        """
+        Ids of the accounts with transactions
+        """
+        return ["%032X" % number for number in self._balances]
+
+    def __len__(self):
+        return self._indexed
@@ -0,0 +1,376 @@
+"""
+Memory mapped reader for the transaction logs.
+
+The logs are csv files with seven unquoted fields per line. csv.reader
+decodes every line and makes a str per field, which is most of the time
+spent reading a log. Here the file is mapped, and lines and fields are split
+on the byte buffer with NumPy. Fields come out as fixed width byte arrays,
+and the typed columns (times, account ids, amounts, currency and category
+codes) are decoded from those, the text ones once per distinct value.
+
+Lines end with \\n or \\r\\n (what csv.writer writes). Files with quotes, or
+with a \\r anywhere else, cannot be split on commas and newlines alone,
+read_log_batches returns None for them, so the caller can use csv.reader
+instead.
+"""
+import os
+import mmap
+import numpy as np
+from bankmanager import registry
+from bankmanager.basebank import BankException
+from bankmanager.timestamps import parse_timestamp, epoch_us, \
+    utc_offset_seconds
+from bankmanager.validation import NR_FIELDS, FIELD_COUNT, BAD_DATE, \
+    BAD_SOURCE_ID, BAD_DESTINATION_ID, BAD_AMOUNT, NEGATIVE_AMOUNT, \
+    BAD_CURRENCY, BAD_CATEGORY, VALID, decode_account_ids, parse_amounts, \
+    first_failures, valid_indices
+
+_NEWLINE = ord("\n")
+_RETURN = ord("\r")
+_COMMA = ord(",")
+# Bytes of log handed to NumPy at once, whole lines only
+CHUNK_BYTES = 1 << 23
+# Widest field of a usual line : timestamp, transaction id, account ids,
+# amount, currency, category. Fields are gathered in arrays as wide as their
+# widest entry, lines with a wider field are gathered apart (see _segments)
+MAX_FIELD_WIDTHS = np.array([40, 64, 40, 40, 40, 8, 64])
+
+
+def _decode(value):
+    return value.decode("utf-8")
+
+
+def _distinct(column, decode):
+    """
+    Decodes every distinct value of a byte column once.
+
+    Parameters
+    ----------
+    decode : callable,
+        str to decoded value, raises (BankException, ValueError) on bad ones
+
+    Returns
+    -------
+    values, codes, valid : list, np.ndarray, np.ndarray
+        Decoded distinct values (None for bad ones), the index in values of
+        every entry, and the mask of the entries that decoded fine
+    """
+    distinct, codes = np.unique(column, return_inverse=True)
+    codes = codes.ravel()
+    values = []
+    distinct_valid = np.ones(len(distinct), dtype=bool)
+    for idx, value in enumerate(distinct.tolist()):
+        try:
+            values.append(decode(_decode(value)))
+        except (BankException, ValueError, OverflowError):
+            values.append(None)
+            distinct_valid[idx] = False
+    return values, codes, distinct_valid[codes]
+
+
+def _currency_code(code):
+    registry.currency(code)
+    return code
+
+
+def _parse_time(date):
+    timestamp = parse_timestamp(date)
+    return epoch_us(timestamp), utc_offset_seconds(timestamp)
+
+
+def _segments(widths, chunk_bytes=CHUNK_BYTES):
+    """
+    Splits the complete lines of a chunk into runs of lines gathered
+    together.
+
+    Parameters
+    ----------
+    widths : np.ndarray,
+        (lines, NR_FIELDS) field widths
+
+    Returns
+    -------
+    segments : list,
+        (first, last) line ranges, in order. Lines with a field wider than
+        MAX_FIELD_WIDTHS are only gathered with other such lines, at most
+        chunk_bytes of gathered fields at once (or the line alone). A few
+        odd lines, eg. corrupted ones, do not make every row of the chunk
+        as wide as them.
+    """
+    wide = (widths > MAX_FIELD_WIDTHS).any(axis=1)
+    if not wide.any():
+        return [(0, len(widths))]
+    bounds = np.concatenate(([0], np.flatnonzero(wide[1:] != wide[:-1]) + 1,
+                             [len(wide)])).tolist()
+    segments = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        if not wide[first]:
+            segments.append((first, last))
+            continue
+        start = first
+        column_widths = widths[first]
+        for line in range(first + 1, last):
+            grown = np.maximum(column_widths, widths[line])
+            if (line - start + 1) * int(grown.sum()) > chunk_bytes:
+                segments.append((start, line))
+                start = line
+                column_widths = widths[line]
+            else:
+                column_widths = grown
+        segments.append((start, last))
+    return segments
+
+
+def _gather(buffer, starts, ends):
+    """
+    Copies the byte ranges [starts, ends) of buffer into a fixed width
+    byte string array, one entry per range
+    """
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    offsets = np.arange(width)
+    gathered = np.take(buffer, starts[:, None] + offsets, mode="clip")
+    if len(lengths) and lengths.min() < width:
+        # Shorter fields are padded with zeros, which S arrays strip
+        gathered[offsets >= lengths[:, None]] = 0
+    return gathered.view("S%d" % width).ravel()
+
+
+class LogBatch(object):
+    """
+    Valid rows of a chunk of a log, column wise. Fields are byte strings
+    as in the file, typed columns are :-
+    - times (int64 utc microseconds) and offsets (int32 utc offset seconds)
+    - sources and destinations, (n, 2) uint64 account ids
+    - amounts, float64
+    - currencies and categories, as (distinct values, int codes)
+    Iterating over it gives the rows as lists of str, like csv.reader.
+    """
+    def __init__(self, fields, times, offsets, sources, destinations,
+                 amounts, currencies, categories):
+        self.fields = fields
+        self.times = times
+        self.offsets = offsets
+        self.sources = sources
+        self.destinations = destinations
+        self.amounts = amounts
+        self.currencies = currencies
+        self.categories = categories
+
+    @classmethod
+    def decode(cls, fields):
+        """
+        Decodes the typed columns of byte fields.
+
+        Returns
+        -------
+        batch, reasons : LogBatch, np.ndarray
+            The batch of all the rows, and the reason code (see
+            bankmanager.validation) of every row
+        """
+        dates, _, sources, destinations, amounts, currencies, categories = \
+            fields
+        times, time_codes, valid_dates = _distinct(dates, _parse_time)
+        times = [time if time is not None else (0, 0) for time in times]
+        offsets = np.array([time[1] for time in times],
+                           dtype=np.int32)[time_codes]
+        times = np.array([time[0] for time in times],
+                         dtype=np.int64)[time_codes]
+        sources, valid_sources = decode_account_ids(sources)
+        destinations, valid_destinations = decode_account_ids(destinations)
+        amounts, parseable = parse_amounts(amounts)
+        currency_values, currency_codes, valid_currencies = _distinct(
+            currencies, _currency_code)
+        category_values, category_codes, valid_categories = _distinct(
+            categories, registry.category)
+
+        reasons = first_failures([
+            (BAD_DATE, valid_dates),
+            (BAD_SOURCE_ID, valid_sources),
+            (BAD_DESTINATION_ID, valid_destinations),
+            (BAD_AMOUNT, parseable),
+            (NEGATIVE_AMOUNT, ~parseable | (amounts >= 0)),
+            (BAD_CURRENCY, valid_currencies),
+            (BAD_CATEGORY, valid_categories),
+        ], len(dates))
+        batch = cls(fields, times, offsets, sources, destinations, amounts,
+                    (currency_values, currency_codes),
+                    (category_values, category_codes))
+        return batch, reasons
+
+    def select(self, rows):
+        """
+        Batch of the given rows only
+        """
+        return LogBatch([field[rows] for field in self.fields],
+                        self.times[rows], self.offsets[rows],
+                        self.sources[rows], self.destinations[rows],
+                        self.amounts[rows],
+                        (self.currencies[0], self.currencies[1][rows]),
+                        (self.categories[0], self.categories[1][rows]))
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        columns = [np.char.decode(field, "utf-8").tolist()
+                   for field in self.fields]
+        for row in zip(*columns):
+            yield list(row)
+
+
+def _split_chunk(buffer, start, end):
+    """
+    Splits buffer[start:end] (whole lines) into lines and fields.
+
+    Returns
+    -------
+    line_starts, line_ends : np.ndarray, np.ndarray
+        Byte range of every line
+    field_starts, field_ends : np.ndarray, np.ndarray
+        (lines, NR_FIELDS) byte ranges of the fields, of the complete lines
+        only
+    complete : np.ndarray,
+        bool mask of the lines with NR_FIELDS fields
+    """
+    chunk = buffer[start:end]
+    newlines = np.flatnonzero(chunk == _NEWLINE) + start
+    line_ends = newlines
+    if end > start and buffer[end - 1] != _NEWLINE:
+        # Last line of the file without a newline
+        line_ends = np.append(newlines, end)
+    line_starts = np.empty(len(line_ends), dtype=np.int64)
+    line_starts[:1] = start
+    line_starts[1:] = line_ends[:-1] + 1
+    # \r\n line endings, the \r is not part of the last field
+    line_ends[(line_ends > line_starts) &
+              (buffer[line_ends - 1] == _RETURN)] -= 1
+
+    commas = np.flatnonzero(chunk == _COMMA) + start
+    comma_counts = np.diff(np.searchsorted(commas, line_starts),
+                           append=len(commas))
+    complete = comma_counts == NR_FIELDS - 1
+
+    # Commas of the complete lines, one row of NR_FIELDS - 1 per line
+    first_comma = np.searchsorted(commas, line_starts[complete])
+    commas = commas[first_comma[:, None] + np.arange(NR_FIELDS - 1)]
+    field_starts = np.column_stack([line_starts[complete], commas + 1])
+    field_ends = np.column_stack([commas, line_ends[complete]])
+    return line_starts, line_ends, field_starts, field_ends, complete
+
+
+def _map(filename, data=None):
+    """
+    The bytes of a log, data if the log was read already (see
+    bankmanager.prefetch), else a read only mmap of the file
+    """
+    if data is not None:
+        return data
+    if os.path.getsize(filename) == 0:
+        return b""
+    with open(filename, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _unmap(mapped):
+    if isinstance(mapped, mmap.mmap):
+        mapped.close()
+
+
+def can_map(filename, chunk_bytes=CHUNK_BYTES, data=None):
+    """
+    True if the log can be split on commas and newlines alone, ie. has no
+    quotes and every \\r is followed by a \\n
+    """
+    mapped = _map(filename, data)
+    buffer = None
+    try:
+        if mapped.find(b'"') != -1:
+            return False
+        if mapped.find(b"\r") == -1:
+            return True
+        if mapped[-1:] == b"\r":
+            return False
+        buffer = np.frombuffer(mapped, dtype=np.uint8)
+        for start in range(0, len(buffer), chunk_bytes):
+            carriage_returns = np.flatnonzero(
+                buffer[start:start + chunk_bytes] == _RETURN) + start
+            if len(carriage_returns) and \
+                    (buffer[carriage_returns + 1] != _NEWLINE).any():
+                return False
+        return True
+    finally:
+        del buffer
+        _unmap(mapped)
+
+
+def read_log_batches(filename, rejects=None, chunk_bytes=CHUNK_BYTES,
+                     data=None):
+    """
+    Yields the valid rows of a log as LogBatch, chunk_bytes of log at a time.
+
+    Parameters
+    ----------
+    rejects : RejectWriter or RejectCollector,
+        Where invalid rows go. If None, an invalid row raises a
+        BankException
+    data : bytes,
+        Content of the log, if it was read already. The file is mapped
+        otherwise.
+
+    Returns
+    -------
+    batches : generator or None,
+        None if the log has quoting, see can_map
+    """
+    if not can_map(filename, chunk_bytes, data):
+        return None
+    return _read_mapped_batches(filename, rejects, chunk_bytes, data)
+
+
+def _read_mapped_batches(filename, rejects, chunk_bytes, data):
+    log_file = os.path.basename(filename)
+    mapped = _map(filename, data)
+    buffer = np.frombuffer(mapped, dtype=np.uint8)
+    first_row_number = 1
+    start = 0
+    try:
+        while start < len(buffer):
+            end = mapped.rfind(b"\n", start, start + chunk_bytes) + 1
+            if end <= start:
+                # A line longer than chunk_bytes, or the end of the file
+                end = mapped.find(b"\n", start + chunk_bytes) + 1 or \
+                    len(buffer)
+            line_starts, line_ends, field_starts, field_ends, complete = \
+                _split_chunk(buffer, start, end)
+            decoded = []
+            for first, last in _segments(field_ends - field_starts,
+                                         chunk_bytes):
+                decoded.append(LogBatch.decode([
+                    _gather(buffer, field_starts[first:last, col],
+                            field_ends[first:last, col])
+                    for col in range(NR_FIELDS)]))
+            reasons = np.full(len(line_starts), FIELD_COUNT, dtype=np.int8)
+            reasons[complete] = np.concatenate(
+                [batch_reasons for _, batch_reasons in decoded])
+
+            def row_of(idx):
+                line = bytes(buffer[line_starts[idx]:line_ends[idx]])
+                return line.decode("utf-8", "replace").split(",") \
+                    if line else []
+
+            valid_indices(reasons, log_file, first_row_number, row_of,
+                          rejects)
+            first_row_number += len(line_starts)
+            start = end
+            for batch, batch_reasons in decoded:
+                if batch_reasons.any():
+                    # Indices of the kept lines among the complete ones
+                    batch = batch.select(
+                        np.flatnonzero(batch_reasons == VALID))
+                if len(batch):
+                    yield batch
+    finally:
+        # The batches own copies of the bytes, only buffer points in the map
+        del buffer
+        _unmap(mapped)
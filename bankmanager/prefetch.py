@@ -0,0 +1,183 @@
+"""
+Read-ahead of log files.
+
+On slow (eg. network mounted) volumes most of the time of a parse is spent
+waiting on the disk. A Prefetcher reads the next few log files on a small
+thread pool while the current one is parsed, so the parser finds them in
+memory. It keeps at most depth files, and memory_budget bytes, in flight.
+
+io_wait is the time the parser spent on reads : waiting for files read
+ahead, reading the ones that were not, and reading through open (eg. files
+bigger than the memory budget). Mapped logs (see bankmanager.logreader)
+bigger than the budget are paged in as they are parsed, that time cannot be
+told apart from the parse and is not counted.
+"""
+import io
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEPTH = 2
+DEFAULT_MEMORY_BUDGET = 256 << 20  # bytes
+
+
+def _read(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+class _TimedFile(io.RawIOBase):
+    """
+    Raw binary file whose reads are added to a Prefetcher's io_wait
+    """
+    def __init__(self, filename, prefetcher):
+        self._file = io.FileIO(filename, "r")
+        self._prefetcher = prefetcher
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        started = time.perf_counter()
+        count = self._file.readinto(buffer)
+        self._prefetcher._io_wait += time.perf_counter() - started
+        return count
+
+    def close(self):
+        self._file.close()
+        super(_TimedFile, self).close()
+
+
+class Prefetcher(object):
+    """
+    Reads log files ahead of the parser, in the order they are scheduled.
+    """
+    def __init__(self, depth=DEFAULT_DEPTH,
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Parameters
+        ----------
+        depth : int,
+            Number of files read ahead
+        memory_budget : int,
+            Maximum bytes held by files read ahead. A file bigger than that
+            is not read ahead, the parser reads it as usual.
+        """
+        assert depth > 0, "Prefetch depth has to be at least 1"
+        self._depth = depth
+        self._memory_budget = memory_budget
+        self._pool = ThreadPoolExecutor(depth)
+        self._queue = []  # (filename, size) to read, in order
+        self._next = 0  # First entry of _queue not submitted yet
+        self._reading = {}  # filename: (future, size)
+        # (future, size) dropped while being read, their bytes count until
+        # the read is done
+        self._dropped = []
+        self._in_flight = 0  # bytes
+        self._io_wait = 0.0  # seconds
+
+    def schedule(self, filenames):
+        """
+        Adds files to read, after the ones already scheduled. They have to
+        be asked for (see read) in the same order.
+        """
+        for filename in filenames:
+            self._queue.append((filename, os.path.getsize(filename)))
+        self._fill()
+
+    def _fill(self):
+        dropped = []
+        for future, size in self._dropped:
+            if future.done():
+                self._in_flight -= size
+            else:
+                dropped.append((future, size))
+        self._dropped = dropped
+        while self._next < len(self._queue) and \
+                len(self._reading) < self._depth:
+            filename, size = self._queue[self._next]
+            if size > self._memory_budget:
+                self._next += 1
+                continue
+            if self._in_flight + size > self._memory_budget:
+                break
+            self._next += 1
+            self._reading[filename] = (self._pool.submit(_read, filename),
+                                       size)
+            self._in_flight += size
+
+    def read(self, filename):
+        """
+        Returns
+        -------
+        data : bytes,
+            Content of filename, waiting for it if it is still being read,
+            or read now if it was not read ahead yet. None if filename was
+            not scheduled, or is bigger than the memory budget (see open).
+            Scheduled files before filename that were never asked for are
+            dropped.
+        """
+        position = next((idx for idx, (name, _) in enumerate(self._queue)
+                         if name == filename), None)
+        if position is None:
+            return None
+        size = self._queue[position][1]
+        skipped, self._queue = self._queue[:position], \
+            self._queue[position + 1:]
+        self._next = max(self._next - position - 1, 0)
+        for name, _ in skipped:
+            self._release(name)
+        entry = self._reading.get(filename)
+        if entry is None:
+            # The next files are read ahead meanwhile
+            self._fill()
+            if size > self._memory_budget:
+                return None
+            started = time.perf_counter()
+            data = _read(filename)
+            self._io_wait += time.perf_counter() - started
+            return data
+        started = time.perf_counter()
+        data = entry[0].result()
+        self._io_wait += time.perf_counter() - started
+        self._release(filename)
+        self._fill()
+        return data
+
+    def open(self, filename):
+        """
+        Binary file object of filename, its reads are counted in io_wait.
+        For the files read does not return.
+        """
+        return io.BufferedReader(_TimedFile(filename, self))
+
+    def _release(self, filename):
+        entry = self._reading.pop(filename, None)
+        if entry is None:
+            return
+        if entry[0].cancel() or entry[0].done():
+            self._in_flight -= entry[1]
+        else:
+            # Cannot be stopped, the bytes are in memory until it is done
+            self._dropped.append(entry)
+
+    @property
+    def io_wait(self):
+        """
+        Seconds the parser spent on reads, see the module's docstring
+        """
+        return self._io_wait
+
+    def close(self):
+        for filename in list(self._reading):
+            self._release(filename)
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
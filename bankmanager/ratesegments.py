@@ -0,0 +1,136 @@
+"""
+Append-only segments of currency rates, merged into a rates file at the end.
+
+The fake data generator sets a rate for every transaction it makes, so
+holding all of them in a CurrencyRateList until the end makes memory grow
+with the data. RateSegmentWriter keeps at most segment_size rates in
+memory : every time it has that many, they are sorted by time and written
+to a new segment file. merge then reads all the segments at once, in order
+(a k-way merge, the segments being sorted already), and streams out a
+currency_rates.json in the format CurrencyRateList.dump writes.
+
+A segment is a csv file of utc microseconds, date (as given), sequence
+number, currency and rate (as json). The sequence number is the order rates were
+added in, so that when a currency gets two rates at the same date the
+first one is kept, as CurrencyRateList does.
+"""
+import os
+import csv
+import json
+import heapq
+import shutil
+import logging
+import tempfile
+from bankmanager.config import BASE_CURRENCY
+from bankmanager.timestamps import parse_timestamp, epoch_us
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 100000
+
+
+def _read_segment(filename):
+    with open(filename, "r", newline="") as f:
+        for time, date, sequence, currency, rate in csv.reader(f):
+            yield int(time), date, int(sequence), currency, rate
+
+
+class RateSegmentWriter(object):
+    """
+    Collects rates like CurrencyRateList.add_currency_at_date, flushing
+    them to sorted segment files every segment_size rates
+    """
+    def __init__(self, folder=None, segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        Parameters
+        ----------
+        folder : str,
+            Where the segments go, a temporary folder (made on the first
+            flush, removed by merge) if None
+        segment_size : int,
+            Rates kept in memory before they are written
+        """
+        assert segment_size > 0, "Segments have to hold at least one rate"
+        self._folder = folder
+        self._own_folder = folder is None
+        self._segment_size = segment_size
+        self._pending = []
+        self._segments = []
+        self._count = 0
+
+    def add_currency_at_date(self, currency="USD", rate=1,
+                             time="1981-09-15T00:26:36+08:00"):
+        if currency == BASE_CURRENCY:
+            return
+        self._pending.append((epoch_us(parse_timestamp(time)), time,
+                              self._count, currency, json.dumps(rate)))
+        self._count += 1
+        if len(self._pending) >= self._segment_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the rates in memory to a new segment
+        """
+        if not self._pending:
+            return
+        if self._folder is None:
+            self._folder = tempfile.mkdtemp(prefix="currency_rates_")
+        filename = os.path.join(self._folder, "rates_{:06d}.csv".format(
+            len(self._segments)))
+        self._pending.sort()
+        with open(filename, "w", newline="") as f:
+            csv.writer(f).writerows(self._pending)
+        self._segments.append(filename)
+        self._pending = []
+
+    @property
+    def segments(self):
+        return list(self._segments)
+
+    def __len__(self):
+        return self._count
+
+    def merge(self, filename, remove=True):
+        """
+        Writes every rate added so far to filename, as CurrencyRateList.dump
+        would : {date: {currency: rate}}, dates in time order. Only one
+        segment at a time per file is read, one entry each.
+
+        Parameters
+        ----------
+        remove : bool,
+            Delete the segments (and the temporary folder) afterwards. If
+            False, more rates can be added and merged again later.
+        """
+        self.flush()
+        entries = heapq.merge(*[_read_segment(segment)
+                                for segment in self._segments])
+        current_date = None
+        currencies = set()
+        with open(filename, "w") as f:
+            f.write("{")
+            for time, date, sequence, currency, rate in entries:
+                if date != current_date:
+                    # Same date strings are next to each other, they have
+                    # the same time
+                    f.write("}, " if current_date is not None else "")
+                    f.write(json.dumps(date) + ": {")
+                    current_date = date
+                    currencies = set()
+                elif currency in currencies:
+                    continue
+                else:
+                    f.write(", ")
+                f.write("{}: {}".format(json.dumps(currency), rate))
+                currencies.add(currency)
+            f.write("}}" if current_date is not None else "}")
+        logger.info("Merged {} rate segments into {}".format(
+            len(self._segments), filename))
+        if remove:
+            for segment in self._segments:
+                os.remove(segment)
+            if self._own_folder and self._folder is not None:
+                shutil.rmtree(self._folder, ignore_errors=True)
+                self._folder = None
+            self._segments = []
@@ -0,0 +1,194 @@
+"""
+Binary sidecar of a currency rates json file.
+
+Parsing a big currency_rates.json takes long, and has to happen before the
+first transaction can be converted. The sidecar (<json file>.bin) holds the
+same rates, per currency, as sorted arrays of times and rates :-
+
+- magic (8 bytes) and number of currencies (uint32, + 4 bytes padding)
+- per currency : code (8 bytes), first entry and number of entries (uint64)
+- all the times, int64 utc microseconds since epoch, currency after currency
+- all the rates, float64, in the same order
+
+It is memory mapped, so opening it only reads the small index, and the
+arrays of a currency are only paged in when that currency is looked up.
+The sidecar is written again whenever the json file is newer.
+"""
+import os
+import mmap
+import json
+import logging
+import numpy as np
+from bankmanager.config import BASE_CURRENCY
+from bankmanager.timestamps import parse_timestamp, epoch_us
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"BMRATES1"
+SUFFIX = ".bin"
+_HEADER = np.dtype([("magic", "S8"), ("count", "<u4"), ("pad", "<u4")])
+_INDEX = np.dtype([("code", "S8"), ("start", "<u8"), ("count", "<u8")])
+
+
+def store_filename(json_filename):
+    return json_filename + SUFFIX
+
+
+def is_fresh(json_filename, filename=None):
+    """
+    True if the sidecar exists and is not older than the json file
+    """
+    filename = filename or store_filename(json_filename)
+    return os.path.exists(filename) and \
+        os.path.getmtime(filename) >= os.path.getmtime(json_filename)
+
+
+def timelines_from_json(json_filename):
+    """
+    Returns
+    -------
+    timelines : dict,
+        {currency: (times, rates)}, both sorted by time. When a currency
+        has two rates at the same time, the first one in the file is kept,
+        like CurrencyRateList.load does.
+    """
+    with open(json_filename, "r") as f:
+        rates_by_date = json.load(f)
+    entries = {}
+    for date, rates in rates_by_date.items():
+        time = epoch_us(parse_timestamp(date))
+        for currency, rate in rates.items():
+            if currency == BASE_CURRENCY:
+                continue
+            entries.setdefault(currency, ([], []))
+            entries[currency][0].append(time)
+            entries[currency][1].append(float(rate))
+    timelines = {}
+    for currency, (times, rates) in entries.items():
+        times = np.array(times, dtype=np.int64)
+        rates = np.array(rates, dtype=np.float64)
+        order = np.argsort(times, kind="stable")
+        times, rates = times[order], rates[order]
+        first = np.ones(len(times), dtype=bool)
+        first[1:] = times[1:] != times[:-1]
+        timelines[currency] = (times[first], rates[first])
+    return timelines
+
+
+def write_rate_store(timelines, filename):
+    """
+    Writes {currency: (sorted times, rates)} to filename. The file is
+    written aside and moved in place, so readers never see half of it.
+    """
+    currencies = sorted(timelines)
+    header = np.zeros(1, dtype=_HEADER)
+    header["magic"] = MAGIC
+    header["count"] = len(currencies)
+    index = np.zeros(len(currencies), dtype=_INDEX)
+    start = 0
+    for idx, currency in enumerate(currencies):
+        index[idx] = (currency.encode("ascii"), start,
+                      len(timelines[currency][0]))
+        start += len(timelines[currency][0])
+    temporary = "{}.{}.tmp".format(filename, os.getpid())
+    with open(temporary, "wb") as f:
+        f.write(header.tobytes())
+        f.write(index.tobytes())
+        for currency in currencies:
+            f.write(np.asarray(timelines[currency][0],
+                               dtype="<i8").tobytes())
+        for currency in currencies:
+            f.write(np.asarray(timelines[currency][1],
+                               dtype="<f8").tobytes())
+    os.replace(temporary, filename)
+
+
+class RateStore(object):
+    """
+    Read only, memory mapped view of a sidecar file
+    """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Checked on a copy of the header, a view would keep the map open
+        header = np.frombuffer(self._map[:_HEADER.itemsize], dtype=_HEADER)
+        count = int(header["count"][0]) if len(header) else 0
+        size = _HEADER.itemsize + _INDEX.itemsize * count
+        if len(header) == 0 or header["magic"][0] != MAGIC or \
+                len(self._map) < size:
+            self._map.close()
+            raise ValueError("Not a rate store : " + filename)
+        index = np.frombuffer(self._map[_HEADER.itemsize:size], dtype=_INDEX)
+        if len(self._map) < size + 16 * int(index["count"].sum()):
+            self._map.close()
+            raise ValueError("Truncated rate store : " + filename)
+        self._index = {code.decode("ascii"): (int(start), int(entries))
+                       for code, start, entries in index.tolist()}
+        total = int(index["count"].sum())
+        offset = _HEADER.itemsize + _INDEX.itemsize * count
+        self._times = np.frombuffer(self._map, dtype="<i8", count=total,
+                                    offset=offset)
+        self._rates = np.frombuffer(self._map, dtype="<f8", count=total,
+                                    offset=offset + 8 * total)
+
+    @property
+    def currencies(self):
+        return list(self._index)
+
+    def arrays(self, currency):
+        """
+        Returns
+        -------
+        times, rates : np.ndarray, np.ndarray
+            Views into the map, sorted by time. None if the currency has no
+            rates.
+        """
+        entry = self._index.get(currency)
+        if entry is None:
+            return None
+        start, count = entry
+        return self._times[start:start + count], \
+            self._rates[start:start + count]
+
+
+def open_rate_store(json_filename):
+    """
+    Opens the sidecar of json_filename, writing it first if it is missing
+    or older than the json file.
+
+    A fresh sidecar that cannot be read (empty, truncated, other format)
+    is written again, once.
+
+    Returns
+    -------
+    store : RateStore,
+        None if the sidecar cannot be written (eg. read only folder) or
+        read
+    """
+    filename = store_filename(json_filename)
+    written = False
+    if not is_fresh(json_filename, filename):
+        if not _write_store(json_filename, filename):
+            return None
+        written = True
+    try:
+        return RateStore(filename)
+    except (OSError, ValueError) as error:
+        logger.info("Cannot read {} : {}".format(filename, error))
+    if written or not _write_store(json_filename, filename):
+        return None
+    try:
+        return RateStore(filename)
+    except (OSError, ValueError) as error:
+        logger.info("Cannot read {} : {}".format(filename, error))
+        return None
+
+
+def _write_store(json_filename, filename):
+    logger.info("Writing currency rate store " + filename)
+    try:
+        write_rate_store(timelines_from_json(json_filename), filename)
+    except OSError as error:
+        logger.info("Cannot write {} : {}".format(filename, error))
+        return False
+    return True
@@ -0,0 +1,238 @@
+"""
+Reconciliation of interbank transfers.
+
+An external transfer shows up in two logs : the sender's, as an outgoing
+leg, and the receiver's (eg. its _pending.csv), as an incoming leg. Both
+legs carry the same transaction id, amount and currency. Reconciling
+pairs them up : the outgoing legs are put in a hash table on transaction
+id and the incoming legs probe it. A transfer is
+
+- matched : both legs, same amount and currency
+- mismatched : both legs, but the amount or the currency differ
+- one sided : only one leg was found (or more legs of one side than of
+  the other)
+
+Both legs of a transfer are between the same two banks, so the legs are
+first partitioned by (source bank, destination bank), and every pair is
+joined apart : only one pair's legs are ever in the hash table. While the
+logs are read, at most buffer_size legs are held in memory, every time
+there are that many they are appended to one file per bank pair (made in
+a temporary folder on the first flush). Logs small enough never touch the
+disk.
+"""
+import os
+import csv
+import shutil
+import logging
+import tempfile
+from bankmanager.aggregation import OUTGOING, INCOMING
+
+logger = logging.getLogger(__name__)
+
+MATCHED = "matched"
+MISMATCHED = "mismatched"
+ONE_SIDED = "one_sided"
+STATUSES = (MATCHED, MISMATCHED, ONE_SIDED)
+
+DEFAULT_BUFFER_SIZE = 1000000
+
+
+def _bank_of(account_id):
+    return account_id.replace("-", "")[:4].upper()
+
+
+def _read_partition(filename):
+    with open(filename, "r", newline="") as f:
+        for transaction_id, side, amount, currency, bank, log_file in \
+                csv.reader(f):
+            yield transaction_id, int(side), amount, currency, bank, log_file
+
+
+class LegPartitioner(object):
+    """
+    Collects the interbank legs of bank logs, partitioned by bank pair
+    """
+    def __init__(self, folder=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        """
+        Parameters
+        ----------
+        folder : str,
+            Where the partitions go, a temporary folder (made on the first
+            flush, removed by close) if None
+        buffer_size : int,
+            Legs kept in memory before they are written to their partition
+        """
+        assert buffer_size > 0, "The buffer has to hold at least one leg"
+        self._folder = folder
+        self._own_folder = folder is None
+        self._buffer_size = buffer_size
+        # {(source bank, destination bank): [leg]}
+        self._buffers = {}
+        self._buffered = 0
+        self._partitions = {}
+        self._count = 0
+
+    def add(self, bank_code, row, log_file=""):
+        """
+        Keeps the row of bank_code's log as a leg, if it is an interbank
+        transfer of that bank
+
+        Parameters
+        ----------
+        row : sequence,
+            Valid log row : date, transaction_id, source, destination,
+            amount, currency, category
+
+        Returns
+        -------
+        added : bool
+        """
+        source_bank = _bank_of(row[2])
+        destination_bank = _bank_of(row[3])
+        if source_bank == destination_bank:
+            return False
+        if bank_code == source_bank:
+            side = OUTGOING
+        elif bank_code == destination_bank:
+            side = INCOMING
+        else:
+            return False
+        leg = (row[1].replace("-", "").upper(), side, row[4],
+               row[5].upper(), bank_code, log_file)
+        self._buffers.setdefault((source_bank, destination_bank),
+                                 []).append(leg)
+        self._buffered += 1
+        self._count += 1
+        if self._buffered >= self._buffer_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        """
+        Appends the legs in memory to the files of their bank pair
+        """
+        if not self._buffered:
+            return
+        if self._folder is None:
+            self._folder = tempfile.mkdtemp(prefix="reconciliation_")
+        for pair, legs in self._buffers.items():
+            filename = self._partitions.get(pair)
+            if filename is None:
+                filename = self._partitions[pair] = os.path.join(
+                    self._folder, "{}_{}.csv".format(*pair))
+            with open(filename, "a", newline="") as f:
+                csv.writer(f).writerows(legs)
+        self._buffers = {}
+        self._buffered = 0
+
+    def partitions(self):
+        """
+        Yields (bank pair, legs) one bank pair at a time, in pair order
+        """
+        for pair in sorted(set(self._partitions) | set(self._buffers)):
+            legs = self._buffers.get(pair, [])
+            if pair in self._partitions:
+                # Legs on disk came first
+                legs = list(_read_partition(self._partitions[pair])) + legs
+            yield pair, legs
+
+    def close(self):
+        """
+        Removes the partition files (and the temporary folder)
+        """
+        for filename in self._partitions.values():
+            os.remove(filename)
+        if self._own_folder and self._folder is not None:
+            shutil.rmtree(self._folder, ignore_errors=True)
+            self._folder = None
+        self._partitions = {}
+        self._buffers = {}
+        self._buffered = 0
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _same_transfer(outgoing, incoming):
+    try:
+        same_amount = float(outgoing[2]) == float(incoming[2])
+    except ValueError:
+        same_amount = outgoing[2] == incoming[2]
+    return same_amount and outgoing[3] == incoming[3]
+
+
+def join_legs(legs):
+    """
+    Hash join of the outgoing and incoming legs of one bank pair
+
+    Parameters
+    ----------
+    legs : iterable,
+        (transaction_id, side, amount, currency, bank, log_file) tuples
+
+    Yields
+    ------
+    status, outgoing, incoming :
+        One of STATUSES and the legs, None for a missing one. Legs of one
+        transaction id are paired in the order they came.
+    """
+    legs = list(legs)
+    table = {}
+    for leg in legs:
+        if leg[1] == OUTGOING:
+            table.setdefault(leg[0], []).append(leg)
+    for leg in legs:
+        if leg[1] != INCOMING:
+            continue
+        candidates = table.get(leg[0])
+        if not candidates:
+            yield ONE_SIDED, None, leg
+            continue
+        outgoing = candidates.pop(0)
+        yield (MATCHED if _same_transfer(outgoing, leg) else MISMATCHED), \
+            outgoing, leg
+    for candidates in table.values():
+        for outgoing in candidates:
+            yield ONE_SIDED, outgoing, None
+
+
+def reconcile(partitioner):
+    """
+    Joins every bank pair of a LegPartitioner
+
+    Yields
+    ------
+    pair, counts, unmatched :
+        Per bank pair, {status: count} and the (status, outgoing, incoming)
+        of the transfers not matched
+    """
+    for pair, legs in partitioner.partitions():
+        counts = dict.fromkeys(STATUSES, 0)
+        unmatched = []
+        for status, outgoing, incoming in join_legs(legs):
+            counts[status] += 1
+            if status != MATCHED:
+                unmatched.append((status, outgoing, incoming))
+        yield pair, counts, unmatched
+
+
+def unmatched_row(pair, status, outgoing, incoming):
+    """
+    Row of reconciliation.csv : status, transaction id, source and
+    destination banks, then log, amount and currency of the outgoing leg
+    and of the incoming leg (empty when missing)
+    """
+    transaction_id = (outgoing or incoming)[0]
+    row = [status, transaction_id, pair[0], pair[1]]
+    for leg in (outgoing, incoming):
+        if leg is None:
+            row.extend(["", "", ""])
+        else:
+            row.extend([leg[5], leg[2], leg[3]])
+    return row
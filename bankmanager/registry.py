@@ -0,0 +1,62 @@
+"""
+Process wide registry of the small vocabularies transactions are built from.
+
+There are at most 65536 bank codes, less than 200 currencies and usually a
+handful of categories, while there are millions of transactions. Every
+distinct value is validated once, the first time it is seen, and from then
+on the same instance is handed out to everyone.
+"""
+import re
+import logging
+from iso4217 import Currency
+from bankmanager.basebank import BankCode, BankException
+
+logger = logging.getLogger(__name__)
+
+_CATEGORY_RULE = re.compile("^[0-9A-Za-z_.-]*$")
+_CURRENCIES = {}
+_CATEGORIES = {}
+
+
+def bank_code(bankid):
+    """
+    Interned BankCode of a bank id string. BankCode interns itself, this is
+    here so every vocabulary can be reached from one place.
+    """
+    return BankCode(bankid)
+
+
+def currency(code):
+    """
+    Parameters
+    ----------
+    code : str,
+        The iso4217 currency code
+
+    Returns
+    -------
+    currency : iso4217.Currency,
+        Raises a BankException if the code is not an iso4217 currency
+    """
+    currency_obj = _CURRENCIES.get(code)
+    if currency_obj is None:
+        try:
+            currency_obj = Currency(code)
+        except ValueError:
+            logger.debug("Cannot parse currency, Raising an error")
+            raise BankException("Currency Parse error")
+        _CURRENCIES[code] = currency_obj
+    return currency_obj
+
+
+def category(name):
+    """
+    Interned category string, raises a BankException if it contains
+    unacceptable characters
+    """
+    interned = _CATEGORIES.get(name)
+    if interned is None:
+        if _CATEGORY_RULE.match(name) is None:
+            raise BankException("Category contains unnacceptable charecters")
+        interned = _CATEGORIES[name] = name
+    return interned
@@ -0,0 +1,124 @@
+"""
+Prefix sums of a bank's converted amounts, in utc time order.
+
+The daily reports bucket by whole local days. For any other range (eg.
+10:00 to 14:00 over some days) the transactions are sorted by utc time
+once, and the running totals of incoming and outgoing amounts and counts
+are kept : the sums over [t0, t1) are then two binary searches and a
+subtraction.
+
+Float prefix sums grow with the whole list, and subtracting two of them
+would lose the digits of small ranges after large amounts. The rounding
+error of every step of the running sum is kept too (the two-sum of the
+previous prefix and the amount), and added back, so a range sum is as
+precise as summing the range alone. With fixed point amounts the sums
+are exact (the high and low bits are summed apart, as in
+fixedpoint.exact_sum).
+"""
+import numpy as np
+from bankmanager.aggregation import BalanceAccumulator, INTERNAL, OUTGOING, \
+    INCOMING
+from bankmanager.timestamps import parse_timestamp, epoch_us
+
+
+def to_epoch_us(time):
+    """
+    utc microseconds of an int (as is) or an ISO-8061 timestamp
+    """
+    if isinstance(time, str):
+        return epoch_us(parse_timestamp(time))
+    return int(time)
+
+
+def _prefix(values):
+    return np.concatenate(([0], np.cumsum(values)))
+
+
+def _compensated_prefix(values):
+    """
+    Float prefix sums, and the prefix sums of the error each addition made
+    """
+    sums = _prefix(values)
+    previous = sums[:-1]
+    added = sums[1:] - previous
+    errors = (previous - (sums[1:] - added)) + (values - added)
+    return sums, _prefix(errors)
+
+
+class TimeIndex(object):
+    """
+    Transactions sorted by utc time, with prefix sums per direction
+    """
+    def __init__(self, times, directions, amounts, exponent=None):
+        """
+        Parameters
+        ----------
+        times : np.ndarray,
+            int64 utc microseconds of every transaction
+        directions, amounts : np.ndarray, np.ndarray
+            See aggregation.classify_and_convert_many
+        exponent : int,
+            Decimals of the minor units the amounts are in, None for float
+            amounts
+        """
+        order = np.argsort(times, kind="stable")
+        self._times = np.asarray(times, dtype=np.int64)[order]
+        directions = np.asarray(directions)[order]
+        amounts = np.asarray(amounts)[order]
+        self._exponent = exponent
+        self._counts = {}
+        self._sums = {}
+        for direction in (INTERNAL, OUTGOING, INCOMING):
+            mask = directions == direction
+            self._counts[direction] = _prefix(mask.astype(np.int64))
+            if direction == INTERNAL:
+                continue
+            values = amounts * mask
+            if exponent is None:
+                self._sums[direction] = _compensated_prefix(
+                    values.astype(np.float64))
+            else:
+                # The high bits cannot overflow, the other sums are right
+                # modulo 2 ** 64, see fixedpoint.exact_sum
+                self._sums[direction] = (_prefix(values >> 32),
+                                         _prefix(values))
+
+    def _range_sum(self, direction, first, last):
+        if self._exponent is None:
+            sums, errors = self._sums[direction]
+            return float((sums[last] - sums[first]) +
+                         (errors[last] - errors[first]))
+        high, wrapped = self._sums[direction]
+        high = int(high[last] - high[first]) << 32
+        with np.errstate(over="ignore"):
+            low = int(wrapped[last] - wrapped[first]) - high
+        return high + low % (1 << 64)
+
+    def between(self, t0, t1):
+        """
+        Sums and counts of the transactions in [t0, t1)
+
+        Parameters
+        ----------
+        t0, t1 : int or str,
+            utc microseconds or ISO-8061 timestamps
+
+        Returns
+        -------
+        accumulator : BalanceAccumulator
+        """
+        first, last = np.searchsorted(
+            self._times, [to_epoch_us(t0), to_epoch_us(t1)], side="left")
+        last = max(first, last)
+        accumulator = BalanceAccumulator(self._exponent)
+        accumulator.incoming_amount = self._range_sum(INCOMING, first, last)
+        accumulator.outgoing_amount = self._range_sum(OUTGOING, first, last)
+        for direction, field in ((INCOMING, "incoming_count"),
+                                 (OUTGOING, "outgoing_count"),
+                                 (INTERNAL, "internal_count")):
+            counts = self._counts[direction]
+            setattr(accumulator, field, int(counts[last] - counts[first]))
+        return accumulator
+
+    def __len__(self):
+        return len(self._times)
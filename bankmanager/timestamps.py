@@ -0,0 +1,109 @@
+"""
+Timestamp helpers.
+
+The logs (and the fake data generator) always write one layout,
+ISO-8601 with an utc offset, eg. 1995-01-29T03:38:08.727229-05:00.
+That layout is parsed directly, dateutil is only used for anything unusual.
+Times are kept as integer UTC microseconds since 1970-01-01 (epoch_us), so
+they can be compared and bucketed without going back to strings.
+"""
+import datetime
+import dateutil.parser
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_DATE = datetime.date(1970, 1, 1)
+_UTC_EPOCH = _EPOCH.replace(tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+US_PER_SECOND = 1000000
+US_PER_DAY = 86400 * US_PER_SECOND
+
+try:
+    _fromisoformat = datetime.datetime.fromisoformat
+except AttributeError:  # python < 3.7, everything goes through dateutil
+    _fromisoformat = dateutil.parser.parse
+
+
+def parse_timestamp(date):
+    """
+    Parameters
+    ----------
+    date : str,
+        Date in ISO-8061 format.
+
+    Returns
+    -------
+    timestamp : datetime.datetime,
+        Same as dateutil.parser.parse(date), just a lot faster for the
+        layout the logs use
+    """
+    try:
+        return _fromisoformat(date)
+    except ValueError:
+        return dateutil.parser.parse(date)
+
+
+_ZONES = {}
+
+
+def shared_zone(offset):
+    """
+    One datetime.timezone instance per utc offset (in seconds), shared by
+    everything that needs it
+    """
+    zone = _ZONES.get(offset)
+    if zone is None:
+        zone = _ZONES[offset] = datetime.timezone(
+            datetime.timedelta(seconds=offset))
+    return zone
+
+
+def zone_of(timestamp):
+    """
+    Shared timezone of a parsed datetime, None for naive ones
+    """
+    if timestamp.tzinfo is None:
+        return None
+    return shared_zone(utc_offset_seconds(timestamp))
+
+
+def utc_offset_seconds(timestamp):
+    offset = timestamp.utcoffset()
+    if offset is None:
+        return 0
+    return int(offset.total_seconds())
+
+
+def epoch_us(timestamp):
+    """
+    UTC microseconds since 1970-01-01 of a datetime. Naive times are taken
+    as UTC.
+    """
+    utc = timestamp.replace(tzinfo=None) - \
+        datetime.timedelta(seconds=utc_offset_seconds(timestamp))
+    return (utc - _EPOCH) // _MICROSECOND
+
+
+def day_of(epoch, offset=0):
+    """
+    Local date, as days since 1970-01-01, of a utc microsecond timestamp.
+    Works elementwise on NumPy arrays too.
+    """
+    return (epoch + offset * US_PER_SECOND) // US_PER_DAY
+
+
+def render_timestamp(epoch, zone=None):
+    """
+    Inverse of (epoch_us, zone_of), gives back the isoformat string of the
+    original timestamp. zone None renders a naive time.
+    """
+    moment = _UTC_EPOCH + datetime.timedelta(microseconds=int(epoch))
+    if zone is None:
+        return moment.replace(tzinfo=None).isoformat()
+    return moment.astimezone(zone).isoformat()
+
+
+def render_day(day):
+    """
+    Inverse of day_of, days since 1970-01-01 to an ISO date string
+    """
+    return (_EPOCH_DATE + datetime.timedelta(days=int(day))).isoformat()
@@ -1,15 +1,43 @@
 import re
-import dateutil.parser
+import sys
+import datetime
+import functools
+import numpy as np
 from itertools import groupby
-from iso4217 import Currency
 import logging
-from bankmanager.basebank import BankException, BankAccountID
-from bankmanager import config
+from bankmanager.basebank import BankException, BankAccountID, render_hex_id
+from bankmanager.timestamps import parse_timestamp, epoch_us, zone_of, \
+    render_timestamp
+from bankmanager.aggregation import BalanceAccumulator, \
+    classify_and_convert, classify_and_convert_many, aggregate_balances, encode_keys, \
+    derive_keys, DATE, CATEGORY, CURRENCY, WEEKDAY
+from bankmanager.fixedpoint import report_exponent
+from bankmanager.ledger import AccountLedger
+from bankmanager.timeindex import TimeIndex
+from bankmanager import config, registry
 
 logger = logging.getLogger(__name__)
 
+_TRANSACTION_ID_RULE = re.compile(config.BANK_ACCOUNT_RULE)
+
+
+@functools.lru_cache(maxsize=65536)
+def _time_fields(date):
+    """
+    (utc microseconds, shared zone, interned date) of a timestamp string.
+    Rows of a log mostly share a few timestamps, each is parsed once.
+    """
+    timestamp = parse_timestamp(date)
+    return epoch_us(timestamp), zone_of(timestamp), \
+        sys.intern(timestamp.date().isoformat())
+
 
 class Transaction(object):
+    # No per instance __dict__, there are millions of these.
+    # Times are kept as utc microseconds + a shared timezone, ids as ints
+    __slots__ = ("_epoch_us", "_zone", "_date_key", "_source", "_destination",
+                 "_amount", "_id", "_currency", "_category")
+
     def __init__(self, date, source, destination, transaction_id,
                  amount=0, currency="USD", category=None):
         """
@@ -41,32 +69,50 @@ class Transaction(object):
         category : str,
             Some human readable note to attach to the transfer
         """
-        assert float(amount) >= 0, "Cannot transfer negative amounts. "\
-                                   "Stop gaming the system!"
+        # Not an assert, validation has to survive python -O
+        if not float(amount) >= 0:
+            raise BankException("Cannot transfer negative amounts. "
+                                "Stop gaming the system!")
+        self._fill(date, BankAccountID(source), BankAccountID(destination),
+                   transaction_id, amount, currency, category)
 
-        self._date = dateutil.parser.parse(date)
-        self._source = BankAccountID(source)
-        self._destination = BankAccountID(destination)
+    @classmethod
+    def from_valid_row(cls, date, transaction_id, source, destination,
+                       amount, currency, category):
+        """
+        Transaction of a log row (in the log's field order) that
+        bankmanager.validation passed already : the checks of __init__
+        are not run again
+        """
+        transaction = cls.__new__(cls)
+        transaction._fill(date, BankAccountID.from_valid(source),
+                          BankAccountID.from_valid(destination),
+                          transaction_id, amount, currency, category)
+        return transaction
+
+    def _fill(self, date, source, destination, transaction_id, amount,
+              currency, category):
+        # Cached once, so bucketing and rate lookups never parse again
+        self._epoch_us, self._zone, self._date_key = _time_fields(date)
+        self._source = source
+        self._destination = destination
         self._amount = float(amount)
-        self._id = transaction_id
-
-        currency_obj = Currency(currency)
-        if currency_obj is not None:
-            self._currency = currency_obj
+        # Ids in the usual layout are stored as an int, anything else as is
+        if _TRANSACTION_ID_RULE.match(transaction_id) is not None:
+            self._id = int(transaction_id.replace("-", ""), 16)
         else:
-            logger.debug("Cannot parse currency, Raising an error")
-            raise BankException("Currency Parse error")
+            self._id = transaction_id
 
+        # Validated once per distinct value, then shared
+        self._currency = registry.currency(currency)
         self._category = None
         if category is not None:
-            assert len(re.findall("^[0-9A-Za-z_.-]*$", category)) == 1, \
-                "Category contains unnacceptable charecters"
-            self._category = category
+            self._category = registry.category(category)
 
+    # BankCodes are interned, so comparing them is an identity check
     @property
     def internal(self):
-        return (self._source.bankid.bankid ==
-                self._destination.bankid.bankid)
+        return self._source.bankid is self._destination.bankid
 
     # Helper functions to determine if the transaction is an incoming
     # or an outgoing transaction with Respect to a reference_bank_code
@@ -74,13 +120,13 @@ class Transaction(object):
         if self.internal:
             return False
         else:
-            return reference_bank_code.bankid == self._source.bankid.bankid
+            return reference_bank_code is self._source.bankid
 
     def is_incoming(self, reference_bank_code):
         if self.internal:
             return False
         else:
-            return reference_bank_code.bankid == self._destination.bankid.bankid
+            return reference_bank_code is self._destination.bankid
 
     def concerns_bank(self, reference_bank_code):
         """
@@ -95,8 +141,8 @@ class Transaction(object):
         -------
 
         """
-        return (self._destination.bankid == reference_bank_code) or \
-               (self._source.bankid == reference_bank_code)
+        return (self._destination.bankid is reference_bank_code) or \
+               (self._source.bankid is reference_bank_code)
 
     def other_bank(self, bankid):
         assert not self.internal, \
@@ -106,6 +152,20 @@ class Transaction(object):
         if self._destination.bankid.bankid == bankid:
             return self._source.bankid.bankid
 
+    @property
+    def transaction_id(self):
+        if isinstance(self._id, int):
+            return render_hex_id(self._id)
+        return self._id
+
+    @property
+    def source(self):
+        return self._source
+
+    @property
+    def destination(self):
+        return self._destination
+
     @property
     def currency_code(self):
         return self._currency.code
@@ -116,7 +176,7 @@ class Transaction(object):
 
     @property
     def transaction_time(self):
-        return self._date.isoformat()
+        return render_timestamp(self._epoch_us, self._zone)
 
     @property
     def transaction_timezone(self):
@@ -126,16 +186,23 @@ class Transaction(object):
     def transaction_amount_nocurrency(self):
         return self._amount
 
+    @property
+    def epoch_us(self):
+        """
+        UTC microseconds since 1970-01-01
+        """
+        return self._epoch_us
+
     @property
     def transaction_date(self):
-        return dateutil.parser.parse(self.transaction_time).date().isoformat()
+        return self._date_key
 
 
 class TransactionList(object):
     """
     Defines a list of transactions, bank specific
     """
-    def __init__(self, bank, currency_rates=None):
+    def __init__(self, bank, currency_rates=None, fixed_point=False):
         """
         Starts from an empty transaction list per bank
         Parameters
@@ -145,6 +212,10 @@ class TransactionList(object):
 
         currency_rates: instance of CurrencyRateList
             Required to calculate the balance in a unified currency
+
+        fixed_point : bool,
+            Convert to int minor units and sum those exactly, see
+            bankmanager.fixedpoint
         """
         self._transactions = []
         self._transaction_categories = set()
@@ -154,6 +225,20 @@ class TransactionList(object):
         self._amount = None
         self._dates = set()
         self._currency_rates = currency_rates
+        self._fixed_point = fixed_point
+        # {currency_rates: (directions, amounts in base currency)}, see
+        # _conversions
+        self._converted = {}
+        # {dimension: (values, codes)}, see _keys
+        self._keys = {}
+        # Running totals with the list's rates, and the version of the rates
+        # they were converted with, see _running_balance
+        self._running = None
+        self._running_version = None
+        # Per account index, see ledger
+        self._ledger = None
+        # {currency_rates: (version, TimeIndex)}, see time_index
+        self._time_indexes = {}
 
     def add_transaction(self, *args, **kwargs):
         """
@@ -164,12 +249,13 @@ class TransactionList(object):
         self._transactions.append(
             my_transaction
         )
+        self._converted = {}
+        self._keys = {}
+        self._time_indexes = {}
+        self._add_to_running(my_transaction)
         self._currencies.append(my_transaction.currency_code)
         self._transaction_categories.add(my_transaction.category)
-        self._dates.add(
-            dateutil.parser.parse(
-                my_transaction.transaction_time
-            ).date().isoformat())
+        self._dates.add(my_transaction.transaction_date)
 
     def append(self, transaction):
         """
@@ -179,79 +265,239 @@ class TransactionList(object):
         self._transactions.append(
             transaction
         )
+        self._converted = {}
+        self._keys = {}
+        self._time_indexes = {}
+        self._add_to_running(transaction)
         self._currencies.append(transaction.currency_code)
         self._transaction_categories.add(transaction.category)
-        self._dates.add(
-            dateutil.parser.parse(
-                transaction.transaction_time
-            ).date().isoformat())
+        self._dates.add(transaction.transaction_date)
 
     def currencies(self):
         return {key: len(list(group)) for key, group in groupby(self._currencies)}
 
     def calculate_balance(self, currency_rates=None):
         """
-        Calculates balance in the base currency
+        Calculates balance in the base currency. With the list's own rates,
+        this reads the running totals (see _running_balance). With other
+        rates (eg. CrossRates), balance is the one calculated here until
+        the list changes.
+        """
+        if currency_rates is None or currency_rates is self._currency_rates:
+            accumulator = self._running_balance()
+            # balance reads the running totals
+            self._amount = None
+        else:
+            exponent = None
+            if self._fixed_point:
+                exponent = report_exponent(currency_rates)
+            accumulator = BalanceAccumulator(exponent).add_many(
+                *self._conversions(currency_rates))
+            self._amount = accumulator.balance
+        return accumulator.calculate_balance()
+
+    def _rates_version(self):
+        return getattr(self._currency_rates, "version", None)
+
+    def _running_balance(self):
+        """
+        BalanceAccumulator of the whole list with the list's rates. It is
+        made with one walk over the list the first time, then every append
+        adds its transaction to it, so reading it is O(1). It is made again
+        only when the rates changed since (their version differs).
+        """
+        assert self._currency_rates is not None, \
+            "Cannot calculate the balances without date-wise currency rates"
+        version = self._rates_version()
+        if self._running is None or version != self._running_version:
+            if self._running is not None:
+                # Converted with the old rates
+                self._converted.pop(self._currency_rates, None)
+            exponent = None
+            if self._fixed_point:
+                exponent = report_exponent(self._currency_rates)
+            self._running = BalanceAccumulator(exponent).add_many(
+                *self._conversions(self._currency_rates))
+            self._running_version = version
+        return self._running
+
+    def _add_to_running(self, transaction):
+        self._amount = None
+        if self._running is None:
+            return
+        if self._rates_version() != self._running_version:
+            # Made again from scratch on the next read anyway
+            self._running = None
+            return
+        self._running.add(*classify_and_convert(
+            transaction, self.bank.code, self._currency_rates,
+            self._fixed_point))
+
+    def _conversions(self, currency_rates):
+        """
+        Direction and amount in base currency of every transaction, all
+        converted in one batch and kept, per currency_rates, until the list
+        changes
+        """
+        converted = self._converted.get(currency_rates)
+        if converted is None:
+            converted = self._converted[currency_rates] = \
+                classify_and_convert_many(self._transactions, self.bank.code,
+                                          currency_rates, self._fixed_point)
+        return converted
+
+    # Key of a transaction along every dimension, see _dimension_keys
+    _KEY_OF = {
+        DATE: lambda transaction: transaction.transaction_date,
+        CATEGORY: lambda transaction: transaction.category,
+        CURRENCY: lambda transaction: transaction.currency_code
+    }
+
+    def _dimension_keys(self, dimension):
+        """
+        (values, codes) of the key of every transaction along dimension,
+        kept until the list changes
+        """
+        keys = self._keys.get(dimension)
+        if keys is None:
+            if dimension == WEEKDAY:
+                keys = derive_keys(
+                    self._dimension_keys(DATE),
+                    lambda date: datetime.date.fromisoformat(date).weekday())
+            elif dimension in self._KEY_OF:
+                key_of = self._KEY_OF[dimension]
+                keys = encode_keys([key_of(transaction)
+                                    for transaction in self._transactions])
+            else:
+                raise ValueError("Unknown dimension : " + str(dimension))
+            self._keys[dimension] = keys
+        return keys
+
+    def balances(self, currency_rates=None, dimensions=(DATE, CATEGORY)):
+        """
+        Balances of the transactions per date, per category... all in one
+        pass over the converted amounts, without splitting the list (see
+        aggregation.aggregate_balances)
+
+        Parameters
+        ----------
+        currency_rates : instance of CurrencyRateList or CrossRates,
+            The list's rates if None
+        dimensions : sequence,
+            Any of aggregation.DATE, CATEGORY, CURRENCY, WEEKDAY
+
+        Returns
+        -------
+        balances : dict,
+            {dimension: {key: BalanceAccumulator}}
         """
         if currency_rates is None:
             currency_rates = self._currency_rates
         assert currency_rates is not None, \
             "Cannot calculate the balances without date-wise currency rates"
-        self._amount = 0
-        incoming_amount = 0
-        incoming_count = 0
-        outgoing_amount = 0
-        outgoing_count = 0
-        internal_count = 0
-        for tx in self._transactions:
-            if tx.currency_code == config.BASE_CURRENCY:
-                rate = 1
-            else:
-                rate = currency_rates.currency_rate_at_date(
-                    tx.currency_code,
-                    tx.transaction_time
-                )
-            if rate is None:
-                logger.info("We are parsing a currency, whose"
-                            " rate is not defined at that time. "
-                            "Assuming as if it is USD")
-            if tx.internal:
-                internal_count += 1
-                continue
-            elif tx.is_outgoing(self.bank.code):
-                # self._amount -= tx.transaction_amount_nocurrency * rate
-                outgoing_amount += tx.transaction_amount_nocurrency * rate
-                outgoing_count += 1
-            elif tx.is_incoming(self.bank.code):
-                # self._amount += tx.transaction_amount_nocurrency * rate
-                incoming_amount += tx.transaction_amount_nocurrency * rate
-                incoming_count += 1
-            else:
-                assert 1 == 0, "Every transaction has to be internal "\
-                               "or incoming or outgoing"
-        self._amount = incoming_amount - outgoing_amount
-        return (incoming_amount, incoming_count), \
-               (outgoing_amount, outgoing_count), \
-               internal_count
+        exponent = None
+        if self._fixed_point:
+            exponent = report_exponent(currency_rates)
+        directions, amounts = self._conversions(currency_rates)
+        return aggregate_balances(
+            directions, amounts,
+            {dimension: self._dimension_keys(dimension)
+             for dimension in dimensions}, exponent)
+
+    def time_index(self, currency_rates=None):
+        """
+        TimeIndex of the transactions converted with currency_rates (the
+        list's if None), kept until the list or the rates change
+        """
+        if currency_rates is None:
+            currency_rates = self._currency_rates
+        assert currency_rates is not None, \
+            "Cannot calculate the balances without date-wise currency rates"
+        version = getattr(currency_rates, "version", None)
+        cached = self._time_indexes.get(currency_rates)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        if cached is not None:
+            # Converted with the old rates
+            self._converted.pop(currency_rates, None)
+        exponent = None
+        if self._fixed_point:
+            exponent = report_exponent(currency_rates)
+        times = np.fromiter((transaction.epoch_us
+                             for transaction in self._transactions),
+                            dtype=np.int64, count=len(self._transactions))
+        time_index = TimeIndex(times, *self._conversions(currency_rates),
+                               exponent=exponent)
+        self._time_indexes[currency_rates] = (version, time_index)
+        return time_index
+
+    def balance_between(self, t0, t1, currency_rates=None):
+        """
+        Balance of the transactions from t0 (included) to t1 (excluded), in
+        O(log n) once the list is indexed (see time_index)
+
+        Parameters
+        ----------
+        t0, t1 : int or str,
+            utc microseconds or ISO-8061 timestamps
+        """
+        return self.time_index(currency_rates).between(t0, t1).balance
+
+    def convert_with(self, currency_rates):
+        """
+        Converts every transaction with currency_rates (eg. CrossRates of
+        another report currency) now, in one batch. Lists split from this
+        one afterwards (categorize, categorize_by_date) get their share of
+        the conversion.
+        """
+        self._conversions(currency_rates)
 
     @property
     def currency_rates(self):
         return self._currency_rates
 
+    @currency_rates.setter
+    def currency_rates(self, currency_rates):
+        # Rates can come after the transactions, eg. once the currencies in
+        # use are known
+        self._currency_rates = currency_rates
+        self._running = None
+        self._amount = None
+
+    @property
+    def fixed_point(self):
+        return self._fixed_point
+
     @property
     def categories(self):
         return self._transaction_categories
 
     @property
     def balance(self):
-        if self._amount is None:
-            self.calculate_balance()
-        return self._amount
+        """
+        Balance of the last calculate_balance with other rates than the
+        list's, if the list did not change since. Otherwise the one of the
+        running totals.
+        """
+        if self._amount is not None:
+            return self._amount
+        return self._running_balance().balance
 
     @property
     def bank(self):
         return self._bank
 
+    @property
+    def ledger(self):
+        """
+        AccountLedger of the bank's accounts, brought up to date with the
+        transactions appended since it was last read
+        """
+        if self._ledger is None:
+            self._ledger = AccountLedger(self)
+        self._ledger.update()
+        return self._ledger
+
     @property
     def transactions(self):
         return self._transactions
@@ -261,26 +507,40 @@ class TransactionList(object):
         return self._dates
 
     @classmethod
-    def categorize(cls, transaction_list):
-        categorized_transactions = {date: cls(transaction_list.bank,
-                                              transaction_list.currency_rates)
-                                    for date in transaction_list.categories}
-        for curr_transaction in transaction_list.transactions:
-            categorized_transactions[curr_transaction.category].append(
-                curr_transaction
-            )
+    def _group(cls, transaction_list, keys, key_of):
+        """
+        Splits transaction_list by key_of(transaction). When the list has
+        currency rates, every transaction is converted once here, and the
+        groups get their share of the conversions (of the list's rates, and
+        any other rates converted with already).
+        """
+        categorized_transactions = {key: cls(transaction_list.bank,
+                                             transaction_list.currency_rates,
+                                             transaction_list.fixed_point)
+                                    for key in keys}
+        indices = {key: [] for key in keys}
+        for idx, curr_transaction in enumerate(transaction_list.transactions):
+            key = key_of(curr_transaction)
+            categorized_transactions[key].append(curr_transaction)
+            indices[key].append(idx)
+        if transaction_list.currency_rates is not None:
+            transaction_list._conversions(transaction_list.currency_rates)
+        for currency_rates, (directions, amounts) in \
+                transaction_list._converted.items():
+            for key, group in categorized_transactions.items():
+                group._converted[currency_rates] = (directions[indices[key]],
+                                                    amounts[indices[key]])
         return categorized_transactions
 
+    @classmethod
+    def categorize(cls, transaction_list):
+        return cls._group(transaction_list, transaction_list.categories,
+                          lambda transaction: transaction.category)
+
     @classmethod
     def categorize_by_date(cls, transaction_list):
-        categorized_transactions = {date: cls(transaction_list.bank,
-                                              transaction_list.currency_rates)
-                                    for date in transaction_list.dates}
-        for curr_transaction in transaction_list.transactions:
-            categorized_transactions[
-                curr_transaction.transaction_date
-            ].append(curr_transaction)
-        return categorized_transactions
+        return cls._group(transaction_list, transaction_list.dates,
+                          lambda transaction: transaction.transaction_date)
 
 
 
@@ -0,0 +1,294 @@
+"""
+Batch validation of log rows.
+
+Rows are checked a whole chunk at a time, column by column, instead of
+with per row asserts. Each row gets a reason code, 0 (VALID) for rows
+that are fine. Failing rows can be written to a rejects file instead of
+stopping the run.
+"""
+import re
+import csv
+import numpy as np
+from bankmanager import registry
+from bankmanager.basebank import BankException
+from bankmanager.timestamps import parse_timestamp
+
+# date, transaction_id, source, destination, amount, currency, category
+NR_FIELDS = 7
+
+# Reason codes, in the order they are checked
+VALID = 0
+FIELD_COUNT = 1
+BAD_DATE = 2
+BAD_SOURCE_ID = 3
+BAD_DESTINATION_ID = 4
+BAD_AMOUNT = 5
+NEGATIVE_AMOUNT = 6
+BAD_CURRENCY = 7
+BAD_CATEGORY = 8
+REASONS = ("valid", "field_count", "bad_date", "bad_source_id",
+           "bad_destination_id", "bad_amount", "negative_amount",
+           "bad_currency", "bad_category")
+
+# Lookup table from ascii byte to hex nibble, 255 meaning "not a hex digit"
+_HEX_LUT = np.full(256, 255, dtype=np.uint8)
+for _nibble, _char in enumerate(b"0123456789ABCDEF"):
+    _HEX_LUT[_char] = _nibble
+_DASH_COLUMNS = [8, 13, 18, 23]  # Positions of '-' in 8-4-4-4-12 ids
+_HEX_COLUMNS = [col for col in range(36) if col not in _DASH_COLUMNS]
+_ACCOUNT_RULE = re.compile("^[0-9A-F]{32}$")
+_ACCOUNT_MASK = (1 << 64) - 1
+
+
+def decode_account_ids(account_ids):
+    """
+    Converts account id strings to 128 bit integers.
+
+    Ids in the canonical 8-4-4-4-12 layout are decoded on the byte buffer
+    in one go, anything else goes through the same dash stripping as
+    BankAccountID.
+
+    Parameters
+    ----------
+    account_ids : sequence of str or bytes
+
+    Returns
+    -------
+    decoded, valid : np.ndarray, np.ndarray
+        Shape (n, 2) uint64 with the high and low halves of every id, and
+        a bool mask of the ids that are well formed
+    """
+    count = len(account_ids)
+    decoded = np.zeros((count, 2), dtype=np.uint64)
+    if count == 0:
+        return decoded, np.ones(0, dtype=bool)
+    try:
+        raw = np.array(account_ids, dtype="S37")
+    except UnicodeEncodeError:
+        raw = np.array([account_id.encode("ascii", "replace")
+                        for account_id in account_ids], dtype="S37")
+    raw = raw.view(np.uint8).reshape(count, 37)
+    nibbles = _HEX_LUT[raw[:, _HEX_COLUMNS]]
+    valid = (raw[:, 36] == 0) & \
+            (raw[:, _DASH_COLUMNS] == ord("-")).all(axis=1) & \
+            (nibbles != 255).all(axis=1)
+
+    nibbles = nibbles.astype(np.uint64)
+    shift = np.uint64(4)
+    for half in range(2):
+        for col in range(16 * half, 16 * half + 16):
+            decoded[:, half] = (decoded[:, half] << shift) | nibbles[:, col]
+
+    # Rare path, ids with unusual dash placement
+    for row in np.flatnonzero(~valid):
+        accountid = account_ids[row]
+        if isinstance(accountid, bytes):
+            accountid = accountid.decode("ascii", "replace")
+        accountid = "".join(accountid.split("-"))
+        if _ACCOUNT_RULE.match(accountid) is None:
+            decoded[row] = 0
+            continue
+        value = int(accountid, 16)
+        decoded[row, 0] = value >> 64
+        decoded[row, 1] = value & _ACCOUNT_MASK
+        valid[row] = True
+    return decoded, valid
+
+
+def parse_amounts(amounts):
+    """
+    Returns
+    -------
+    parsed, valid : np.ndarray, np.ndarray
+        float64 amounts and a mask of the usable ones. "nan" is not.
+    """
+    try:
+        parsed = np.array(amounts, dtype=np.float64)
+    except ValueError:
+        parsed = np.empty(len(amounts), dtype=np.float64)
+        for idx, amount in enumerate(amounts):
+            try:
+                parsed[idx] = float(amount)
+            except ValueError:
+                parsed[idx] = np.nan
+    return parsed, ~np.isnan(parsed)
+
+
+def distinct_mask(values, check):
+    """
+    Applies check once per distinct value. check raises on bad values.
+
+    Returns
+    -------
+    valid : np.ndarray,
+        bool mask, one entry per value
+    """
+    verdicts = {}
+    valid = np.empty(len(values), dtype=bool)
+    for idx, value in enumerate(values):
+        verdict = verdicts.get(value)
+        if verdict is None:
+            try:
+                check(value)
+                verdict = True
+            except (BankException, ValueError, OverflowError):
+                verdict = False
+            verdicts[value] = verdict
+        valid[idx] = verdict
+    return valid
+
+
+def validate_rows(rows):
+    """
+    Parameters
+    ----------
+    rows : list,
+        Log rows (lists of strings), as returned by csv.reader
+
+    Returns
+    -------
+    reasons : np.ndarray,
+        int8 reason code per row, VALID for good rows. When a row has
+        several problems, the first one in REASONS is reported.
+    """
+    reasons = np.zeros(len(rows), dtype=np.int8)
+    complete = np.array([len(row) == NR_FIELDS for row in rows], dtype=bool)
+    reasons[~complete] = FIELD_COUNT
+    indices = np.flatnonzero(complete)
+    if len(indices) == 0:
+        return reasons
+    if len(indices) == len(rows):
+        columns = list(zip(*rows))
+    else:
+        columns = list(zip(*[rows[idx] for idx in indices]))
+    dates, _, sources, destinations, amounts, currencies, categories = \
+        columns
+
+    amounts, parseable = parse_amounts(amounts)
+    reasons[indices] = first_failures([
+        (BAD_DATE, distinct_mask(dates, parse_timestamp)),
+        (BAD_SOURCE_ID, decode_account_ids(sources)[1]),
+        (BAD_DESTINATION_ID, decode_account_ids(destinations)[1]),
+        (BAD_AMOUNT, parseable),
+        (NEGATIVE_AMOUNT, ~parseable | (amounts >= 0)),
+        (BAD_CURRENCY, distinct_mask(currencies, registry.currency)),
+        (BAD_CATEGORY, distinct_mask(categories, registry.category)),
+    ], len(indices))
+    return reasons
+
+
+def first_failures(checks, count):
+    """
+    Parameters
+    ----------
+    checks : list,
+        (reason, valid mask) pairs, in the order of REASONS
+    count : int,
+        Length of the masks
+
+    Returns
+    -------
+    reasons : np.ndarray,
+        int8, the first failed reason of every entry, VALID if none failed
+    """
+    found = np.zeros(count, dtype=np.int8)
+    # Last assignment wins, so go from the last check to the first
+    for reason, valid in reversed(checks):
+        found[~valid] = reason
+    return found
+
+
+class RejectWriter(object):
+    """
+    Writes rejected rows to a csv file, as
+    log file, row number, reason, then the fields of the row
+    """
+    def __init__(self, filename):
+        self._file = open(filename, "w")
+        self._writer = csv.writer(self._file)
+        self._counts = {}
+
+    def write(self, log_file, row_number, reason, row):
+        self._writer.writerow([log_file, row_number, REASONS[reason]] +
+                              list(row))
+        self._counts[REASONS[reason]] = \
+            self._counts.get(REASONS[reason], 0) + 1
+
+    @property
+    def counts(self):
+        return self._counts
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RejectCollector(list):
+    """
+    Keeps rejects in memory (eg. in a worker process) with the same
+    write(...) as RejectWriter. Entries can be replayed into a RejectWriter.
+    """
+    def write(self, log_file, row_number, reason, row):
+        self.append((log_file, row_number, reason, list(row)))
+
+
+def check_rows(rows, log_file, first_row_number, rejects=None):
+    """
+    Validates a chunk of rows.
+
+    Parameters
+    ----------
+    rows : list,
+        Log rows
+    log_file : str,
+        Name of the log, for the rejects
+    first_row_number : int,
+        Row number (1 based) of rows[0] in the log
+    rejects : RejectWriter or RejectCollector,
+        Where bad rows go. If None, the first bad row raises a BankException
+
+    Returns
+    -------
+    good_rows : list,
+        The valid rows, in order
+    """
+    reasons = validate_rows(rows)
+    if not reasons.any():
+        return rows
+    return [rows[idx] for idx in valid_indices(
+        reasons, log_file, first_row_number, rows.__getitem__, rejects)]
+
+
+def valid_indices(reasons, log_file, first_row_number, row_of,
+                  rejects=None):
+    """
+    Sends the failed rows of a chunk to rejects.
+
+    Parameters
+    ----------
+    reasons : np.ndarray,
+        Reason code of every row of the chunk, see validate_rows
+    row_of : callable,
+        Index in the chunk to the row fields, only called for failed rows
+    rejects : RejectWriter or RejectCollector,
+        If None, the first failed row raises a BankException
+
+    Returns
+    -------
+    indices : np.ndarray,
+        Indices of the valid rows, in order
+    """
+    bad = np.flatnonzero(reasons)
+    if len(bad) and rejects is None:
+        idx = bad[0]
+        raise BankException("{}, row {} : {}".format(
+            log_file, first_row_number + idx, REASONS[reasons[idx]]))
+    for idx in bad:
+        rejects.write(log_file, first_row_number + int(idx),
+                      int(reasons[idx]), row_of(idx))
+    return np.flatnonzero(reasons == VALID)
@@ -17,10 +17,12 @@ import logging
 # My modules
 from bankmanager.transaction import Transaction
 from bankmanager import config
-from bankmanager.currencyrates import CurrencyRateList
+from bankmanager.ratesegments import RateSegmentWriter, DEFAULT_SEGMENT_SIZE
 
 # Store currencies in this dict
-CURRENCY_LIST = CurrencyRateList()
+# Rates go to sorted segment files as they are made, see
+# fake_multibank_transactions
+CURRENCY_LIST = RateSegmentWriter()
 
 # Logger coz why not
 logger = logging.getLogger("Fake Data Generator")
@@ -179,7 +181,10 @@ def write_pending_transactions(filename, pending_bank_transactions):
 
 def fake_multibank_transactions(nr_banks=10, entries_per_bank=10,
                                 logsize=10, output_folder="./",
-                                currency_file="currency_rates.json"):
+                                currency_file="currency_rates.json",
+                                rate_segment_size=DEFAULT_SEGMENT_SIZE):
+    global CURRENCY_LIST
+    CURRENCY_LIST = RateSegmentWriter(segment_size=rate_segment_size)
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
     transaction_faker = Faker()
@@ -261,9 +266,8 @@ def fake_multibank_transactions(nr_banks=10, entries_per_bank=10,
                     name
                 ]
             )
-    CURRENCY_LIST.dump(os.path.join(output_folder,
-                                    currency_file))
-    pass
+    CURRENCY_LIST.merge(os.path.join(output_folder,
+                                     currency_file or "currency_rates.json"))
 
 
 if __name__ == "__main__":
@@ -285,10 +289,15 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--logsize", type=int,
                         default=10,
                         help="Number of transactions per log")
+    parser.add_argument("--rate_segment_size", type=int,
+                        default=DEFAULT_SEGMENT_SIZE,
+                        help="Number of currency rates kept in memory "
+                             "before they are written to a segment")
     args = parser.parse_args()
     transaction_folder = os.path.abspath(args.transaction_folder)
     fake_multibank_transactions(nr_banks=args.banks,
                                 entries_per_bank=args.entries,
                                 logsize=args.logsize,
                                 output_folder=transaction_folder,
-                                currency_file=args.currency_rates)
+                                currency_file=args.currency_rates,
+                                rate_segment_size=args.rate_segment_size)
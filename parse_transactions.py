@@ -9,56 +9,228 @@ Hover down to the if __name__ == "__main__" to understand parameters
 """
 import argparse
 import csv
+import io
 import os
 import logging
+import multiprocessing
+from itertools import islice
 from tqdm import tqdm  # Progress bar coz why not
 from bankmanager.bank import Bank
-from bankmanager.transaction import TransactionList
-from bankmanager.currencyrates import CurrencyRateList
+from bankmanager.transaction import Transaction, TransactionList
+from bankmanager.aggregation import BankAggregate, DATE, CATEGORY
+from bankmanager.incremental import IncrementalState
+from bankmanager.prefetch import Prefetcher
+from bankmanager.validation import check_rows, RejectWriter, RejectCollector
+from bankmanager.reconciliation import LegPartitioner, reconcile, \
+    unmatched_row, STATUSES
+from bankmanager.columnar import ColumnarTransactionList
+from bankmanager import logreader
+from bankmanager.currencyrates import CurrencyRateList, CrossRates
+from bankmanager.ratestore import open_rate_store
+from bankmanager.dailyrates import DailyRates, cache_filename, cache_key
 from bankmanager import config
+from bankmanager import registry
+from bankmanager.basebank import BankException
 
 logger = logging.getLogger("Transaction Parser")
 
 
-def parse_log_file(filename, bank_transaction_list):
-    with open(filename, "r") as f:
+def read_log_batches(filename, rejects=None, batch_size=65536,
+                     use_mmap=False, prefetcher=None):
+    """
+    Yields the rows of a log file in batches of up to batch_size rows.
+    Every batch is validated at once (see bankmanager.validation), and only
+    the valid rows are yielded.
+
+    Parameters
+    ----------
+    rejects : RejectWriter or RejectCollector,
+        Where invalid rows go. If None, an invalid row raises a
+        BankException
+    use_mmap : bool,
+        Split the log on its raw bytes (see bankmanager.logreader), the
+        batches are then LogBatch instances, which iterate as rows too.
+        Logs with quoting still go through csv.reader.
+    prefetcher : instance of Prefetcher,
+        Where the log was read ahead, if it was scheduled there. Its reads
+        are timed by the prefetcher all the same (see Prefetcher.io_wait).
+    """
+    data = None
+    if prefetcher is not None:
+        data = prefetcher.read(filename)
+    if use_mmap:
+        batches = logreader.read_log_batches(filename, rejects, data=data)
+        if batches is not None:
+            logging.info("Parsing log file : " + filename)
+            return batches
+        logging.info("Quoting in {}, using csv.reader".format(filename))
+    if data is None and prefetcher is not None:
+        data = prefetcher.open(filename)
+    return read_csv_batches(filename, rejects, batch_size, data)
+
+
+def read_csv_batches(filename, rejects=None, batch_size=65536, data=None):
+    """
+    csv.reader version of read_log_batches, batches are lists of rows.
+    data is the content of the file if it was read already, or a binary
+    file to read it from.
+    """
+    log_file = os.path.basename(filename)
+    if data is None:
+        log = open(filename, "r")
+    elif isinstance(data, bytes):
+        log = io.TextIOWrapper(io.BytesIO(data))
+    else:
+        log = io.TextIOWrapper(data)
+    with log as f:
         logging.info("Parsing log file : " + filename)
         reader = csv.reader(f)
-        for transaction in reader:
-            date, transaction_id, source_id, \
-            dest_id, amount, currency, category = transaction
+        first_row_number = 1
+        while True:
+            batch = list(islice(reader, batch_size))
+            if not batch:
+                break
+            rows = check_rows(batch, log_file, first_row_number, rejects)
+            first_row_number += len(batch)
+            if rows:
+                yield rows
+
+
+def read_log_rows(filename, rejects=None, use_mmap=False, prefetcher=None):
+    """
+    Yields the valid rows of a log file one at a time
+    """
+    for rows in read_log_batches(filename, rejects, use_mmap=use_mmap,
+                                 prefetcher=prefetcher):
+        for row in rows:
+            yield row
+
+
+def parse_log_file(filename, bank_transaction_list, rejects=None,
+                   use_mmap=False, prefetcher=None):
+    # Rows were validated as they were read, they are not checked again
+    for row in read_log_rows(filename, rejects, use_mmap, prefetcher):
+        bank_transaction_list.append(Transaction.from_valid_row(*row))
+
+
+def parse_log_file_columnar(filename, bank_transaction_list, rejects=None,
+                            use_mmap=False, prefetcher=None,
+                            batch_size=65536):
+    """
+    Same as parse_log_file, but hands the rows over to a
+    ColumnarTransactionList column wise, batch_size rows at a time
+    """
+    for batch in read_log_batches(filename, rejects, batch_size, use_mmap,
+                                  prefetcher):
+        if isinstance(batch, logreader.LogBatch):
+            bank_transaction_list.add_batch(batch)
+            continue
+        dates, _, source_ids, dest_ids, amounts, currencies, \
+        categories = zip(*batch)
+        bank_transaction_list.add_transactions(
+            dates, source_ids, dest_ids, amounts, currencies, categories
+        )
+
+
+def stream_transactions(folder_transaction, log_files, rejects=None,
+                        use_mmap=False, prefetcher=None):
+    """
+    Yields the transactions of a bank's log files one at a time. Nothing
+    holds on to them, memory stays flat however long the logs are.
+    """
+    for transaction_file in log_files:
+        for row in read_log_rows(
+                os.path.join(folder_transaction, transaction_file),
+                rejects, use_mmap, prefetcher):
+            yield Transaction.from_valid_row(*row)
+
+
+def transaction_list_kind(columnar=False):
+    """
+    Returns (transaction list class, log parser) for the chosen storage
+    """
+    if columnar:
+        return ColumnarTransactionList, parse_log_file_columnar
+    return TransactionList, parse_log_file
 
-            bank_transaction_list.add_transaction(
-                date, source_id, dest_id, transaction_id,
-                amount, currency, category
-            )
 
+def read_bank_logs(folder_transaction):
+    """
+    Groups the entries of transactions.csv by bank.
 
-def parse_transaction_file(folder_transaction, currency_rates):
+    Returns
+    -------
+    bank_logs : list,
+        (bank_code, bank_tz, bank_name, [log files]) per bank, in the order
+        banks first appear. Timezone and name are the ones of the first
+        entry, like parse_transaction_file does.
+    """
     filename = os.path.join(folder_transaction, "transactions.csv")
-    transaction_lists = dict()
+    bank_logs = dict()
     with open(filename, "r") as f:
         reader = csv.reader(f)
         for entry in reader:
             date, bank_code, bank_tz, transaction_file, bank_name = entry
-            current_bank = Bank(bank_code,
-                                bank_tz,
-                                bank_name)
-            if bank_code not in transaction_lists.keys():
-                transaction_lists[bank_code] = TransactionList(current_bank,
-                                                               currency_rates)
-            parse_log_file(
-                os.path.join(folder_transaction, transaction_file),
-                transaction_lists[bank_code]
-            )
+            if bank_code not in bank_logs:
+                bank_logs[bank_code] = (bank_code, bank_tz, bank_name, [])
+            bank_logs[bank_code][3].append(transaction_file)
+    return list(bank_logs.values())
+
+
+def parse_transaction_file(folder_transaction, currency_rates,
+                           columnar=False, rejects=None, use_mmap=False,
+                           prefetcher=None, fixed_point=False):
+    filename = os.path.join(folder_transaction, "transactions.csv")
+    transaction_lists = dict()
+    list_class, parse_log = transaction_list_kind(columnar)
+    with open(filename, "r") as f:
+        entries = list(csv.reader(f))
+    if prefetcher is not None:
+        # Logs are read ahead in the order of transactions.csv
+        prefetcher.schedule([os.path.join(folder_transaction, entry[3])
+                             for entry in entries])
+    for entry in entries:
+        date, bank_code, bank_tz, transaction_file, bank_name = entry
+        current_bank = Bank(bank_code,
+                            bank_tz,
+                            bank_name)
+        if bank_code not in transaction_lists.keys():
+            transaction_lists[bank_code] = list_class(current_bank,
+                                                      currency_rates,
+                                                      fixed_point)
+        parse_log(
+            os.path.join(folder_transaction, transaction_file),
+            transaction_lists[bank_code],
+            rejects,
+            use_mmap,
+            prefetcher
+        )
     logger.info("Parsed Transactions in " + filename)
     return transaction_lists
 
 
+def used_currencies(transaction_lists):
+    """
+    Currency codes of all the parsed transactions, from the currency
+    dictionary of every list
+    """
+    currencies = set()
+    for transaction_list in transaction_lists.values():
+        currencies.update(transaction_list.currencies())
+    return currencies
+
+
 def write_bank_details(transaction_lists, filename):
     things_to_write = {}
     for bank_code, transaction_list in transaction_lists.items():
         things_to_write[bank_code] = transaction_list.bank.name
+    write_bank_names(things_to_write, filename)
+
+
+def write_bank_names(things_to_write, filename):
+    """
+    Writes banks.csv from a {bank_code: bank_name} dict
+    """
     with open(filename, 'w') as f:
         writer = csv.writer(f)
         for bank_code in sorted(things_to_write.keys()):
@@ -69,26 +241,45 @@ def write_bank_details(transaction_lists, filename):
 
 def categorize_transactions_for_bank(bankid, all_transactions):
     assert bankid in all_transactions, "Didn't parse transactions for this bank"
-    my_categorized_transactions = TransactionList.categorize(
-        all_transactions[bankid]
+    transaction_list = all_transactions[bankid]
+    my_categorized_transactions = type(transaction_list).categorize(
+        transaction_list
     )
     return my_categorized_transactions
 
 
 def categorize_transactions_for_bank_by_date(bankid, all_transactions):
     assert bankid in all_transactions, "Didn't parse transactions for this bank"
-    my_categorized_transactions = TransactionList.categorize_by_date(
-        all_transactions[bankid]
+    transaction_list = all_transactions[bankid]
+    my_categorized_transactions = type(transaction_list).categorize_by_date(
+        transaction_list
     )
     return my_categorized_transactions
 
 
-def write_daily_balances(bankid, categorized_date_transactions, result_folder,
-                         filename_prefix="_daily_balances.csv"):
+def _calculate_balance(group, currency_rates=None):
+    # Streaming accumulators are in one currency already, they take no rates
+    if currency_rates is None:
+        return group.calculate_balance()
+    return group.calculate_balance(currency_rates)
+
+
+def daily_balance_rows(categorized_date_transactions, currency_rates=None,
+                       currency=config.BASE_CURRENCY):
+    """
+    Rows of _daily_balances.csv, sorted by date
+
+    Parameters
+    ----------
+    currency_rates : instance of CurrencyRateList or CrossRates,
+        Rates to convert with, the ones of the groups if None
+    currency : str,
+        Currency currency_rates convert to, written in every row
+    """
     data_to_write  = []
     for date in categorized_date_transactions.keys():
-        outgoing_amount, incoming_amount, _ = \
-            categorized_date_transactions[date].calculate_balance()
+        outgoing_amount, incoming_amount, _ = _calculate_balance(
+            categorized_date_transactions[date], currency_rates)
         data_to_write.append(
             (date,
              outgoing_amount[0],
@@ -97,25 +288,46 @@ def write_daily_balances(bankid, categorized_date_transactions, result_folder,
              incoming_amount[1]
              )
         )
+    # base currency is the same so not sorting it w.r.t to that
+    return [(data[0], currency,
+             data[1], data[2], data[3], data[4])
+            for data in sorted(data_to_write, key=lambda x: x[0])]
+
 
-    with open(os.path.join(result_folder, bankid + filename_prefix), "w") as f:
+def write_rows(filename, rows):
+    with open(filename, "w") as f:
         writer = csv.writer(f)
-        # base currency is the same so not sorting it w.r.t to that
-        for data in sorted(data_to_write, key=lambda x: x[0]):
-            writer.writerow((data[0], config.BASE_CURRENCY,
-                             data[1], data[2], data[3], data[4]))
+        writer.writerows(rows)
+
+
+def write_daily_balances(bankid, categorized_date_transactions, result_folder,
+                         filename_prefix="_daily_balances.csv"):
+    write_daily_balance_rows(
+        bankid, daily_balance_rows(categorized_date_transactions),
+        result_folder, filename_prefix)
+
+
+def write_daily_balance_rows(bankid, rows, result_folder,
+                             filename_prefix="_daily_balances.csv"):
+    write_rows(os.path.join(result_folder, bankid + filename_prefix), rows)
     logger.info(
         "Written {}.csv with daily balances".format(bankid + filename_prefix)
     )
 
 
-def write_category_balances(bankid, categorized_categorical_transactions,
-                            result_folder,
-                            filename_prefix="_categories.csv"):
+def category_balance_rows(categorized_categorical_transactions,
+                          currency_rates=None,
+                          currency=config.BASE_CURRENCY):
+    """
+    Rows of _categories.csv, sorted by category. Parameters are the same
+    as for daily_balance_rows.
+    """
     data_to_write  = []
     for category in categorized_categorical_transactions.keys():
         outgoing_amount, incoming_amount, internal_count = \
-            categorized_categorical_transactions[category].calculate_balance()
+            _calculate_balance(
+                categorized_categorical_transactions[category],
+                currency_rates)
         data_to_write.append(
             (category,
 
@@ -126,23 +338,453 @@ def write_category_balances(bankid, categorized_categorical_transactions,
              outgoing_amount[1] + incoming_amount[1] + internal_count,
              )
         )
+    # base currency is the same so not sorting it w.r.t to that
+    return [(cat, currency, amount, txcount)
+            for cat, amount, txcount in sorted(data_to_write,
+                                               key=lambda x: x[0])]
 
-    with open(os.path.join(result_folder, bankid + filename_prefix), "w") as f:
-        writer = csv.writer(f)
-        # base currency is the same so not sorting it w.r.t to that
-        for cat, amount, txcount in sorted(data_to_write, key=lambda x: x[0]):
-            writer.writerow(
-                (
-                    cat,
-                    config.BASE_CURRENCY,
-                    amount,
-                    txcount
-                )
-            )
+
+def write_category_balances(bankid, categorized_categorical_transactions,
+                            result_folder,
+                            filename_prefix="_categories.csv"):
+    write_category_balance_rows(
+        bankid, category_balance_rows(categorized_categorical_transactions),
+        result_folder, filename_prefix)
+
+
+def write_category_balance_rows(bankid, rows, result_folder,
+                                filename_prefix="_categories.csv"):
+    write_rows(os.path.join(result_folder, bankid + filename_prefix), rows)
     logger.info("Written {}.csv with category based split balances, for "
                 "bank_name".format(bankid + filename_prefix))
 
 
+def other_report_currencies(report_currencies):
+    """
+    Report currencies in their order, without repeats and without
+    config.BASE_CURRENCY (its reports are always written)
+    """
+    return [currency for currency in dict.fromkeys(report_currencies)
+            if currency != config.BASE_CURRENCY]
+
+
+def report_rates(currency_rates, report_currencies=()):
+    """
+    Returns
+    -------
+    rates : list,
+        (currency, rates) to make the reports with, config.BASE_CURRENCY
+        first, then every other report currency with CrossRates
+    """
+    return [(config.BASE_CURRENCY, currency_rates)] + \
+        [(currency, CrossRates(currency_rates, currency))
+         for currency in other_report_currencies(report_currencies)]
+
+
+def report_rows(transaction_list, report_currencies=()):
+    """
+    Rows of _daily_balances.csv and _categories.csv of a parsed list, in
+    config.BASE_CURRENCY and in every report currency. Every currency
+    converts the whole list in one batch, and fills the date and category
+    tables in one pass over it (see TransactionList.balances), the list is
+    never split. Rows carry their currency, see write_report_rows.
+    """
+    daily_rows, category_rows = [], []
+    for currency, currency_rates in report_rates(
+            transaction_list.currency_rates, report_currencies):
+        balances = transaction_list.balances(currency_rates,
+                                             (DATE, CATEGORY))
+        daily_rows += daily_balance_rows(balances[DATE], currency=currency)
+        category_rows += category_balance_rows(balances[CATEGORY],
+                                               currency=currency)
+    return daily_rows, category_rows
+
+
+def write_report_rows(bankid, daily_rows, category_rows, result_folder,
+                      report_currencies=()):
+    """
+    Writes the rows of config.BASE_CURRENCY to _daily_balances.csv and
+    _categories.csv, and the ones of every other report currency to
+    _daily_balances_<currency>.csv and _categories_<currency>.csv
+    """
+    for currency, suffix in [(config.BASE_CURRENCY, "")] + \
+            [(currency, "_" + currency) for currency in
+             other_report_currencies(report_currencies)]:
+        write_daily_balance_rows(
+            bankid, [row for row in daily_rows if row[1] == currency],
+            result_folder, "_daily_balances{}.csv".format(suffix))
+        write_category_balance_rows(
+            bankid, [row for row in category_rows if row[1] == currency],
+            result_folder, "_categories{}.csv".format(suffix))
+
+
+# Every worker process loads the currency rates once, in _init_worker
+_worker_currency_rates = None
+
+
+def reconcile_transfers(folder_transaction, result_folder, use_mmap=False,
+                        buffer_size=None):
+    """
+    Pairs the outgoing and incoming legs of the interbank transfers of all
+    the logs (see bankmanager.reconciliation). Writes reconciliation.csv,
+    the transfers not matched, and reconciliation_summary.csv, the number
+    of transfers per status and bank pair.
+
+    Returns
+    -------
+    totals : dict,
+        {status: number of transfers}
+    """
+    totals = dict.fromkeys(STATUSES, 0)
+    options = {} if buffer_size is None else {"buffer_size": buffer_size}
+    with LegPartitioner(**options) as partitioner:
+        for bank_code, bank_tz, bank_name, log_files in \
+                read_bank_logs(folder_transaction):
+            for transaction_file in log_files:
+                # Bad rows were reported by the reports already
+                for row in read_log_rows(
+                        os.path.join(folder_transaction, transaction_file),
+                        RejectCollector(), use_mmap):
+                    partitioner.add(bank_code, row, transaction_file)
+        logger.info("Reconciling {} interbank legs".format(len(partitioner)))
+        with open(os.path.join(result_folder, "reconciliation.csv"),
+                  "w") as unmatched_file, \
+                open(os.path.join(result_folder,
+                                  "reconciliation_summary.csv"),
+                     "w") as summary_file:
+            unmatched_writer = csv.writer(unmatched_file)
+            summary_writer = csv.writer(summary_file)
+            for pair, counts, unmatched in reconcile(partitioner):
+                unmatched_writer.writerows(
+                    unmatched_row(pair, *transfer) for transfer in unmatched)
+                summary_writer.writerow(list(pair) + [counts[status] for
+                                                      status in STATUSES])
+                for status in STATUSES:
+                    totals[status] += counts[status]
+    logger.info("Interbank transfers : {}".format(totals))
+    return totals
+
+
+def load_currency_rates(filename_currency, max_staleness=None,
+                        currencies=None, daily_rates=False):
+    """
+    Currency rates of a run, see CurrencyRateList.load_cached. With
+    daily_rates, amounts are converted with the closing rate of their day
+    (see bankmanager.dailyrates), starting from the matrix saved by a
+    previous run if there is one.
+    """
+    currency_list = CurrencyRateList.load_cached(filename_currency,
+                                                 max_staleness, currencies)
+    if daily_rates:
+        currency_list = DailyRates.load(
+            cache_filename(filename_currency), currency_list,
+            cache_key(filename_currency, max_staleness))
+    return currency_list
+
+
+def save_daily_rates(currency_list, filename_currency, max_staleness=None):
+    if isinstance(currency_list, DailyRates):
+        currency_list.save(cache_filename(filename_currency),
+                           cache_key(filename_currency, max_staleness))
+
+
+def _init_worker(filename_currency, max_staleness=None, daily_rates=False):
+    global _worker_currency_rates
+    # Workers only read the saved daily rates, the parent does not save any
+    _worker_currency_rates = load_currency_rates(
+        filename_currency, max_staleness, daily_rates=daily_rates)
+
+
+def bank_reports(folder_transaction, bank_code, bank_tz, bank_name,
+                 log_files, currency_rates, columnar=False, streaming=False,
+                 rejects=None, use_mmap=False, prefetcher=None,
+                 report_currencies=(), fixed_point=False):
+    """
+    Parses all the logs of one bank and computes its reports.
+    Invalid rows go to rejects (see read_log_batches).
+
+    Parameters
+    ----------
+    report_currencies : sequence,
+        Currencies to also report in, besides config.BASE_CURRENCY. The
+        logs are still parsed once.
+    fixed_point : bool,
+        Convert and sum int minor units, see bankmanager.fixedpoint
+
+    Returns
+    -------
+    daily_rows, category_rows : list, list
+        Rows of _daily_balances.csv and _categories.csv, those of every
+        report currency after the config.BASE_CURRENCY ones
+    """
+    current_bank = Bank(bank_code, bank_tz, bank_name)
+    if streaming:
+        # Only running sums per date and per category are kept, one set
+        # per report currency
+        rates = report_rates(currency_rates, report_currencies)
+        aggregates = [BankAggregate(current_bank, rates_of_currency,
+                                    fixed_point=fixed_point)
+                      for _, rates_of_currency in rates]
+        for transaction in stream_transactions(folder_transaction, log_files,
+                                               rejects, use_mmap,
+                                               prefetcher):
+            for aggregate in aggregates:
+                aggregate.add(transaction)
+        daily_rows, category_rows = [], []
+        for (currency, _), aggregate in zip(rates, aggregates):
+            daily_rows += daily_balance_rows(aggregate.by_date,
+                                             currency=currency)
+            category_rows += category_balance_rows(aggregate.by_category,
+                                                   currency=currency)
+        return daily_rows, category_rows
+
+    list_class, parse_log = transaction_list_kind(columnar)
+    transaction_list = list_class(current_bank, currency_rates, fixed_point)
+    for transaction_file in log_files:
+        parse_log(os.path.join(folder_transaction, transaction_file),
+                  transaction_list, rejects, use_mmap, prefetcher)
+    return report_rows(transaction_list, report_currencies)
+
+
+def incremental_bank_reports(folder_transaction, bank_code, bank_tz,
+                             bank_name, log_files, currency_rates, state,
+                             rejects=None, use_mmap=False, prefetcher=None,
+                             report_files=None):
+    """
+    Same as bank_reports(..., streaming=True), but only the log files that
+    are new or changed since the last run are parsed. The partial
+    aggregates of the others come from the state, converted again from
+    their raw amounts where the rates were corrected (state.rate_changes).
+    The rejected rows of every log are saved with its aggregates, those of
+    the logs not parsed again are written to rejects from the state.
+
+    Parameters
+    ----------
+    state : instance of IncrementalState
+    report_files : list,
+        Report files of the bank. If no log was parsed, no bucket changed
+        and the state recorded them as written, (None, None) is returned :
+        the reports do not need writing again.
+    """
+    current_bank = Bank(bank_code, bank_tz, bank_name)
+    saved = state.load_bank(bank_code)
+    partials = {}
+    stale = []
+    for transaction_file in log_files:
+        entry = saved.get(transaction_file)
+        # Without rejects bad rows raise, so logs saved with rejected rows
+        # are parsed again to raise as a full run would
+        if entry is None or not state.unchanged(
+                transaction_file,
+                os.path.join(folder_transaction, transaction_file)) or \
+                (rejects is None and entry.get("rejects")):
+            stale.append(transaction_file)
+            continue
+        partial = BankAggregate.from_dict(current_bank, currency_rates,
+                                          entry)
+        # After a rate correction, logs saved without their raw amounts, or
+        # with raw sums over rates changed in part, are parsed again
+        if state.rate_changes is not None and \
+                not partial.can_reconvert(state.rate_changes):
+            stale.append(transaction_file)
+            continue
+        partials[transaction_file] = partial
+    if prefetcher is not None:
+        prefetcher.schedule([os.path.join(folder_transaction, name)
+                             for name in stale])
+
+    changed = bool(stale) or set(saved) != set(log_files)
+    log_rejects = {}
+    for transaction_file in log_files:
+        filename = os.path.join(folder_transaction, transaction_file)
+        if transaction_file in partials:
+            if state.rate_changes:
+                changed_dates, changed_categories = \
+                    partials[transaction_file].reconvert(
+                        state.rate_changes, currency_rates)
+                changed = changed or bool(changed_dates or
+                                          changed_categories)
+            log_rejects[transaction_file] = \
+                saved[transaction_file].get("rejects", [])
+        else:
+            collector = None if rejects is None else RejectCollector()
+            partials[transaction_file] = BankAggregate(
+                current_bank, currency_rates, keep_raw=True).consume(
+                stream_transactions(folder_transaction, [transaction_file],
+                                    collector, use_mmap, prefetcher))
+            log_rejects[transaction_file] = collector or []
+            state.record(transaction_file, filename)
+        if rejects is not None:
+            for reject in log_rejects[transaction_file]:
+                rejects.write(*reject)
+
+    if not changed:
+        logger.info("Logs and rates of {} unchanged".format(bank_code))
+        if report_files and state.reports_kept(bank_code, report_files):
+            return None, None
+    else:
+        saved = {}
+        for transaction_file in log_files:
+            saved[transaction_file] = partials[transaction_file].to_dict()
+            if log_rejects[transaction_file]:
+                saved[transaction_file]["rejects"] = \
+                    list(log_rejects[transaction_file])
+        state.save_bank(bank_code, saved)
+
+    aggregate = BankAggregate(current_bank, currency_rates)
+    for transaction_file in log_files:
+        aggregate.merge(partials[transaction_file])
+    return daily_balance_rows(aggregate.by_date), \
+        category_balance_rows(aggregate.by_category)
+
+
+def report_filenames(bankid, result_folder):
+    """
+    Paths of the config.BASE_CURRENCY reports of a bank, see
+    write_report_rows
+    """
+    return [os.path.join(result_folder, bankid + name)
+            for name in ("_daily_balances.csv", "_categories.csv")]
+
+
+def streaming_bank_reports(folder_transaction, currency_rates, state=None,
+                           rejects=None, use_mmap=False, prefetcher=None,
+                           report_currencies=(), fixed_point=False,
+                           result_folder=None):
+    """
+    Computes the reports bank after bank, keeping only running sums.
+    With a state (instance of IncrementalState), only new or changed log
+    files are parsed, see incremental_bank_reports. Report currencies and
+    fixed point (see bank_reports) are only available without a state.
+    Yields (bank_code, bank_name, daily_rows, category_rows).
+
+    With a state and the result_folder the reports go to, the rows of a
+    bank whose reports there are up to date are None. The reports yielded
+    have to be written (see write_report_rows) before the next bank is
+    asked for, the state records them then.
+    """
+    bank_logs = read_bank_logs(folder_transaction)
+    if prefetcher is not None and state is None:
+        prefetcher.schedule([os.path.join(folder_transaction, name)
+                             for bank in bank_logs for name in bank[3]])
+    log_files_seen = []
+    for bank_code, bank_tz, bank_name, log_files in bank_logs:
+        logger.info("On bank id: " + bank_code)
+        if state is None:
+            daily_rows, category_rows = bank_reports(
+                folder_transaction, bank_code, bank_tz, bank_name,
+                log_files, currency_rates, streaming=True, rejects=rejects,
+                use_mmap=use_mmap, prefetcher=prefetcher,
+                report_currencies=report_currencies, fixed_point=fixed_point)
+            yield bank_code, bank_name, daily_rows, category_rows
+            continue
+        log_files_seen.extend(log_files)
+        report_files = None
+        if result_folder is not None:
+            report_files = report_filenames(bank_code, result_folder)
+        daily_rows, category_rows = incremental_bank_reports(
+            folder_transaction, bank_code, bank_tz, bank_name,
+            log_files, currency_rates, state, rejects, use_mmap,
+            prefetcher, report_files)
+        yield bank_code, bank_name, daily_rows, category_rows
+        if report_files is not None and daily_rows is not None:
+            state.record_reports(bank_code, report_files)
+    if state is not None:
+        state.retain(log_files_seen)
+        state.save()
+
+
+def _process_bank(job):
+    """
+    Computes the reports of one bank in a worker. Only plain rows go back
+    to the parent, not the transactions.
+    """
+    folder_transaction, bank_code, bank_tz, bank_name, log_files, \
+        columnar, streaming, collect_rejects, use_mmap, prefetch, \
+        report_currencies, fixed_point = job
+    rejects = RejectCollector() if collect_rejects else None
+    misses = _worker_currency_rates.misses
+    prefetcher = None
+    if prefetch is not None:
+        prefetcher = Prefetcher(*prefetch)
+        prefetcher.schedule([os.path.join(folder_transaction, name)
+                             for name in log_files])
+    try:
+        daily_rows, category_rows = bank_reports(
+            folder_transaction, bank_code, bank_tz, bank_name, log_files,
+            _worker_currency_rates, columnar, streaming, rejects, use_mmap,
+            prefetcher, report_currencies, fixed_point)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    stats = {
+        "io_wait": prefetcher.io_wait if prefetcher is not None else 0.0,
+        "rate_misses": _worker_currency_rates.misses - misses
+    }
+    return bank_code, bank_name, daily_rows, category_rows, rejects, stats
+
+
+def process_banks_parallel(folder_transaction, filename_currency, workers,
+                           columnar=False, streaming=False, rejects=None,
+                           use_mmap=False, prefetch=None,
+                           max_staleness=None, daily_rates=False,
+                           report_currencies=(), fixed_point=False):
+    """
+    Shards the banks of transactions.csv over a pool of worker processes,
+    every bank being parsed and summarized by a single worker.
+    Yields (bank_code, bank_name, daily_rows, category_rows) as banks finish.
+    Invalid rows found by the workers are written to rejects here.
+
+    Parameters
+    ----------
+    prefetch : tuple,
+        (depth, memory_budget) of the Prefetcher each worker reads its
+        bank's logs with. None reads the logs as they are parsed.
+    max_staleness : float,
+        Seconds a currency rate stays valid for, see CurrencyRateList
+    daily_rates : bool,
+        Convert with the closing rate of the day, see load_currency_rates
+    report_currencies : sequence,
+        Currencies to also report in, see bank_reports
+    fixed_point : bool,
+        Convert and sum int minor units, see bank_reports. The reports are
+        then the same as those of a serial run, to the last digit.
+    """
+    bank_logs = read_bank_logs(folder_transaction)
+
+    def log_size(bank):
+        return sum(os.path.getsize(os.path.join(folder_transaction, name))
+                   for name in bank[3])
+
+    # Biggest banks first, so one huge bank does not start last
+    jobs = [(folder_transaction,) + bank +
+            (columnar, streaming, rejects is not None, use_mmap, prefetch,
+             tuple(report_currencies), fixed_point)
+            for bank in sorted(bank_logs, key=log_size, reverse=True)]
+    # Write the rate store once here, not in every worker at the same time
+    open_rate_store(filename_currency)
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(filename_currency, max_staleness,
+                                          daily_rates))
+    stats = {"io_wait": 0.0, "rate_misses": 0}
+    try:
+        for result in pool.imap_unordered(_process_bank, jobs):
+            if rejects is not None:
+                for reject in result[4]:
+                    rejects.write(*reject)
+            for key, value in result[5].items():
+                stats[key] += value
+            yield result[:4]
+        if prefetch is not None:
+            logger.info("Workers waited {:.3f}s on log reads".format(
+                stats["io_wait"]))
+        logger.info("Currency rate lookups without a rate : {}".format(
+            stats["rate_misses"]))
+    finally:
+        pool.close()
+        pool.join()
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     parser = argparse.ArgumentParser("Transaction parser."
@@ -159,7 +801,85 @@ if __name__ == "__main__":
                         help="The name of the currency rates file. This path "
                              "is relative to current folder, and *not* "
                              "relative to transaction folder")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of worker processes. Banks are "
+                             "spread over the workers, 1 parses everything "
+                             "in this process")
+    storage = parser.add_mutually_exclusive_group()
+    storage.add_argument("--columnar", action="store_true",
+                         help="Store transactions in NumPy columns instead "
+                              "of one object per transaction. Faster and "
+                              "lighter for large logs")
+    storage.add_argument("--streaming", action="store_true",
+                         help="Do not keep transactions at all, only "
+                              "running sums per date and category. Memory "
+                              "does not grow with the size of the logs")
+    parser.add_argument("-s", "--state_folder", type=str, default=None,
+                        help="Folder for the manifest of processed log "
+                             "files and their partial aggregates. When "
+                             "given, re-runs only parse new or changed "
+                             "log files")
+    parser.add_argument("--rejects", type=str, default=None,
+                        help="Write invalid log rows, with the reason, to "
+                             "this csv file instead of stopping at the "
+                             "first one")
+    parser.add_argument("--mmap", action="store_true",
+                        help="Read the logs through a memory map, splitting "
+                             "lines and fields on the raw bytes instead of "
+                             "with csv.reader. Logs with quoting still use "
+                             "csv.reader")
+    parser.add_argument("--rate_staleness", type=float, default=None,
+                        help="Seconds a currency rate stays valid for. A "
+                             "transaction with no rate that recent is "
+                             "taken as in the base currency. By default "
+                             "the last rate before a transaction is used, "
+                             "however old")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="Number of log files read ahead, on a thread "
+                             "pool, while the current one is parsed. 0 "
+                             "reads every log as it is parsed")
+    parser.add_argument("--prefetch_memory", type=int, default=256,
+                        help="Megabytes of log files read ahead at most, "
+                             "bigger logs are read as they are parsed")
+    parser.add_argument("--daily_rates", action="store_true",
+                        help="Convert amounts with the closing rate (utc) "
+                             "of their day instead of the rate at their "
+                             "time. The day x currency rates are saved next "
+                             "to the currency rates file for the next run")
+    parser.add_argument("--report_currencies", type=str, default="",
+                        help="Comma separated currencies to also write the "
+                             "reports in, eg. USD,EUR,GBP, with cross rates "
+                             "through the base currency. Their files are "
+                             "suffixed by the currency")
+    parser.add_argument("--fixed_point", action="store_true",
+                        help="Keep amounts as integer minor units of their "
+                             "currency (cents...) and convert and sum them "
+                             "exactly, instead of in floating point")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="Also pair the outgoing and incoming legs of "
+                             "interbank transfers across the logs, and write "
+                             "the unmatched ones to reconciliation.csv")
+    parser.add_argument("--reconcile_buffer", type=int, default=None,
+                        help="Legs kept in memory while reconciling before "
+                             "they are written to per bank pair files")
     args = parser.parse_args()
+    if args.state_folder and (args.workers > 1 or args.columnar):
+        parser.error("--state_folder runs in a single process and keeps "
+                     "running sums only, it cannot be combined with "
+                     "--workers or --columnar")
+    report_currencies = other_report_currencies(
+        currency.strip().upper() for currency in
+        args.report_currencies.split(",") if currency.strip())
+    for currency in report_currencies:
+        try:
+            registry.currency(currency)
+        except BankException:
+            parser.error("Not an iso4217 currency : " + currency)
+    if args.state_folder and report_currencies:
+        parser.error("--report_currencies cannot be combined with "
+                     "--state_folder")
+    if args.state_folder and args.fixed_point:
+        parser.error("--fixed_point cannot be combined with --state_folder")
 
     result_folder = os.path.abspath(args.result_folder)
 
@@ -175,35 +895,102 @@ if __name__ == "__main__":
     else:
         filename_currency = args.currency_rates
 
-    currency_list = CurrencyRateList.load(
-        filename_currency
-    )
-
-    all_transaction_lists = \
-        parse_transaction_file(os.path.abspath(args.transaction_folder),
-                               currency_list)
+    transaction_folder = os.path.abspath(args.transaction_folder)
+    rejects = RejectWriter(args.rejects) if args.rejects else None
+    prefetch = None
+    prefetcher = None
+    if args.prefetch > 0:
+        prefetch = (args.prefetch, args.prefetch_memory << 20)
+        if args.workers <= 1:
+            prefetcher = Prefetcher(*prefetch)
 
-    logger.info("Writing Bank details to banks.csv")
-    write_bank_details(
-        all_transaction_lists,
-        os.path.join(result_folder, "banks.csv")
-    )
+    if args.workers > 1:
+        logger.info("Processing banks with {} workers".format(args.workers))
+        reports = process_banks_parallel(transaction_folder,
+                                         filename_currency,
+                                         args.workers,
+                                         columnar=args.columnar,
+                                         streaming=args.streaming,
+                                         rejects=rejects,
+                                         use_mmap=args.mmap,
+                                         prefetch=prefetch,
+                                         max_staleness=args.rate_staleness,
+                                         daily_rates=args.daily_rates,
+                                         report_currencies=report_currencies,
+                                         fixed_point=args.fixed_point)
+    elif args.state_folder or args.streaming:
+        state = None
+        if args.state_folder:
+            state = IncrementalState(os.path.abspath(args.state_folder))
+            state.check_currency_rates(filename_currency,
+                                       args.rate_staleness, args.daily_rates)
+        logger.info("Streaming daily and categorical balances")
+        currency_list = load_currency_rates(
+            filename_currency, args.rate_staleness,
+            daily_rates=args.daily_rates)
+        reports = streaming_bank_reports(
+            transaction_folder, currency_list, state, rejects, args.mmap,
+            prefetcher, report_currencies, args.fixed_point, result_folder)
+    else:
+        reports = None
 
-    logger.info("Processing daily and categorical balances")
-    for bank_id in tqdm(list(all_transaction_lists.keys())):
-        logger.info("On bank id: " + bank_id)
-        categorized_bank_transactions = categorize_transactions_for_bank_by_date(
-            bank_id,
-            all_transaction_lists,
+    if reports is not None:
+        bank_names = {}
+        for bank_id, bank_name, daily_rows, category_rows in tqdm(reports):
+            bank_names[bank_id] = bank_name
+            if daily_rows is None:
+                logger.info("Reports of {} up to date".format(bank_id))
+                continue
+            write_report_rows(bank_id, daily_rows, category_rows,
+                              result_folder, report_currencies)
+        logger.info("Writing Bank details to banks.csv")
+        write_bank_names(bank_names,
+                         os.path.join(result_folder, "banks.csv"))
+    else:
+        # Logs first, so only the rates of the currencies in them are loaded
+        all_transaction_lists = \
+            parse_transaction_file(transaction_folder,
+                                   None,
+                                   columnar=args.columnar,
+                                   rejects=rejects,
+                                   use_mmap=args.mmap,
+                                   prefetcher=prefetcher,
+                                   fixed_point=args.fixed_point)
+        currency_list = load_currency_rates(
+            filename_currency,
+            args.rate_staleness,
+            used_currencies(all_transaction_lists),
+            args.daily_rates
         )
-        write_daily_balances(bank_id,
-                             categorized_bank_transactions,
-                             result_folder)
-        categorized_bank_transactions = categorize_transactions_for_bank(
-            bank_id,
+        for transaction_list in all_transaction_lists.values():
+            transaction_list.currency_rates = currency_list
+
+        logger.info("Writing Bank details to banks.csv")
+        write_bank_details(
             all_transaction_lists,
+            os.path.join(result_folder, "banks.csv")
         )
-        write_category_balances(bank_id,
-                                categorized_bank_transactions,
-                                result_folder)
-    pass
\ No newline at end of file
+
+        logger.info("Processing daily and categorical balances")
+        for bank_id in tqdm(list(all_transaction_lists.keys())):
+            logger.info("On bank id: " + bank_id)
+            daily_rows, category_rows = report_rows(
+                all_transaction_lists[bank_id], report_currencies)
+            write_report_rows(bank_id, daily_rows, category_rows,
+                              result_folder, report_currencies)
+
+    if args.workers <= 1:
+        logger.info("Currency rate lookups without a rate : {}".format(
+            currency_list.misses))
+        save_daily_rates(currency_list, filename_currency,
+                         args.rate_staleness)
+    if prefetcher is not None:
+        prefetcher.close()
+        logger.info("Waited {:.3f}s on log reads".format(prefetcher.io_wait))
+    if args.reconcile:
+        logger.info("Reconciling interbank transfers")
+        reconcile_transfers(transaction_folder, result_folder, args.mmap,
+                            args.reconcile_buffer)
+    if rejects is not None:
+        rejects.close()
+        logger.info("Rejected rows : {}".format(rejects.counts))
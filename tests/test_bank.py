@@ -3,6 +3,7 @@ This file tests the different components of bankmanager.
 """
 # Path magic to get pytest to work sanely
 import sys
+import csv
 import os
 pth = os.path.dirname(__file__)
 pth = os.path.join(pth, "..")
@@ -15,11 +16,15 @@ import datetime
 from bankmanager.basebank import BankCode, BankZone
 from bankmanager.transaction import Transaction, TransactionList
 from bankmanager.currencyrates import CurrencyRateList
+from bankmanager.columnar import ColumnarTransactionList
+from bankmanager.timestamps import parse_timestamp, epoch_us
+import dateutil.parser
 from rstr import xeger
 from bankmanager import config
 import random
 from iso4217 import Currency
 from bankmanager import bank
+from bankmanager import registry
 
 def gen_transaction(bankid, incoming=True, outgoing=False):
     if incoming:
@@ -64,6 +69,35 @@ def gen_agnostic_data(currency_list, date):
     return amount, currency, category, currency_list
 
 
+def write_fake_transaction_folder(folder, nr_banks=3, nr_logs=2, logsize=20):
+    """
+    Writes a small transactions.csv, its logs and currency_rates.json
+    """
+    currency_list = CurrencyRateList()
+    bank_ids = [gen_bank_id() for bankidx in range(nr_banks)]
+    with open(os.path.join(folder, "transactions.csv"), "w") as f:
+        for bankid in bank_ids:
+            timezone = gen_timezone()
+            for logidx in range(nr_logs):
+                date = Faker().iso8601() + timezone
+                log_name = "{}_{:04d}.csv".format(bankid, logidx)
+                with open(os.path.join(folder, log_name), "w") as log:
+                    for txcount in range(logsize):
+                        amount, currency, category, currency_list = \
+                            gen_agnostic_data(currency_list, date)
+                        transaction_id, source_id, dest_id = \
+                            gen_transaction(bankid, *random.choice([
+                                (True, True), (True, False), (False, True)
+                            ]))
+                        log.write(",".join((date, transaction_id, source_id,
+                                            dest_id, amount, currency,
+                                            category)) + "\n")
+                f.write(",".join((date, bankid, "UTC" + timezone, log_name,
+                                  "Fake Bank")) + "\n")
+    currency_list.dump(os.path.join(folder, "currency_rates.json"))
+    return bank_ids
+
+
 def test_bank_code():
     for trials in range(0,10):
         assert BankCode(gen_bank_id()), "Bank Code cannot " \
@@ -73,6 +107,26 @@ def test_bank_code():
                 "Bank Code should not be instantiated"
 
 
+def test_registry():
+    bankid = gen_bank_id()
+    assert BankCode(bankid) is BankCode(bankid)
+    assert registry.bank_code(bankid) is BankCode(bankid)
+    assert registry.currency("EUR") is registry.currency("".join("EUR"))
+    assert registry.category("".join("Groceries")) is \
+        registry.category("Groceries")
+    with pytest.raises(Exception):
+        registry.currency("ZZZ")
+    with pytest.raises(Exception):
+        registry.category("Not a category!")
+
+    transaction_id, source_id, dest_id = gen_transaction(bankid, True, True)
+    tx = Transaction(Faker().iso8601() + gen_timezone(), source_id, dest_id,
+                     transaction_id, 10, "EUR", "Groceries")
+    assert tx.source.bankid is tx.destination.bankid
+    assert tx.internal
+    assert tx.concerns_bank(BankCode(bankid))
+
+
 def test_bank_zone():
     for trials in range(0,10):
         tzone = pytz.timezone(Faker().timezone()).localize(
@@ -129,6 +183,15 @@ def test_transaction():
             amount, currency, category
         ).internal, "Cannot instantiate Transaction"
 
+        # From a validated log row, same fields
+        checked = Transaction(date, source_id, dest_id, transaction_id,
+                              str(amount), currency, category)
+        trusted = Transaction.from_valid_row(date, transaction_id, source_id,
+                                             dest_id, str(amount), currency,
+                                             category)
+        for field in Transaction.__slots__:
+            assert getattr(trusted, field) == getattr(checked, field)
+
 
 def test_multiple_transactions():
     my_bankid = gen_bank_id()
@@ -296,4 +359,1335 @@ def test_categorization():
 
     for date, txlist in TransactionList.categorize_by_date(txlist1).items():
         for tx in txlist.transactions:
-            assert date == tx.transaction_date, "Categorization by has failed"
\ No newline at end of file
+            assert date == tx.transaction_date, "Categorization by has failed"
+
+
+def deep_size(objects):
+    """
+    Bytes used by objects and everything they reference through __slots__
+    or __dict__. Shared objects are only counted once.
+    """
+    seen = set()
+    total = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        if isinstance(obj, dict):
+            stack.extend(obj.values())
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return total
+
+
+def test_transaction_memory():
+    my_bankid = gen_bank_id()
+    date = Faker().iso8601() + gen_timezone()
+    transactions = []
+    for txcount in range(0, 1000):
+        transaction_id, source_id, dest_id = gen_transaction(my_bankid,
+                                                             True, True)
+        # Fresh strings, like the csv reader would hand them over
+        transactions.append(Transaction(
+            date, source_id, dest_id, transaction_id,
+            str(random.random() * 1000), "EUR", "".join("Groceries")
+        ))
+    for tx in transactions:
+        assert not hasattr(tx, "__dict__")
+    bytes_per_transaction = deep_size(transactions) / len(transactions)
+    assert bytes_per_transaction < 450, \
+        "Transactions take {} bytes".format(bytes_per_transaction)
+
+
+def test_parse_timestamp():
+    dates = [Faker().iso8601() + gen_timezone() for trial in range(0, 10)]
+    dates += ["1995-01-29T03:38:08.727229-05:00", "2019-08-06 19:58:59Z",
+              "Tue Aug 6 19:58:59 2019 +0200", "1969-12-31T23:59:59+00:00"]
+    for date in dates:
+        expected = dateutil.parser.parse(date)
+        assert parse_timestamp(date) == expected
+        assert parse_timestamp(date).isoformat() == expected.isoformat()
+        assert epoch_us(parse_timestamp(date)) == \
+            round(expected.timestamp() * 1000000)
+
+
+def test_columnar_transaction_list():
+    my_bankid = gen_bank_id()
+    my_bank = bank.Bank(
+        my_bankid,
+        "UTC" + gen_timezone()
+    )
+    txlist = TransactionList(my_bank)
+    columnar = ColumnarTransactionList(my_bank)
+    currency_list = CurrencyRateList()
+    rows = []
+    for txcount in range(0, 50):
+        date = Faker().iso8601() + gen_timezone()
+        amount, currency, category, currency_list = \
+            gen_agnostic_data(currency_list, date)
+        my_tx_type = random.choice([
+            (True, True),  # Internal
+            (True, False),  # Incoming
+            (False, True)  # Outgoing
+        ])
+        transaction_id, source_id, dest_id = gen_transaction(my_bankid,
+                                                             my_tx_type[0],
+                                                             my_tx_type[1])
+        txlist.add_transaction(date, source_id, dest_id, transaction_id,
+                               amount, currency, category)
+        rows.append((date, source_id, dest_id, amount, currency, category))
+    columnar.add_transactions(*zip(*rows))
+
+    assert len(columnar) == len(txlist.transactions)
+    assert columnar.calculate_balance(currency_list) == \
+        txlist.calculate_balance(currency_list)
+    assert columnar.categories == txlist.categories
+    assert columnar.dates == txlist.dates
+
+    for grouping in ["categorize", "categorize_by_date"]:
+        expected = getattr(TransactionList, grouping)(txlist)
+        grouped = getattr(ColumnarTransactionList, grouping)(columnar)
+        assert grouped.keys() == expected.keys()
+        for key, sublist in grouped.items():
+            assert sublist.calculate_balance(currency_list) == \
+                expected[key].calculate_balance(currency_list)
+
+    with pytest.raises(Exception):
+        columnar.add_transactions([date], [source_id], [dest_id], ["-1"],
+                                  [currency], [category])
+
+
+
+def test_parallel_parse(tmp_path):
+    import parse_transactions
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder)
+    filename_currency = os.path.join(folder, "currency_rates.json")
+    serial = parse_transactions.parse_transaction_file(
+        folder, CurrencyRateList.load(filename_currency))
+    reports = list(parse_transactions.process_banks_parallel(
+        folder, filename_currency, 2))
+    assert len(reports) == len(serial)
+    for bankid, bank_name, daily_rows, category_rows in reports:
+        assert daily_rows == parse_transactions.daily_balance_rows(
+            TransactionList.categorize_by_date(serial[bankid]))
+        assert category_rows == parse_transactions.category_balance_rows(
+            TransactionList.categorize(serial[bankid]))
+
+
+
+def test_streaming_reports(tmp_path):
+    import parse_transactions
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder)
+    currency_list = CurrencyRateList.load(
+        os.path.join(folder, "currency_rates.json"))
+    serial = parse_transactions.parse_transaction_file(folder, currency_list)
+    for bank_entry in parse_transactions.read_bank_logs(folder):
+        daily_rows, category_rows = parse_transactions.bank_reports(
+            folder, *bank_entry, currency_list, streaming=True)
+        txlist = serial[bank_entry[0]]
+        assert daily_rows == parse_transactions.daily_balance_rows(
+            TransactionList.categorize_by_date(txlist))
+        assert category_rows == parse_transactions.category_balance_rows(
+            TransactionList.categorize(txlist))
+
+
+
+def test_incremental_reports(tmp_path, monkeypatch):
+    import parse_transactions
+    from bankmanager.incremental import IncrementalState
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder)
+    filename_currency = os.path.join(folder, "currency_rates.json")
+    currency_list = CurrencyRateList.load(filename_currency)
+    state_folder = os.path.join(folder, "state")
+
+    def run():
+        state = IncrementalState(state_folder)
+        state.check_currency_rates(filename_currency)
+        reports = {bank_entry[0]: parse_transactions.incremental_bank_reports(
+            folder, *bank_entry, currency_list, state)
+            for bank_entry in parse_transactions.read_bank_logs(folder)}
+        state.save()
+        return reports
+
+    def expected():
+        return {bank_entry[0]: parse_transactions.bank_reports(
+            folder, *bank_entry, currency_list, streaming=True)
+            for bank_entry in parse_transactions.read_bank_logs(folder)}
+
+    def same(reports, other):
+        assert reports.keys() == other.keys()
+        for bankid in reports:
+            for rows, other_rows in zip(reports[bankid], other[bankid]):
+                assert [row[:2] for row in rows] == \
+                    [row[:2] for row in other_rows]
+                for row, other_row in zip(rows, other_rows):
+                    assert row[2:] == pytest.approx(other_row[2:])
+
+    same(run(), expected())
+
+    # Nothing changed, nothing is parsed again
+    parsed = []
+    original_stream = parse_transactions.stream_transactions
+
+    def recording_stream(folder, log_files, *args):
+        parsed.extend(log_files)
+        return original_stream(folder, log_files, *args)
+
+    monkeypatch.setattr(parse_transactions, "stream_transactions",
+                        recording_stream)
+    same(run(), expected())
+    # Only expected() parsed the logs
+    assert len(parsed) == sum(len(bank_entry[3]) for bank_entry in
+                              parse_transactions.read_bank_logs(folder))
+
+    # Only the changed log is parsed again
+    bankid, _, _, log_files = parse_transactions.read_bank_logs(folder)[0]
+    with open(os.path.join(folder, log_files[0]), "r") as f:
+        first_row = f.readline()
+    with open(os.path.join(folder, log_files[0]), "w") as f:
+        f.write(first_row)
+    del parsed[:]
+    same(run(), expected())
+    assert parsed[0] == log_files[0]
+    assert parsed.count(log_files[0]) == 2
+
+    # Reports still the ones written last time are not written again
+    results = os.path.join(folder, "results")
+    os.makedirs(results)
+
+    def write_run():
+        state = IncrementalState(state_folder)
+        state.check_currency_rates(filename_currency)
+        written = []
+        for bankid, _, daily_rows, category_rows in \
+                parse_transactions.streaming_bank_reports(
+                    folder, currency_list, state, result_folder=results):
+            if daily_rows is not None:
+                parse_transactions.write_report_rows(
+                    bankid, daily_rows, category_rows, results)
+                written.append(bankid)
+        return written
+
+    banks = [bank_entry[0] for bank_entry in
+             parse_transactions.read_bank_logs(folder)]
+    assert write_run() == banks
+    assert write_run() == []
+    os.remove(parse_transactions.report_filenames(banks[0], results)[0])
+    assert write_run() == [banks[0]]
+    with open(os.path.join(folder, log_files[0]), "a") as f:
+        f.write(first_row)
+    assert write_run() == [bankid]
+
+
+
+def test_rejects(tmp_path):
+    import parse_transactions
+    from bankmanager import validation
+    from bankmanager.basebank import BankException
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder, nr_banks=1, nr_logs=1)
+    bankid, _, _, log_files = parse_transactions.read_bank_logs(folder)[0]
+    log_path = os.path.join(folder, log_files[0])
+    with open(log_path, "r") as f:
+        good_rows = [line.rstrip("\n").split(",") for line in f]
+
+    def broken(field, value):
+        row = list(good_rows[0])
+        row[field] = value
+        return row
+
+    bad_rows = [
+        good_rows[0][:5],
+        broken(0, "not a date"),
+        broken(2, "ZZZZ"),
+        broken(3, good_rows[0][3][:-1]),
+        broken(4, "ten"),
+        broken(4, "-10"),
+        broken(5, "XYZ"),
+        broken(6, "Food & Drinks"),
+    ]
+    assert list(validation.validate_rows(good_rows + bad_rows)) == \
+        [validation.VALID] * len(good_rows) + list(range(1, 9))
+
+    with open(log_path, "a") as f:
+        for row in bad_rows:
+            f.write(",".join(row) + "\n")
+
+    currency_list = CurrencyRateList.load(
+        os.path.join(folder, "currency_rates.json"))
+    with pytest.raises(BankException):
+        parse_transactions.parse_transaction_file(folder, currency_list)
+
+    for columnar in [False, True]:
+        rejects = validation.RejectCollector()
+        lists = parse_transactions.parse_transaction_file(
+            folder, currency_list, columnar=columnar, rejects=rejects)
+        parsed = lists[bankid] if columnar else lists[bankid].transactions
+        assert len(parsed) == len(good_rows)
+        assert [reject[1] for reject in rejects] == \
+            list(range(len(good_rows) + 1, len(good_rows) + 9))
+        assert [reject[2] for reject in rejects] == list(range(1, 9))
+
+    rejects_file = os.path.join(folder, "rejects.csv")
+    with validation.RejectWriter(rejects_file) as rejects:
+        parse_transactions.bank_reports(
+            folder, *parse_transactions.read_bank_logs(folder)[0],
+            currency_list, streaming=True, rejects=rejects)
+        assert sum(rejects.counts.values()) == len(bad_rows)
+    with open(rejects_file, "r") as f:
+        assert len(f.readlines()) == len(bad_rows)
+
+    # Re-runs with a state write the rejects of the logs not parsed again
+    from bankmanager.incremental import IncrementalState
+    state_folder = os.path.join(folder, "state")
+    for run in range(2):
+        state = IncrementalState(state_folder)
+        state.check_currency_rates(os.path.join(folder,
+                                                "currency_rates.json"))
+        with validation.RejectWriter(rejects_file) as rejects:
+            parse_transactions.incremental_bank_reports(
+                folder, *parse_transactions.read_bank_logs(folder)[0],
+                currency_list, state, rejects)
+            assert sum(rejects.counts.values()) == len(bad_rows)
+        state.save()
+        with open(rejects_file, "r") as f:
+            assert len(f.readlines()) == len(bad_rows)
+    # Without rejects, the saved bad rows raise as in a full run
+    state = IncrementalState(state_folder)
+    state.check_currency_rates(os.path.join(folder, "currency_rates.json"))
+    with pytest.raises(BankException):
+        parse_transactions.incremental_bank_reports(
+            folder, *parse_transactions.read_bank_logs(folder)[0],
+            currency_list, state)
+
+
+def test_mmap_reader(tmp_path):
+    import numpy as np
+    import parse_transactions
+    from bankmanager import logreader, validation
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder, nr_banks=2)
+    currency_list = CurrencyRateList.load(
+        os.path.join(folder, "currency_rates.json"))
+    for bankid, _, _, log_files in parse_transactions.read_bank_logs(folder):
+        for log_file in log_files:
+            filename = os.path.join(folder, log_file)
+            assert logreader.can_map(filename)
+            assert list(parse_transactions.read_log_rows(
+                filename, use_mmap=True)) == \
+                list(parse_transactions.read_log_rows(filename))
+
+    for columnar in [False, True]:
+        expected = parse_transactions.parse_transaction_file(
+            folder, currency_list, columnar=columnar)
+        mapped = parse_transactions.parse_transaction_file(
+            folder, currency_list, columnar=columnar, use_mmap=True)
+        for bankid in expected:
+            assert mapped[bankid].calculate_balance() == \
+                expected[bankid].calculate_balance()
+
+    # \n line endings, blank and short lines, no newline at the end,
+    # small chunks
+    filename = os.path.join(folder, log_files[0])
+    with open(filename, "r") as f:
+        lines = f.read().splitlines()
+    variant = os.path.join(folder, "variant.csv")
+    with open(variant, "w") as f:
+        f.write("\n".join(lines[:3] + ["", "a,b,c"] + lines[3:]))
+    for chunk_bytes in [logreader.CHUNK_BYTES, 100]:
+        mapped_rejects = validation.RejectCollector()
+        csv_rejects = validation.RejectCollector()
+        assert [row for batch in logreader.read_log_batches(
+            variant, mapped_rejects, chunk_bytes) for row in batch] == \
+            list(parse_transactions.read_log_rows(variant, csv_rejects))
+        assert mapped_rejects == csv_rejects == [
+            ("variant.csv", 4, validation.FIELD_COUNT, []),
+            ("variant.csv", 5, validation.FIELD_COUNT, ["a", "b", "c"])]
+
+    # Lines with very wide fields (a long category, a long bad amount) are
+    # gathered apart from the others, in order
+    wide = os.path.join(folder, "wide.csv")
+    long_category = lines[1].split(",")
+    long_category[6] = "c" * 5000
+    long_amount = lines[2].split(",")
+    long_amount[4] = "9" * 3000 + "x"
+    with open(wide, "w") as f:
+        f.write("\n".join(lines[:1] + [",".join(long_category),
+                                       ",".join(long_amount)] +
+                          lines[3:]) + "\n")
+    for chunk_bytes in [logreader.CHUNK_BYTES, 100]:
+        mapped_rejects = validation.RejectCollector()
+        csv_rejects = validation.RejectCollector()
+        assert [row for batch in logreader.read_log_batches(
+            wide, mapped_rejects, chunk_bytes) for row in batch] == \
+            list(parse_transactions.read_log_rows(wide, csv_rejects))
+        assert mapped_rejects == csv_rejects
+        assert [reject[2] for reject in csv_rejects] == \
+            [validation.BAD_AMOUNT]
+    widths = np.tile(logreader.MAX_FIELD_WIDTHS, (6, 1))
+    widths[1, 6] = widths[2, 6] = widths[4, 0] = 1000
+    assert logreader._segments(widths) == [(0, 1), (1, 3), (3, 4), (4, 5),
+                                           (5, 6)]
+    # Wide lines are gathered together up to chunk_bytes only
+    assert logreader._segments(widths, 1500) == [(0, 1), (1, 2), (2, 3),
+                                                 (3, 4), (4, 5), (5, 6)]
+
+    # Quoted fields go through csv.reader
+    quoted = os.path.join(folder, "quoted.csv")
+    fields = lines[0].split(",")
+    with open(quoted, "w") as f:
+        f.write(",".join(fields[:-1] + ['"' + fields[-1] + '"']) + "\n")
+    assert not logreader.can_map(quoted)
+    assert list(parse_transactions.read_log_rows(quoted, use_mmap=True)) == \
+        [fields]
+
+
+def test_prefetch(tmp_path):
+    import parse_transactions
+    from bankmanager.prefetch import Prefetcher
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder, nr_banks=2, nr_logs=3)
+    currency_list = CurrencyRateList.load(
+        os.path.join(folder, "currency_rates.json"))
+    log_files = [os.path.join(folder, name) for bank_entry in
+                 parse_transactions.read_bank_logs(folder)
+                 for name in bank_entry[3]]
+
+    def content(filename):
+        with open(filename, "rb") as f:
+            return f.read()
+
+    with Prefetcher(depth=2) as prefetcher:
+        prefetcher.schedule(log_files)
+        assert prefetcher.read(log_files[0]) == content(log_files[0])
+        # Skipped files are dropped, later ones still come from memory
+        assert prefetcher.read(log_files[2]) == content(log_files[2])
+        assert prefetcher.read(log_files[1]) is None
+        assert prefetcher.read(os.path.join(folder, "missing.csv")) is None
+        assert prefetcher.io_wait >= 0
+
+    # Files bigger than the budget are left to the parser, its reads
+    # through open are timed too
+    with Prefetcher(depth=2, memory_budget=1) as prefetcher:
+        prefetcher.schedule(log_files)
+        assert prefetcher.read(log_files[0]) is None
+        with prefetcher.open(log_files[0]) as f:
+            assert f.read() == content(log_files[0])
+        assert prefetcher.io_wait > 0
+
+    # Files not read ahead yet are read when asked for, and timed
+    with Prefetcher(depth=1, memory_budget=max(
+            os.path.getsize(name) for name in log_files)) as prefetcher:
+        prefetcher.schedule(log_files)
+        for name in log_files:
+            wait = prefetcher.io_wait
+            assert prefetcher.read(name) == content(name)
+            assert prefetcher.io_wait > wait
+
+    # A dropped read that cannot be cancelled keeps its bytes in the
+    # budget until it is done
+    from concurrent.futures import Future
+    with Prefetcher(depth=1) as prefetcher:
+        running = Future()
+        running.set_running_or_notify_cancel()
+        prefetcher._reading[log_files[0]] = (running, 10)
+        prefetcher._in_flight = 10
+        prefetcher._release(log_files[0])
+        prefetcher._fill()
+        assert prefetcher._in_flight == 10
+        running.set_result(b"")
+        prefetcher._fill()
+        assert prefetcher._in_flight == 0
+
+    expected = parse_transactions.parse_transaction_file(folder,
+                                                         currency_list)
+    for use_mmap in [False, True]:
+        with Prefetcher(depth=2) as prefetcher:
+            prefetched = parse_transactions.parse_transaction_file(
+                folder, currency_list, use_mmap=use_mmap,
+                prefetcher=prefetcher)
+        for bankid in expected:
+            assert prefetched[bankid].calculate_balance() == \
+                expected[bankid].calculate_balance()
+
+
+def test_as_of_rates():
+    currency_list = CurrencyRateList()
+    currency_list.add_currency_at_date("EUR", 2, "2019-01-02T00:00:00+00:00")
+    currency_list.add_currency_at_date("EUR", 3, "2019-01-01T00:00:00+00:00")
+    # Same time as the first one, the first one added stays
+    currency_list.add_currency_at_date("EUR", 5, "2019-01-02T01:00:00+01:00")
+    currency_list.add_currency_at_date("GBP", 7, "2019-01-01T00:00:00+00:00")
+
+    assert currency_list.currency_rate_at_date(
+        "EUR", "2018-12-31T23:59:59+00:00") is None
+    assert currency_list.currency_rate_at_date(
+        "EUR", "2019-01-01T00:00:00+00:00") == 3
+    assert currency_list.currency_rate_at_date(
+        "EUR", "2019-01-01T23:00:00-02:00") == 2
+    assert currency_list.currency_rate_at_date(
+        "EUR", "2025-01-01T00:00:00+00:00") == 2
+    assert currency_list.currency_rate_at_date(
+        "GBP", dateutil.parser.parse("2019-06-01T00:00:00+00:00")) == 7
+    assert currency_list.currency_rate_at_date(
+        "JPY", "2019-01-01T00:00:00+00:00") is None
+    assert currency_list.currency_rate_at_date(
+        config.BASE_CURRENCY, "2019-01-01T00:00:00+00:00") == 1
+    assert currency_list.misses == 2
+    assert currency_list.lookups == 6
+
+    stale_list = CurrencyRateList(max_staleness=3600)
+    stale_list.add_currency_at_date("EUR", 2, "2019-01-01T00:00:00+00:00")
+    assert stale_list.currency_rate_at_date(
+        "EUR", "2019-01-01T01:00:00+00:00") == 2
+    assert stale_list.currency_rate_at_date(
+        "EUR", "2019-01-01T01:00:01+00:00") is None
+    assert stale_list.misses == 1
+
+
+def test_batch_conversion():
+    import numpy as np
+    currency_list = CurrencyRateList(max_staleness=86400 * 365)
+    currencies = ["EUR", "GBP", "JPY"]
+    for count in range(50):
+        date = Faker().iso8601() + gen_timezone()
+        currency_list.add_currency_at_date(random.choice(currencies),
+                                           random.randint(1, 100), date)
+    codes = [random.choice(currencies + [config.BASE_CURRENCY, "CHF"])
+             for count in range(500)]
+    times = np.array([epoch_us(parse_timestamp(Faker().iso8601() +
+                                               gen_timezone()))
+                      for count in range(500)], dtype=np.int64)
+    amounts = np.array([random.random() * 1000 for count in range(500)])
+
+    expected_rates = [currency_list.rate_at(code, int(time))
+                      for code, time in zip(codes, times)]
+    misses = currency_list.misses
+    rates = currency_list.rates_at(codes, times)
+    assert currency_list.misses - misses == \
+        sum(rate is None for rate in expected_rates)
+    assert [None if np.isnan(rate) else rate for rate in rates] == \
+        expected_rates
+
+    expected = [amount * (1 if rate is None else rate)
+                for amount, rate in zip(amounts, expected_rates)]
+    assert list(currency_list.convert(codes, times, amounts)) == expected
+    values = sorted(set(codes))
+    encoded = (values, np.array([values.index(code) for code in codes]))
+    assert list(currency_list.convert(encoded, times, amounts)) == expected
+    assert len(currency_list.convert([], [], [])) == 0
+
+
+def test_rate_store(tmp_path):
+    import numpy as np
+    from bankmanager import ratestore
+    currency_list = CurrencyRateList()
+    currencies = ["EUR", "GBP", "JPY"]
+    for count in range(50):
+        date = Faker().iso8601() + gen_timezone()
+        currency_list.add_currency_at_date(random.choice(currencies),
+                                           random.randint(1, 100), date)
+    filename = str(tmp_path / "currency_rates.json")
+    currency_list.dump(filename)
+    loaded = CurrencyRateList.load(filename)
+    cached = CurrencyRateList.load_cached(filename)
+    assert os.path.exists(ratestore.store_filename(filename))
+    # Nothing is read from the store before the first lookup
+    assert len(cached._timelines) == 0
+
+    codes = [random.choice(currencies + ["CHF"]) for count in range(200)]
+    times = np.array([epoch_us(parse_timestamp(Faker().iso8601() +
+                                               gen_timezone()))
+                      for count in range(200)], dtype=np.int64)
+    assert [loaded.rate_at(code, int(time))
+            for code, time in zip(codes, times)] == \
+        [cached.rate_at(code, int(time)) for code, time in zip(codes, times)]
+    assert np.array_equal(loaded.rates_at(codes, times),
+                          cached.rates_at(codes, times), equal_nan=True)
+
+    # Rates added to a cached list, and a dump of it, see the stored ones
+    cached.add_currency_at_date("EUR", 7, "2100-01-01T00:00:00+00:00")
+    assert cached.currency_rate_at_date("EUR", "2100-01-02T00:00:00") == 7
+    cached.dump(str(tmp_path / "dumped.json"))
+    dumped = CurrencyRateList.load(str(tmp_path / "dumped.json"))
+    assert np.array_equal(loaded.rates_at(codes, times),
+                          dumped.rates_at(codes, times), equal_nan=True)
+
+    # A newer json file is written to the store again
+    newer = CurrencyRateList()
+    newer.add_currency_at_date("EUR", 3, "2000-01-01T00:00:00+00:00")
+    newer.dump(filename)
+    later = os.path.getmtime(ratestore.store_filename(filename)) + 10
+    os.utime(filename, (later, later))
+    reloaded = CurrencyRateList.load_cached(filename)
+    assert reloaded.currency_rate_at_date("EUR", "2001-01-01T00:00:00") == 3
+    assert reloaded.currency_rate_at_date("GBP", "2001-01-01T00:00:00") is None
+
+    # A fresh but unreadable store (empty, truncated, other format) is
+    # written again
+    with open(ratestore.store_filename(filename), "rb") as f:
+        valid = f.read()
+    for content in (b"", b"BMRATES1", b"something else entirely",
+                    valid[:-8]):
+        with open(ratestore.store_filename(filename), "wb") as f:
+            f.write(content)
+        os.utime(ratestore.store_filename(filename), (later + 1, later + 1))
+        assert ratestore.is_fresh(filename)
+        reloaded = CurrencyRateList.load_cached(filename)
+        assert reloaded.currency_rate_at_date("EUR",
+                                              "2001-01-01T00:00:00") == 3
+
+
+def test_load_used_currencies(tmp_path):
+    import numpy as np
+    from bankmanager.currencyrates import read_rates
+    currency_list = CurrencyRateList()
+    currencies = ["EUR", "GBP", "JPY", "CHF"]
+    for count in range(80):
+        date = Faker().iso8601() + gen_timezone()
+        currency_list.add_currency_at_date(random.choice(currencies),
+                                           random.randint(1, 100), date)
+    filename = str(tmp_path / "currency_rates.json")
+    currency_list.dump(filename)
+
+    wanted = ["EUR", "JPY"]
+    assert read_rates(filename, wanted) == \
+        [entry for entry in read_rates(filename) if entry[1] in wanted]
+    # Scanned a chunk at a time, entries across chunks included
+    for chunk_size in (1, 7, 100, 4096):
+        assert read_rates(filename, wanted, chunk_size) == \
+            read_rates(filename, wanted)
+        assert read_rates(filename, [], chunk_size) == []
+    loaded = CurrencyRateList.load(filename)
+    subset = CurrencyRateList.load(filename, currencies=wanted)
+    assert sorted(subset._timelines) == sorted(
+        currency for currency in wanted if currency in loaded._timelines)
+    codes = [random.choice(wanted) for count in range(100)]
+    times = np.array([epoch_us(parse_timestamp(Faker().iso8601() +
+                                               gen_timezone()))
+                      for count in range(100)], dtype=np.int64)
+    assert np.array_equal(loaded.rates_at(codes, times),
+                          subset.rates_at(codes, times), equal_nan=True)
+
+    # Files not shaped like dump writes them are decoded as json
+    with open(filename, "w") as f:
+        f.write('{"2000-01-01T00:00:00": {"EUR": 2, "GBP": {"x": 1}}}')
+    assert read_rates(filename, ["EUR"]) == \
+        [("2000-01-01T00:00:00", "EUR", 2)]
+
+
+def test_daily_rates(tmp_path):
+    import numpy as np
+    from bankmanager.dailyrates import DailyRates
+    from bankmanager.timestamps import US_PER_DAY
+    currency_list = CurrencyRateList(max_staleness=86400 * 365)
+    currencies = ["EUR", "GBP", "JPY"]
+    for count in range(50):
+        date = Faker().iso8601() + gen_timezone()
+        currency_list.add_currency_at_date(random.choice(currencies),
+                                           random.randint(1, 100), date)
+    codes = [random.choice(currencies + [config.BASE_CURRENCY, "CHF"])
+             for count in range(300)]
+    times = np.array([epoch_us(parse_timestamp(Faker().iso8601() +
+                                               gen_timezone()))
+                      for count in range(300)], dtype=np.int64)
+    amounts = np.array([random.random() * 1000 for count in range(300)])
+    # Closing rate of the (utc) day of every time
+    day_ends = (times // US_PER_DAY + 1) * US_PER_DAY - 1
+    expected = currency_list.rates_at(codes, day_ends)
+
+    daily_rates = DailyRates(currency_list)
+    # Covering half first, then growing to everything
+    assert np.array_equal(daily_rates.rates_at(codes[:150], times[:150]),
+                          expected[:150], equal_nan=True)
+    assert np.array_equal(daily_rates.rates_at(codes, times), expected,
+                          equal_nan=True)
+    assert [daily_rates.rate_at(code, int(time))
+            for code, time in zip(codes, times)] == \
+        [None if np.isnan(rate) else rate for rate in expected]
+    assert np.array_equal(
+        daily_rates.convert(codes, times, amounts),
+        amounts * np.where(np.isnan(expected), 1, expected))
+
+    filename = str(tmp_path / "daily.npz")
+    daily_rates.save(filename, "key")
+    saved = DailyRates.load(filename, currency_list, "key")
+    assert saved.days == daily_rates.days
+    assert sorted(saved.currencies) == sorted(daily_rates.currencies)
+    assert np.array_equal(saved.rates_at(codes, times), expected,
+                          equal_nan=True)
+    assert DailyRates.load(filename, currency_list, "other").currencies == []
+
+
+def test_report_currencies(tmp_path):
+    import parse_transactions
+    from bankmanager.currencyrates import CrossRates, read_rates
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder)
+    filename_currency = os.path.join(folder, "currency_rates.json")
+    currency_list = CurrencyRateList.load(filename_currency)
+    report_currency = read_rates(filename_currency)[0][1]
+    # The base currency and repeats are left out
+    report_currencies = [config.BASE_CURRENCY, report_currency,
+                         report_currency]
+    assert parse_transactions.other_report_currencies(report_currencies) == \
+        [report_currency]
+
+    cross = CrossRates(currency_list, report_currency)
+    for date, currency, rate in read_rates(filename_currency)[:20]:
+        time = epoch_us(parse_timestamp(date))
+        rate = currency_list.rate_at(currency, time)
+        report_rate = currency_list.rate_at(report_currency, time)
+        assert cross.rate_at(currency, time) == \
+            (1 if rate is None else rate) / (report_rate or 1)
+        assert cross.rates_at([currency], [time])[0] == \
+            cross.rate_at(currency, time)
+
+    # A rate of 0 converts to 0, as in the base currency, and the report
+    # currency tables are the base ones divided by its rate
+    rates = CurrencyRateList()
+    rates.add_currency_at_date("JPY", 0, "2020-01-01T00:00:00+00:00")
+    rates.add_currency_at_date("GBP", 4, "2020-01-01T00:00:00+00:00")
+    rates.add_currency_at_date("EUR", 2, "2020-01-01T00:00:00+00:00")
+    rates.add_currency_at_date("EUR", 0, "2020-02-01T00:00:00+00:00")
+    january = epoch_us(parse_timestamp("2020-01-15T00:00:00+00:00"))
+    february = epoch_us(parse_timestamp("2020-02-15T00:00:00+00:00"))
+    cross = CrossRates(rates, "EUR")
+    codes = ["JPY", "GBP", "CHF", config.BASE_CURRENCY]
+    base = rates.convert(codes, [january] * 4, [10.0] * 4)
+    assert list(base) == [0, 40, 10, 10]
+    assert list(cross.convert(codes, [january] * 4, [10.0] * 4)) == \
+        list(base / 2)
+    assert [cross.rate_at(code, january) for code in codes] == \
+        [0, 2, 0.5, 0.5]
+    # No value for the report currency, amounts stay at their base value
+    assert cross.zero_report_rates == 0
+    assert list(cross.convert(codes, [february] * 4, [10.0] * 4)) == \
+        list(rates.convert(codes, [february] * 4, [10.0] * 4))
+    assert cross.rate_at("GBP", february) == 4
+    assert cross.zero_report_rates == 5
+
+    for bank_entry in parse_transactions.read_bank_logs(folder):
+        base = parse_transactions.bank_reports(folder, *bank_entry,
+                                               currency_list)
+        reports = [parse_transactions.bank_reports(
+            folder, *bank_entry, currency_list,
+            report_currencies=report_currencies, **kwargs)
+            for kwargs in ({}, {"columnar": True}, {"streaming": True})]
+        for daily_rows, category_rows in reports:
+            assert daily_rows == reports[0][0]
+            assert category_rows == reports[0][1]
+        daily_rows, category_rows = reports[0]
+        # Base currency rows first, then the report currency ones
+        assert daily_rows[:len(base[0])] == base[0]
+        assert category_rows[:len(base[1])] == base[1]
+        assert {row[1] for row in daily_rows[len(base[0]):]} == \
+            {report_currency}
+        assert len(category_rows) == 2 * len(base[1])
+
+        parse_transactions.write_report_rows(bank_entry[0], daily_rows,
+                                             category_rows, folder,
+                                             report_currencies)
+        for name, rows in [("_daily_balances", base[0]),
+                           ("_categories", base[1])]:
+            for suffix in ["", "_" + report_currency]:
+                with open(os.path.join(folder, bank_entry[0] + name +
+                                       suffix + ".csv"), "r") as f:
+                    assert len(f.readlines()) == len(rows)
+            assert not os.path.exists(os.path.join(
+                folder, bank_entry[0] + name + "_" + config.BASE_CURRENCY +
+                ".csv"))
+
+
+def test_rate_corrections(tmp_path, monkeypatch):
+    import json
+    import numpy as np
+    import parse_transactions
+    from bankmanager.aggregation import BankAggregate
+    from bankmanager.currencyrates import rate_changes
+    from bankmanager.incremental import IncrementalState
+
+    old = CurrencyRateList()
+    old.add_currency_at_date("EUR", 2, "2000-01-01T00:00:00+00:00")
+    old.add_currency_at_date("EUR", 3, "2000-02-01T00:00:00+00:00")
+    new = CurrencyRateList()
+    new.add_currency_at_date("EUR", 2, "2000-01-01T00:00:00+00:00")
+    new.add_currency_at_date("EUR", 4, "2000-01-15T00:00:00+00:00")
+    new.add_currency_at_date("EUR", 3, "2000-02-01T00:00:00+00:00")
+    new.add_currency_at_date("GBP", 5, "2000-03-01T00:00:00+00:00")
+    changes = rate_changes(old, new)
+    assert sorted(changes) == ["EUR", "GBP"]
+    assert changes["EUR"][0].tolist() == \
+        [epoch_us(parse_timestamp("2000-01-15T00:00:00+00:00"))]
+    assert changes["EUR"][1].tolist() == \
+        [epoch_us(parse_timestamp("2000-02-01T00:00:00+00:00"))]
+    assert rate_changes(old, old) == {}
+
+    def us(date):
+        return epoch_us(parse_timestamp(date + "T00:00:00+00:00"))
+    assert new.rate_interval("EUR", us("2000-01-20")) == \
+        (us("2000-01-15"), us("2000-02-01"))
+    assert new.rate_interval("EUR", us("1999-01-01")) == \
+        (None, us("2000-01-01"))
+    assert new.rate_interval("EUR", us("2000-03-01")) == \
+        (us("2000-02-01"), None)
+    assert new.rate_interval(config.BASE_CURRENCY, 0) == (None, None)
+    # A rate too old no longer holds
+    day = CurrencyRateList(max_staleness=24 * 3600)
+    day.add_currency_at_date("EUR", 2, "2000-01-01T00:00:00+00:00")
+    assert day.rate_interval("EUR", us("2000-01-01")) == \
+        (us("2000-01-01"), us("2000-01-02") + 1)
+    assert day.rate_interval("EUR", us("2000-01-05")) == \
+        (us("2000-01-02") + 1, None)
+
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder)
+    filename_currency = os.path.join(folder, "currency_rates.json")
+    state_folder = os.path.join(folder, "state")
+
+    def run():
+        currency_list = CurrencyRateList.load(filename_currency)
+        state = IncrementalState(state_folder)
+        state.check_currency_rates(filename_currency)
+        reports = {bank_entry[0]: parse_transactions.incremental_bank_reports(
+            folder, *bank_entry, currency_list, state)
+            for bank_entry in parse_transactions.read_bank_logs(folder)}
+        state.save()
+        return reports
+
+    def expected():
+        currency_list = CurrencyRateList.load(filename_currency)
+        return {bank_entry[0]: parse_transactions.bank_reports(
+            folder, *bank_entry, currency_list, streaming=True)
+            for bank_entry in parse_transactions.read_bank_logs(folder)}
+
+    run()
+    # Correct every other rate of the file
+    with open(filename_currency, "r") as f:
+        rates_by_date = json.load(f)
+    for idx, rates in enumerate(rates_by_date.values()):
+        if idx % 2 == 0:
+            for currency in rates:
+                rates[currency] += 1
+    with open(filename_currency, "w") as f:
+        json.dump(rates_by_date, f)
+
+    parsed = []
+    original_stream = parse_transactions.stream_transactions
+
+    def recording_stream(folder, log_files, *args):
+        parsed.extend(log_files)
+        return original_stream(folder, log_files, *args)
+
+    monkeypatch.setattr(parse_transactions, "stream_transactions",
+                        recording_stream)
+    def same(reports, reference):
+        assert reports.keys() == reference.keys()
+        for bankid in reports:
+            for rows, other_rows in zip(reports[bankid], reference[bankid]):
+                assert [row[:2] for row in rows] == \
+                    [row[:2] for row in other_rows]
+                for row, other_row in zip(rows, other_rows):
+                    assert row[2:] == pytest.approx(other_row[2:])
+
+    reports = run()
+    # No log was read again
+    assert parsed == []
+    same(reports, expected())
+
+    # Converting again with the same rates gives the very same floats
+    currency_list = CurrencyRateList.load(filename_currency)
+    bank_entry = parse_transactions.read_bank_logs(folder)[0]
+    partial = BankAggregate(bank.Bank(*bank_entry[:3]), currency_list,
+                            keep_raw=True).consume(
+        original_stream(folder, bank_entry[3]))
+    everything = {currency: (np.array([np.iinfo(np.int64).min]),
+                             np.array([np.iinfo(np.int64).max]))
+                  for currency in currency_list.currencies}
+    assert partial.can_reconvert(everything)
+    assert partial.reconvert(everything, currency_list) == (set(), set())
+
+    # Rates added a second after the others split the raw sums, the logs
+    # with amounts there are read again
+    with open(filename_currency, "r") as f:
+        rates_by_date = json.load(f)
+    for date, rates in list(rates_by_date.items()):
+        later = dateutil.parser.isoparse(date) + \
+            datetime.timedelta(seconds=1)
+        rates_by_date[later.isoformat()] = {
+            currency: rate + 1 for currency, rate in rates.items()}
+    with open(filename_currency, "w") as f:
+        json.dump(rates_by_date, f)
+    del parsed[:]
+    reports = run()
+    assert parsed
+    same(reports, expected())
+
+
+def test_rate_segments(tmp_path):
+    import json
+    from bankmanager.ratesegments import RateSegmentWriter
+    currency_list = CurrencyRateList()
+    writer = RateSegmentWriter(str(tmp_path / "segments"), segment_size=7)
+    os.makedirs(str(tmp_path / "segments"))
+    currencies = ["EUR", "GBP", "JPY", "USD"]
+    dates = [Faker().iso8601() + gen_timezone() for count in range(30)]
+    for count in range(100):
+        # Repeated dates, so some currencies get two rates at one date
+        date = random.choice(dates)
+        currency = random.choice(currencies)
+        rate = random.randint(0, 100)
+        currency_list.add_currency_at_date(currency, rate, date)
+        writer.add_currency_at_date(currency, rate, date)
+    assert len(writer.segments) == len(writer) // 7
+
+    merged = str(tmp_path / "merged.json")
+    writer.merge(merged, remove=False)
+    dumped = str(tmp_path / "dumped.json")
+    currency_list.dump(dumped)
+    with open(merged) as f:
+        merged_rates = json.load(f)
+    with open(dumped) as f:
+        assert merged_rates == json.load(f)
+    times = [epoch_us(parse_timestamp(date)) for date in merged_rates]
+    assert times == sorted(times)
+
+    # dump leaves the list as it was, it can be dumped again and grow
+    currency_list.dump(dumped)
+    with open(dumped) as f:
+        assert merged_rates == json.load(f)
+    currency_list.add_currency_at_date("EUR", 5, "2100-01-01T00:00:00+00:00")
+    writer.add_currency_at_date("EUR", 5, "2100-01-01T00:00:00+00:00")
+    currency_list.dump(dumped)
+    writer.merge(merged)
+    with open(merged) as f, open(dumped) as g:
+        assert json.load(f) == json.load(g)
+    assert os.listdir(str(tmp_path / "segments")) == []
+    assert CurrencyRateList.load(merged).currency_rate_at_date(
+        "EUR", "2100-01-02T00:00:00") == 5
+
+
+def test_fixed_point(tmp_path):
+    import numpy as np
+    from fractions import Fraction
+    import parse_transactions
+    from bankmanager import fixedpoint
+    from bankmanager.basebank import BankException
+
+    # Conversions are exact, rounded half to even
+    for count in range(500):
+        exponent, target = random.choice([0, 2, 3, 4]), \
+            random.choice([0, 2, 4])
+        amount = random.randint(0, 10 ** random.randint(1, 12))
+        rate = random.randint(0, 100 * fixedpoint.RATE_SCALE)
+        converted = fixedpoint.convert_minor(
+            np.array([amount]), np.array([exponent]), np.array([rate]),
+            target)[0]
+        assert converted == round(Fraction(
+            amount * rate * 10 ** target,
+            fixedpoint.RATE_SCALE * 10 ** exponent))
+    assert fixedpoint.minor_exponent("JPY") == 0
+    assert fixedpoint.to_minor([0.125, 1.5], [2, 0]).tolist() == [12, 2]
+    with pytest.raises(BankException):
+        fixedpoint.to_minor([1e20], [2])
+    # Sums do not wrap around
+    values = np.full(100, 2 ** 62, dtype=np.int64)
+    assert fixedpoint.exact_sum(values) == 100 * 2 ** 62
+    mask = np.arange(100) % 3 == 0
+    assert fixedpoint.exact_sum(values, mask) == 34 * 2 ** 62
+
+    folder = str(tmp_path)
+    write_fake_transaction_folder(folder)
+    currency_list = CurrencyRateList.load(
+        os.path.join(folder, "currency_rates.json"))
+    report_currencies = ["JPY"]
+    for bank_entry in parse_transactions.read_bank_logs(folder):
+        reports = [parse_transactions.bank_reports(
+            folder, *bank_entry, currency_list, fixed_point=True,
+            report_currencies=report_currencies, **kwargs)
+            for kwargs in ({}, {"columnar": True}, {"streaming": True})]
+        for daily_rows, category_rows in reports:
+            assert daily_rows == reports[0][0]
+            assert category_rows == reports[0][1]
+        # Yen have no decimals
+        assert all(row[2] == int(row[2]) for row in reports[0][0]
+                   if row[1] == "JPY")
+
+    # Balances do not depend on the order of the transactions
+    bank_code, bank_tz, bank_name, log_files = \
+        parse_transactions.read_bank_logs(folder)[0]
+    transactions = list(parse_transactions.stream_transactions(
+        folder, log_files))
+    balances = set()
+    for count in range(5):
+        random.shuffle(transactions)
+        transaction_list = TransactionList(
+            bank.Bank(bank_code, bank_tz, bank_name), currency_list,
+            fixed_point=True)
+        for transaction in transactions:
+            transaction_list.append(transaction)
+        balances.add(transaction_list.balance)
+    assert len(balances) == 1
+
+
+def test_rate_memo():
+    from bankmanager.timestamps import US_PER_DAY
+    currencies = ["EUR", "GBP", "JPY"]
+    start = epoch_us(parse_timestamp("2020-01-01T00:00:00+00:00"))
+    for max_staleness in (None, 3600 * 5):
+        memoized = CurrencyRateList(max_staleness, memo_size=16)
+        plain = CurrencyRateList(max_staleness, memo_size=0)
+        for count in range(60):
+            date = Faker().date_time_between(
+                datetime.datetime(2020, 1, 1),
+                datetime.datetime(2020, 1, 20)).isoformat() + "+00:00"
+            currency, rate = random.choice(currencies), random.randint(1, 99)
+            memoized.add_currency_at_date(currency, rate, date)
+            plain.add_currency_at_date(currency, rate, date)
+        # Skewed lookups, a few days get most of them
+        for count in range(2000):
+            time = start + random.choice([2, 3, random.randint(0, 25)]) * \
+                US_PER_DAY + random.randint(0, US_PER_DAY - 1)
+            currency = random.choice(currencies + ["CHF"])
+            assert memoized.rate_at(currency, time) == \
+                plain.rate_at(currency, time)
+        assert memoized.memo_hits + memoized.memo_misses == 2000
+        assert memoized.memo_hits > memoized.memo_misses
+        assert len(memoized._memo) <= 16
+        assert (memoized.lookups, memoized.misses) == \
+            (plain.lookups, plain.misses)
+
+        # A new rate replaces the remembered ones from its time on
+        time = start + 2 * US_PER_DAY + 10
+        memoized.rate_at("EUR", time)
+        memoized.add_currency_at_date("EUR", 1234,
+                                      "2020-01-03T00:00:00.000005+00:00")
+        assert memoized.rate_at("EUR", time) == 1234
+
+
+def test_aggregate_balances():
+    from bankmanager.aggregation import DATE, CATEGORY, CURRENCY, WEEKDAY
+    my_bankid = gen_bank_id()
+    my_bank = bank.Bank(my_bankid, "UTC" + gen_timezone())
+    currency_list = CurrencyRateList()
+    txlist = TransactionList(my_bank, currency_list)
+    columnar = ColumnarTransactionList(my_bank, currency_list)
+    dates = [Faker().iso8601() + gen_timezone() for count in range(10)]
+    rows = []
+    for txcount in range(200):
+        date = random.choice(dates)
+        amount, currency, category, currency_list = \
+            gen_agnostic_data(currency_list, date)
+        incoming, outgoing = random.choice([(True, True), (True, False),
+                                            (False, True)])
+        transaction_id, source_id, dest_id = gen_transaction(
+            my_bankid, incoming, outgoing)
+        txlist.add_transaction(date, source_id, dest_id, transaction_id,
+                               amount, currency, category)
+        rows.append((date, source_id, dest_id, amount, currency, category))
+    columnar.add_transactions(*zip(*rows))
+
+    dimensions = (DATE, CATEGORY, CURRENCY, WEEKDAY)
+    key_of = {
+        DATE: lambda transaction: transaction.transaction_date,
+        CATEGORY: lambda transaction: transaction.category,
+        CURRENCY: lambda transaction: transaction.currency_code,
+        WEEKDAY: lambda transaction: datetime.date.fromisoformat(
+            transaction.transaction_date).weekday()
+    }
+    for storage in (txlist, columnar):
+        balances = storage.balances(dimensions=dimensions)
+        for dimension in dimensions:
+            # Same as splitting the list and summing every part
+            groups = {}
+            for transaction in txlist.transactions:
+                groups.setdefault(key_of[dimension](transaction),
+                                  TransactionList(my_bank, currency_list)
+                                  ).append(transaction)
+            assert balances[dimension].keys() == groups.keys()
+            for key, group in groups.items():
+                assert balances[dimension][key].calculate_balance() == \
+                    group.calculate_balance()
+                assert balances[dimension][key].balance == group.balance
+
+
+def test_running_balance():
+    my_bankid = gen_bank_id()
+    my_bank = bank.Bank(my_bankid, "UTC" + gen_timezone())
+    for fixed_point in (False, True):
+        currency_list = CurrencyRateList()
+        txlist = TransactionList(my_bank, currency_list, fixed_point)
+        for txcount in range(100):
+            date = Faker().iso8601() + gen_timezone()
+            amount, currency, category, currency_list = \
+                gen_agnostic_data(currency_list, date)
+            incoming, outgoing = random.choice([(True, True), (True, False),
+                                                (False, True)])
+            transaction_id, source_id, dest_id = gen_transaction(
+                my_bankid, incoming, outgoing)
+            txlist.add_transaction(date, source_id, dest_id, transaction_id,
+                                   amount, currency, category)
+            # Same as walking the whole list again
+            fresh = TransactionList(my_bank, currency_list, fixed_point)
+            for transaction in txlist.transactions:
+                fresh.append(transaction)
+            assert txlist.balance == fresh.balance
+            assert txlist.calculate_balance() == fresh.calculate_balance()
+
+        # Rates unchanged, appends only add to the running totals
+        running = txlist._running
+        for transaction in list(txlist.transactions):
+            txlist.append(transaction)
+        assert txlist._running is running
+        assert txlist._running.count == len(txlist.transactions)
+        # A new rate, they are made again
+        currency_list.add_currency_at_date("EUR", 0.5, Faker().iso8601() +
+                                           gen_timezone())
+        assert txlist.balance is not None and txlist._running is not running
+        fresh = TransactionList(my_bank, currency_list, fixed_point)
+        for transaction in txlist.transactions:
+            fresh.append(transaction)
+        assert txlist.calculate_balance() == fresh.calculate_balance()
+
+    # Rows in a report currency have the balance in that currency
+    import parse_transactions
+    from bankmanager.currencyrates import CrossRates
+    date = "2020-01-15T00:00:00+00:00"
+    _, _, category, _ = gen_agnostic_data(CurrencyRateList(), date)
+    rates = CurrencyRateList()
+    rates.add_currency_at_date("EUR", 2, "2020-01-01T00:00:00+00:00")
+    txlist = TransactionList(my_bank, rates)
+    transaction_id, source_id, dest_id = gen_transaction(my_bankid, True,
+                                                         False)
+    txlist.add_transaction(date, source_id, dest_id, transaction_id, 10,
+                           config.BASE_CURRENCY, category)
+    cross = CrossRates(rates, "EUR")
+    assert parse_transactions.category_balance_rows(
+        TransactionList.categorize(txlist), cross, "EUR") == \
+        [(category, "EUR", 5.0, 1)]
+    assert parse_transactions.daily_balance_rows(
+        TransactionList.categorize_by_date(txlist), cross, "EUR") == \
+        [("2020-01-15", "EUR", 5.0, 1, 0, 0)]
+    assert txlist.calculate_balance(cross) == ((5.0, 1), (0, 0), 0)
+    assert txlist.balance == 5.0
+    # Until the list changes
+    txlist.append(txlist.transactions[0])
+    assert txlist.balance == 20.0
+    assert parse_transactions.category_balance_rows(
+        TransactionList.categorize(txlist)) == \
+        [(category, config.BASE_CURRENCY, 20.0, 2)]
+
+
+def test_account_ledger():
+    from bankmanager.account import BankAccount
+    from bankmanager.basebank import BankException, BankAccountID
+    from bankmanager.fixedpoint import convert_minor_one, to_major, \
+        report_exponent
+    my_bankid = gen_bank_id()
+    my_bank = bank.Bank(my_bankid, "UTC" + gen_timezone())
+    own = [my_bankid + xeger(config.BANKLESS_ACCOUNT_RULE) for count in range(5)]
+    for fixed_point in (False, True):
+        currency_list = CurrencyRateList()
+        txlist = TransactionList(my_bank, currency_list, fixed_point)
+
+        def add_transactions(count):
+            for txcount in range(count):
+                date = Faker().iso8601() + gen_timezone()
+                amount, currency, category, _ = \
+                    gen_agnostic_data(currency_list, date)
+                source, destination = random.choice([
+                    (random.choice(own), random.choice(own)),
+                    (random.choice(own), xeger(config.BANK_ACCOUNT_RULE)),
+                    (xeger(config.BANK_ACCOUNT_RULE), random.choice(own))])
+                txlist.add_transaction(date, source, destination,
+                                       xeger(config.BANK_ACCOUNT_RULE),
+                                       amount, currency, category)
+
+        def check(ledger):
+            exponent = report_exponent(currency_list)
+            assert len(ledger) == len(txlist.transactions)
+            for account_id in own:
+                account = BankAccount(account_id)
+                number = BankAccountID(account_id)
+                expected = [transaction for transaction in txlist.transactions
+                            if number in (transaction.source,
+                                          transaction.destination)]
+                assert account.statement(txlist) == expected
+                # Same as converting the account's transactions one by one
+                total = 0
+                for transaction in expected:
+                    rate = currency_list.rate_at(transaction.currency_code,
+                                                 transaction.epoch_us)
+                    if fixed_point:
+                        amount = convert_minor_one(
+                            transaction.transaction_amount_nocurrency,
+                            transaction.currency_code, rate, exponent)
+                    else:
+                        amount = transaction.transaction_amount_nocurrency * \
+                            (1 if rate is None else rate)
+                    if transaction.source == number:
+                        total -= amount
+                    if transaction.destination == number:
+                        total += amount
+                if fixed_point:
+                    total = to_major(total, exponent)
+                assert account.check_balance(ledger) == total
+                assert account.last_calculated_balance == total
+
+        add_transactions(100)
+        ledger = txlist.ledger
+        check(ledger)
+        # New transactions (without new rates) are only indexed on top
+        count = len(txlist.transactions)
+        version = currency_list.version
+        for transaction in list(txlist.transactions[:50]):
+            txlist.append(transaction)
+        assert currency_list.version == version
+        assert ledger.update() == 50 and len(ledger) == count + 50
+        check(ledger)
+        # New rates, indexed again
+        add_transactions(20)
+        assert txlist.ledger is ledger
+        check(ledger)
+
+        with pytest.raises(BankException):
+            BankAccount(xeger(config.BANK_ACCOUNT_RULE)).check_balance(ledger)
+
+
+def test_balance_between():
+    from bankmanager.timestamps import US_PER_DAY
+    my_bankid = gen_bank_id()
+    my_bank = bank.Bank(my_bankid, "UTC" + gen_timezone())
+    for fixed_point in (False, True):
+        currency_list = CurrencyRateList()
+        txlist = TransactionList(my_bank, currency_list, fixed_point)
+        columnar = ColumnarTransactionList(my_bank, currency_list, fixed_point)
+        rows = []
+        for txcount in range(300):
+            date = Faker().date_time_between(
+                datetime.datetime(2020, 1, 1),
+                datetime.datetime(2020, 3, 1)).isoformat() + gen_timezone()
+            amount, currency, category, _ = \
+                gen_agnostic_data(currency_list, date)
+            incoming, outgoing = random.choice([(True, True), (True, False),
+                                                (False, True)])
+            transaction_id, source_id, dest_id = gen_transaction(
+                my_bankid, incoming, outgoing)
+            txlist.add_transaction(date, source_id, dest_id, transaction_id,
+                                   amount, currency, category)
+            rows.append((date, source_id, dest_id, amount, currency,
+                         category))
+        columnar.add_transactions(*zip(*rows))
+
+        start = epoch_us(parse_timestamp("2020-01-01T00:00:00+00:00"))
+        ranges = [(start, start + 60 * US_PER_DAY),
+                  ("2020-01-10T10:00:00+00:00", "2020-01-10T14:00:00+00:00"),
+                  (start + 3 * US_PER_DAY, start + 2 * US_PER_DAY)]
+        for day in range(0, 60, 7):
+            # 10:00 to 14:00 utc
+            t0 = start + day * US_PER_DAY + 10 * 3600 * 10 ** 6
+            ranges.append((t0, t0 + 4 * 3600 * 10 ** 6))
+        for t0, t1 in ranges:
+            epoch0 = t0 if isinstance(t0, int) else \
+                epoch_us(parse_timestamp(t0))
+            epoch1 = t1 if isinstance(t1, int) else \
+                epoch_us(parse_timestamp(t1))
+            expected = TransactionList(my_bank, currency_list, fixed_point)
+            for transaction in txlist.transactions:
+                if epoch0 <= transaction.epoch_us < epoch1:
+                    expected.append(transaction)
+            (incoming, incoming_count), (outgoing, outgoing_count), \
+                internal_count = expected.calculate_balance()
+            for storage in (txlist, columnar):
+                found = storage.time_index().between(t0, t1)
+                assert (found.incoming_count, found.outgoing_count,
+                        found.internal_count) == \
+                    (incoming_count, outgoing_count, internal_count)
+                if fixed_point:
+                    # Exact, whatever the order
+                    assert storage.balance_between(t0, t1) == \
+                        expected.balance
+                else:
+                    # Up to the rounding of the sums themselves
+                    assert storage.balance_between(t0, t1) == \
+                        pytest.approx(expected.balance,
+                                      abs=1e-12 * (incoming + outgoing) + 1e-9)
+
+        # Rates changed, indexed again
+        index = txlist.time_index()
+        currency_list.add_currency_at_date("EUR", 0.5, "2020-01-05T00:00:00"
+                                           "+00:00")
+        assert txlist.time_index() is not index
+        assert txlist.time_index() is txlist.time_index()
+
+
+def test_reconciliation(tmp_path):
+    import parse_transactions
+    folder = str(tmp_path)
+    bank_a, bank_b = gen_bank_id(), gen_bank_id()
+    while bank_b == bank_a:
+        bank_b = gen_bank_id()
+    date = Faker().iso8601() + "+00:00"
+    legs_a, legs_b = [], []
+    for txcount in range(40):
+        transaction_id, source_id, dest_id = gen_transaction(
+            bank_a, *random.choice([(True, False), (False, True)]))
+        # Counterparty in bank B
+        if source_id[:4] != bank_a:
+            source_id = bank_b + source_id[4:]
+        else:
+            dest_id = bank_b + dest_id[4:]
+        row = [date, transaction_id, source_id, dest_id,
+               "{:.2f}".format(random.uniform(1, 1000)), "EUR", "Rent"]
+        legs_a.append(row)
+        legs_b.append(list(row))
+    # Internal ones are no legs
+    internal = list(gen_transaction(bank_a, True, True))
+    legs_a.append([date] + internal + ["5.00", "EUR", "Rent"])
+    legs_b[0][4] = "0.01"  # Amount differs
+    legs_b[1][5] = "USD"  # Currency differs
+    del legs_b[2]  # Only in bank A
+    legs_b.append([date, xeger(config.BANK_ACCOUNT_RULE), bank_a + "0" * 28,
+                   bank_b + "1" * 28, "1.00", "EUR", "Rent"])  # Only in B
+    with open(os.path.join(folder, "transactions.csv"), "w") as f:
+        for bankid, name, rows in ((bank_a, "_0000.csv", legs_a),
+                                   (bank_b, "_pending.csv", legs_b)):
+            with open(os.path.join(folder, bankid + name), "w") as log:
+                log.writelines(",".join(row) + "\n" for row in rows)
+            f.write(",".join((date, bankid, "UTC+00:00", bankid + name,
+                              "Fake Bank")) + "\n")
+
+    outputs = []
+    for buffer_size in (None, 3):
+        result = os.path.join(folder, "result_{}".format(buffer_size))
+        os.mkdir(result)
+        totals = parse_transactions.reconcile_transfers(folder, result,
+                                                        buffer_size=buffer_size)
+        assert totals == {"matched": 37, "mismatched": 2, "one_sided": 2}
+        outputs.append([open(os.path.join(result, name)).read() for name in
+                        ("reconciliation.csv", "reconciliation_summary.csv")])
+    # Same, whether the legs went to disk or not
+    assert outputs[0] == outputs[1]
+    unmatched = list(csv.reader(outputs[0][0].splitlines()))
+    assert sorted(row[0] for row in unmatched) == \
+        ["mismatched", "mismatched", "one_sided", "one_sided"]
+
+    # A small buffer writes the legs to one file per bank pair
+    from bankmanager.reconciliation import LegPartitioner
+    partition_folder = os.path.join(folder, "partitions")
+    os.mkdir(partition_folder)
+    with LegPartitioner(partition_folder, buffer_size=3) as partitioner:
+        for row in legs_a:
+            partitioner.add(bank_a, row)
+        assert len(partitioner) == 40
+        assert len(os.listdir(partition_folder)) == 2
+    assert os.listdir(partition_folder) == []